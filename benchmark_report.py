@@ -0,0 +1,50 @@
+import os
+import json
+import platform
+import subprocess
+from datetime import datetime
+
+# the parts of the benchmark reports shared by telemetry_processor/benchmark.py and vision_system/benchmark_detect.py
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """Get what a run's results depend on besides the code, for the top of its report
+
+    Returns:
+        dict: commit, date, python, platform and cpus
+    """
+    return {
+        'commit': git_commit(),
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+def write_report(report: dict, output: str):
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=4)
+    print(f"Wrote results to {output}")
+
+def load_previous(previous_file: str, key):
+    """Read a previous run's report to compare against
+
+    Args:
+        previous_file (str): A report written by write_report()
+        key (function): result => what identifies the same case in both runs, eg. (scale, stage)
+
+    Returns:
+        dict: key => the previous run's result, for the cases that didn't fail
+    """
+    with open(previous_file, 'r') as file:
+        previous = json.load(file)
+
+    print(f"\nCompared to {previous_file} (commit {previous.get('commit')}):")
+    return { key(x): x for x in previous['results'] if x.get('error') is None }
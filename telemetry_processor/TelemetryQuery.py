@@ -0,0 +1,216 @@
+import numpy as np
+import pandas as pd
+
+class TelemetryQuery:
+    """Time based queries across the message types of a telemetry store
+
+    Fields are selected with 'TYPE.field' strings (eg. 'VFR_HUD.alt'). Every lookup is a binary search
+    (np.searchsorted) on the message type's sorted timestamp array, so sampling any number of fields
+    at any number of times is vectorized.
+
+    Sampling methods:
+        'previous' - the last value at or before each time (as-of)
+        'nearest'  - the value closest in time
+        'linear'   - linearly interpolated between the surrounding values (float fields only, integer
+                     fields such as bitfields and enums and other fields fall back to 'previous')
+    """
+
+    METHODS = ('previous', 'nearest', 'linear')
+
+    store: dict = {}
+
+    def __init__(self, store: dict):
+        """
+        Args:
+            store (dict): msg_type => pd.DataFrame with a 'timestamp' column, eg. from tlog2store()
+        """
+        self.store = store
+        self.sorted = {}
+
+    @staticmethod
+    def parse_selector(selector: str):
+        msg_type, _, field = selector.partition('.')
+        if not field:
+            raise ValueError(f"Field selectors look like TYPE.field, got '{selector}'")
+        return msg_type.upper(), field
+
+    def frame(self, msg_type: str):
+        """Get a message type's data sorted by timestamp
+
+        Args:
+            msg_type (str): The MAVLink message name
+
+        Returns:
+            pd.DataFrame: The message's data
+        """
+        msg_type = msg_type.upper()
+        if msg_type not in self.sorted:
+            if msg_type not in self.store:
+                raise KeyError(f"No {msg_type} messages in the telemetry")
+            data = self.store[msg_type]
+            timestamps = data['timestamp'].to_numpy()
+            if np.any(timestamps[1:] < timestamps[:-1]):
+                data = data.iloc[np.argsort(timestamps, kind='stable')].reset_index(drop=True)
+            self.sorted[msg_type] = data
+        return self.sorted[msg_type]
+
+    def timestamps(self, msg_type: str):
+        return self.frame(msg_type)['timestamp'].to_numpy()
+
+    def time_range(self):
+        """Get the first and last timestamp over every message type
+
+        Returns:
+            tuple: (start, end) unix timestamps
+        """
+        ranges = [(data['timestamp'].min(), data['timestamp'].max()) for data in self.store.values() if len(data)]
+        return min(x[0] for x in ranges), max(x[1] for x in ranges)
+
+    def slice(self, msg_type: str, fields=None, start: float = None, end: float = None):
+        """Select a time window of a message type
+
+        Args:
+            msg_type (str): The MAVLink message name
+            fields (list, optional): The fields to keep (Defaults to all fields)
+            start (float, optional): The first unix timestamp to include
+            end (float, optional): The last unix timestamp to include
+
+        Returns:
+            pd.DataFrame: 'timestamp' followed by the selected fields
+        """
+        data = self.frame(msg_type)
+        timestamps = data['timestamp'].to_numpy()
+        first = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+        last = len(timestamps) if end is None else np.searchsorted(timestamps, end, side='right')
+
+        columns = list(data.columns) if fields is None else ['timestamp'] + [x for x in fields if x != 'timestamp']
+        return data[columns].iloc[first:last].reset_index(drop=True)
+
+    def sample(self, selectors, times, method: str = 'previous', tolerance: float = None):
+        """Sample fields of any message types at the given times
+
+        Args:
+            selectors (list): 'TYPE.field' strings
+            times (np.ndarray): The unix timestamps to sample at
+            method (str, optional): 'previous', 'nearest' or 'linear' (Defaults to 'previous')
+            tolerance (float, optional): Leave a sample empty when the matched message is further than this many
+                                         seconds away (Defaults to no limit)
+
+        Returns:
+            pd.DataFrame: A 'timestamp' column holding times followed by one column per selector
+        """
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown method '{method}', expected one of {', '.join(self.METHODS)}")
+
+        times = np.asarray(times, dtype=np.float64)
+        result = { 'timestamp': times }
+
+        by_type = {}
+        for selector in selectors:
+            msg_type, field = self.parse_selector(selector)
+            by_type.setdefault(msg_type, []).append((selector, field))
+
+        for msg_type, fields in by_type.items():
+            data = self.frame(msg_type)
+            timestamps = data['timestamp'].to_numpy()
+
+            if len(timestamps) == 0:
+                # nothing to match, every sample is empty
+                matched = np.zeros(len(times), dtype=np.int64)
+                valid = stepped = np.zeros(len(times), dtype=bool)
+            else:
+                # index of the last message at or before each time (-1 if there is none)
+                previous = np.searchsorted(timestamps, times, side='right') - 1
+                following = np.minimum(previous + 1, len(timestamps) - 1)
+                before = np.clip(previous, 0, None)
+
+                if method == 'nearest':
+                    use_following = (previous < 0) | (np.abs(timestamps[following] - times) < np.abs(times - timestamps[before]))
+                    matched = np.where(use_following, following, before)
+                else:
+                    matched = before
+
+                # the previous message, also used by 'linear' for integer fields (eg. bitfields and enums) which can't be interpolated
+                stepped = previous >= 0
+                if tolerance is not None:
+                    stepped &= times - timestamps[before] <= tolerance
+
+                if method == 'nearest':
+                    valid = np.ones(len(times), dtype=bool)
+                    if tolerance is not None:
+                        valid &= np.abs(timestamps[matched] - times) <= tolerance
+                elif method == 'linear':
+                    valid = previous >= 0
+                    if tolerance is not None:
+                        # interpolated values need a message within tolerance on both sides
+                        valid &= (times - timestamps[before] <= tolerance) & (timestamps[following] - times <= tolerance)
+                else:
+                    valid = stepped
+
+            for selector, field in fields:
+                if field not in data.columns:
+                    raise KeyError(f"{msg_type} has no field '{field}'")
+                values = data[field].to_numpy()
+
+                interpolate = method == 'linear' and values.dtype.kind == 'f'
+                if len(timestamps) == 0:
+                    column = np.empty(len(times), dtype=values.dtype)
+                elif interpolate:
+                    column = np.interp(times, timestamps, values, left=np.nan, right=np.nan)
+                else:
+                    column = values[matched]
+
+                mask = valid if interpolate or method != 'linear' else stepped
+                if not mask.all():
+                    if column.dtype.kind in 'iub':
+                        column = column.astype(np.float64)
+                    elif column.dtype.kind != 'f':
+                        column = column.astype(object)
+                    column[~mask] = np.nan if column.dtype.kind == 'f' else None
+
+                result[selector] = column
+
+        return pd.DataFrame(result)
+
+    def join(self, msg_type: str, selectors, fields=None, method: str = 'previous', tolerance: float = None, start: float = None, end: float = None):
+        """As-of join: attach fields of other message types to every message of one type
+
+        eg. join('GLOBAL_POSITION_INT', ['ATTITUDE.roll', 'ATTITUDE.pitch', 'ATTITUDE.yaw'], method='nearest')
+
+        Args:
+            msg_type (str): The message type whose timestamps are used
+            selectors (list): 'TYPE.field' strings of the fields to attach
+            fields (list, optional): msg_type's own fields to keep (Defaults to all fields)
+            method, tolerance: See sample()
+            start, end: See slice()
+
+        Returns:
+            pd.DataFrame: msg_type's fields followed by one column per selector
+        """
+        base = self.slice(msg_type, fields, start, end)
+        joined = self.sample(selectors, base['timestamp'].to_numpy(), method, tolerance)
+        return pd.concat([base, joined.drop(columns='timestamp')], axis=1)
+
+    def resample(self, selectors, rate: float, start: float = None, end: float = None, method: str = 'linear', tolerance: float = None):
+        """Resample fields of any message types onto one uniform time grid
+
+        Args:
+            selectors (list): 'TYPE.field' strings
+            rate (float): The sample rate (Hz)
+            start (float, optional): The first unix timestamp of the grid (Defaults to the start of the log)
+            end (float, optional): The last unix timestamp of the grid (Defaults to the end of the log)
+            method, tolerance: See sample()
+
+        Returns:
+            pd.DataFrame: A 'timestamp' column followed by one column per selector
+        """
+        if rate <= 0:
+            raise ValueError("The sample rate must be positive")
+
+        if start is None or end is None:
+            first, last = self.time_range()
+            start = first if start is None else start
+            end = last if end is None else end
+
+        times = start + np.arange(int(np.floor((end - start) * rate)) + 1) / rate
+        return self.sample(selectors, times, method, tolerance)
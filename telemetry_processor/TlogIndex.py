@@ -0,0 +1,238 @@
+import os
+import mmap
+import array
+
+import numpy as np
+from pymavlink import mavutil
+
+class TlogIndex:
+    """Byte-offset index over a .tlog file
+
+    A .tlog is a sequence of records, each one a big endian uint64 timestamp (microseconds) followed by a
+    MAVLink v1 or v2 packet. The index holds the offset, length, timestamp and message id of every packet
+    in compact arrays so a time window or a set of message types can be read straight out of the
+    memory-mapped log without decoding the rest of it. It is saved next to the log as <log>.idx.npz
+    and extended (rather than rebuilt) when the log has grown since.
+    """
+
+    MARKER_V1 = 0xFE
+    MARKER_V2 = 0xFD
+    MAVLINK_IFLAG_SIGNED = 0x01
+    SIGNATURE_LEN = 13
+
+    file: str = None
+    sidecar: str = None
+    offsets: np.ndarray = None
+    lengths: np.ndarray = None
+    timestamps: np.ndarray = None
+    msgids: np.ndarray = None
+    # number of bytes of the log that have been indexed
+    size: int = 0
+
+    def __init__(self, file: str, save: bool = True, sidecar: str = None):
+        """Load the sidecar index of a log, building or extending it as needed
+
+        Args:
+            file (str): The telemetry log (.tlog file)
+            save (bool, optional): Write the sidecar file if the index changed (Defaults to True)
+            sidecar (str, optional): Where to keep the index (Defaults to <log>.idx.npz next to the log)
+        """
+        self.file = file
+        self.sidecar = sidecar if sidecar is not None else f"{file}.idx.npz"
+
+        if not self.load():
+            self.offsets = np.empty(0, dtype=np.int64)
+            self.lengths = np.empty(0, dtype=np.uint16)
+            self.timestamps = np.empty(0, dtype=np.float64)
+            self.msgids = np.empty(0, dtype=np.uint32)
+            self.size = 0
+
+        if self.update() and save:
+            self.save()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def load(self):
+        if not os.path.isfile(self.sidecar):
+            return False
+
+        try:
+            with np.load(self.sidecar) as index:
+                size = int(index['size'])
+                if size > os.path.getsize(self.file):
+                    # the log was replaced by a shorter one
+                    return False
+                self.offsets = index['offsets']
+                self.lengths = index['lengths']
+                self.timestamps = index['timestamps']
+                self.msgids = index['msgids']
+                self.size = size
+        except (OSError, KeyError, ValueError):
+            return False
+
+        return True
+
+    def save(self):
+        try:
+            with open(self.sidecar, 'wb') as file:
+                np.savez(file, offsets=self.offsets, lengths=self.lengths, timestamps=self.timestamps, msgids=self.msgids, size=self.size)
+        except OSError:
+            # a read-only log directory just means the index is rebuilt next time
+            pass
+
+    def update(self):
+        """Index any records appended to the log since the last scan
+
+        Returns:
+            bool: True if new records were indexed
+        """
+        file_size = os.path.getsize(self.file)
+        if file_size <= self.size:
+            return False
+
+        with open(self.file, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                offsets, lengths, timestamps, msgids, self.size = self.scan(data, self.size)
+
+        if not offsets:
+            return False
+
+        self.offsets = np.concatenate((self.offsets, np.frombuffer(offsets, dtype=np.int64)))
+        self.lengths = np.concatenate((self.lengths, np.frombuffer(lengths, dtype=np.uint16)))
+        self.timestamps = np.concatenate((self.timestamps, np.frombuffer(timestamps, dtype=np.uint64) * 1.0e-6))
+        self.msgids = np.concatenate((self.msgids, np.frombuffer(msgids, dtype=np.uint32)))
+        return True
+
+    @classmethod
+    def scan(cls, data, ofs: int = 0):
+        """Walk the records of a log in one pass
+
+        Args:
+            data (mmap.mmap): The log's contents
+            ofs (int, optional): The offset of the first record to scan (Defaults to 0)
+
+        Returns:
+            tuple: (offsets, lengths, timestamps, msgids, end) where the first four are array.arrays
+                   and end is the offset just past the last complete record
+        """
+        offsets = array.array('q')
+        lengths = array.array('H')
+        timestamps = array.array('Q')
+        msgids = array.array('I')
+
+        data_len = len(data)
+        while ofs + 8 + 6 <= data_len:
+            marker = data[ofs+8]
+            payload_len = data[ofs+9]
+            if marker == cls.MARKER_V1:
+                msgid = data[ofs+13]
+                packet_len = payload_len + 8
+            elif marker == cls.MARKER_V2:
+                if ofs + 8 + 10 > data_len:
+                    break
+                msgid = data[ofs+15] | (data[ofs+16] << 8) | (data[ofs+17] << 16)
+                packet_len = payload_len + 12
+                if data[ofs+10] & cls.MAVLINK_IFLAG_SIGNED:
+                    packet_len += cls.SIGNATURE_LEN
+            else:
+                # unrecognised marker, probably a malformed log so look for the next record
+                ofs += 1
+                continue
+
+            if ofs + 8 + packet_len > data_len:
+                # the last record hasn't been completely written yet
+                break
+
+            offsets.append(ofs)
+            lengths.append(packet_len)
+            timestamps.append(int.from_bytes(data[ofs:ofs+8], 'big'))
+            msgids.append(msgid)
+            ofs += 8 + packet_len
+
+        # unscanned trailing bytes are picked up by the next update
+        return offsets, lengths, timestamps, msgids, ofs
+
+    @staticmethod
+    def use_mavlink2():
+        """Switch pymavlink to the MAVLink 2 dialect the same way its own readers do when they see a v2 packet
+
+        The MAVLink 2 parser decodes v1 packets too, and only it knows the v2 extension fields and messages.
+        """
+        if not mavutil.mavlink20():
+            os.environ['MAVLINK20'] = '1'
+            mavutil.set_dialect(mavutil.current_dialect)
+
+    @classmethod
+    def msgids_for(cls, types):
+        cls.use_mavlink2()
+        name_to_id = { msg_cls.msgname: msgid for msgid, msg_cls in mavutil.mavlink.mavlink_map.items() }
+        return np.array([name_to_id[name.upper()] for name in types if name.upper() in name_to_id], dtype=np.uint32)
+
+    def select(self, types=None, start: float = None, end: float = None):
+        """Find the records of some message types within a time window
+
+        Args:
+            types (list, optional): MAVLink message names to select (Defaults to all types)
+            start (float, optional): Only select records at or after this unix timestamp
+            end (float, optional): Only select records at or before this unix timestamp
+
+        Returns:
+            np.ndarray: The positions (into offsets, timestamps, etc.) of the selected records, in log order
+        """
+        first, last = 0, len(self.timestamps)
+        if start is not None or end is not None:
+            if np.all(self.timestamps[1:] >= self.timestamps[:-1]):
+                # sorted (the normal case), so the window can be found with a binary search
+                if start is not None:
+                    first = np.searchsorted(self.timestamps, start, side='left')
+                if end is not None:
+                    last = np.searchsorted(self.timestamps, end, side='right')
+                mask = np.ones(max(0, last - first), dtype=bool)
+            else:
+                mask = np.ones(len(self.timestamps), dtype=bool)
+                if start is not None:
+                    mask &= self.timestamps >= start
+                if end is not None:
+                    mask &= self.timestamps <= end
+        else:
+            mask = np.ones(last - first, dtype=bool)
+
+        if types is not None:
+            mask &= np.isin(self.msgids[first:first+len(mask)], self.msgids_for(types))
+
+        return np.flatnonzero(mask) + first
+
+    def read(self, types=None, start: float = None, end: float = None):
+        """Decode only the selected records, see select()
+
+        Yields:
+            tuple: (timestamp, msg) where msg is the decoded pymavlink message
+        """
+        return self.decode(self.select(types, start, end))
+
+    def decode(self, positions):
+        """Decode the records at the given positions
+
+        Args:
+            positions (np.ndarray): Positions into offsets, timestamps, etc. (eg. from select())
+
+        Yields:
+            tuple: (timestamp, msg) where msg is the decoded pymavlink message
+        """
+        if len(positions) == 0:
+            return
+
+        mav = mavutil.mavlink.MAVLink(None)
+        with open(self.file, 'rb') as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for ofs, length, timestamp in zip(self.offsets[positions].tolist(), self.lengths[positions].tolist(), self.timestamps[positions].tolist()):
+                    if data[ofs+8] == self.MARKER_V2 and not mavutil.mavlink20():
+                        self.use_mavlink2()
+                        mav = mavutil.mavlink.MAVLink(None)
+                    try:
+                        msg = mav.decode(bytearray(data[ofs+8:ofs+8+length]))
+                    except mavutil.mavlink.MAVError:
+                        continue
+                    msg._timestamp = timestamp
+                    yield timestamp, msg
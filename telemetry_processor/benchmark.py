@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import mmap
+import time
+import shutil
+import argparse
+import statistics
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from TlogIndex import TlogIndex
+
+# aero-pada % python3 telemetry_processor/benchmark.py --scales 1,10 --stages decode,csv,report -o bench.json --compare bench_main.json
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# benchmark_report.py is shared with vision_system/benchmark_detect.py
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+import benchmark_report
+DEFAULT_TLOG = os.path.join(SCRIPT_DIR, '..', 'data', '2023-11-06_16-19-38.tlog')
+STAGES = ['index', 'decode', 'csv', 'stream_csv', 'excel', 'report', 'parquet', 'end_to_end']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the telemetry processor on a real log and synthetic logs scaled up from it")
+    parser.add_argument('-i', '--input', type=str, default=DEFAULT_TLOG, help="The telemetry log to benchmark and scale up (.tlog file)")
+    parser.add_argument('-s', '--scales', type=str, default='1,10,100', help="Comma separated scale factors of the synthetic logs (1 is the input itself)")
+    parser.add_argument('--stages', type=str, default=','.join(STAGES), help=f"Comma separated stages to run ({', '.join(STAGES)})")
+    parser.add_argument('-n', '--repeat', type=int, default=1, help="Run each stage this many times and keep the fastest")
+    parser.add_argument('-w', '--work-dir', type=str, default=os.path.join(tempfile.gettempdir(), 'pada_telemetry_benchmark'), help="Where the synthetic logs and exports are written (synthetic logs are reused between runs)")
+    parser.add_argument('-o', '--output', type=str, default='telemetry_benchmark.json', help="The JSON file to write the results to")
+    parser.add_argument('-c', '--compare', type=str, help="A previous results JSON file to compare against")
+
+    args = parser.parse_args()
+    args.input = os.path.expanduser(args.input)
+    args.scales = [int(x) for x in args.scales.split(',') if x.strip()]
+    args.stages = [x.strip() for x in args.stages.split(',') if x.strip()]
+    for stage in args.stages:
+        if stage not in STAGES:
+            parser.error(f"unknown stage '{stage}'")
+
+    return args
+
+def make_fixture(input, scale, work_dir):
+    """Create a synthetic log by repeating the input scale times
+
+    Each copy's timestamps are shifted to follow on from the previous copy so the log stays in time order.
+
+    Args:
+        input (str): The telemetry log to scale up
+        scale (int): How many copies of the input to write
+        work_dir (str): The directory to write the log to
+
+    Returns:
+        str: The path to the synthetic log (the input itself when scale is 1)
+    """
+    if scale == 1:
+        return input
+
+    name = os.path.splitext(os.path.basename(input))[0]
+    path = os.path.join(work_dir, f"{name}_x{scale}.tlog")
+    if os.path.isfile(path) and os.path.getsize(path) == scale * os.path.getsize(input):
+        return path
+
+    os.makedirs(work_dir, exist_ok=True)
+    with open(input, 'rb') as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offsets, _, timestamps, _, _ = TlogIndex.scan(data)
+            buf = np.frombuffer(data, dtype=np.uint8).copy()
+
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    timestamps = np.frombuffer(timestamps, dtype=np.uint64)
+    positions = offsets[:, None] + np.arange(8)
+    span = int(timestamps.max() - timestamps.min()) + 1000000
+
+    with open(path, 'wb') as file:
+        for copy in range(scale):
+            shifted = (timestamps + np.uint64(copy * span)).astype('>u8')
+            buf[positions] = shifted.view(np.uint8).reshape(-1, 8)
+            file.write(buf.tobytes())
+
+    return path
+
+def peak_rss_mb(children: bool = False):
+    # the peak of this process, or of the finished child processes (eg. the end to end run)
+    try:
+        import resource
+    except ImportError:
+        # not available on Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1 << 20) if sys.platform == 'darwin' else rss / (1 << 10)
+
+def run_stage(stage, tlog, output):
+    """Run one stage in a fresh process (see benchmark()) and measure it
+
+    Args:
+        stage (str): One of STAGES
+        tlog (str): The telemetry log
+        output (str): The directory to export to
+
+    Returns:
+        dict: seconds (the timed part of the stage), messages and peak_rss_mb
+    """
+    import telemetry_processor as tp
+
+    shutil.rmtree(output, ignore_errors=True)
+    os.makedirs(output)
+
+    if stage == 'end_to_end':
+        # the whole command line tool, including interpreter start up and imports
+        cmd = [sys.executable, os.path.join(SCRIPT_DIR, 'telemetry_processor.py'), '--all', '--overwrite', '--no-copy-tlog', '-o', output, tlog]
+        start = time.perf_counter()
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL)
+        seconds = time.perf_counter() - start
+        return { 'seconds': seconds, 'messages': None, 'peak_rss_mb': peak_rss_mb(children=True) }
+
+    if stage == 'index':
+        # a sidecar in the (just emptied) output directory, so the index is built from scratch without touching
+        # an index kept next to the log
+        start = time.perf_counter()
+        index = TlogIndex(tlog, save=False, sidecar=os.path.join(output, 'index.idx.npz'))
+        return { 'seconds': time.perf_counter() - start, 'messages': len(index), 'peak_rss_mb': peak_rss_mb() }
+
+    if stage == 'stream_csv':
+        start = time.perf_counter()
+        with tp.CsvStream(output) as csv_stream:
+            tp.tlog2store(tlog, csv_stream=csv_stream, keep_store=False)
+        return { 'seconds': time.perf_counter() - start, 'messages': csv_stream.count, 'peak_rss_mb': peak_rss_mb() }
+
+    start = time.perf_counter()
+    store = tp.tlog2store(tlog)
+    seconds = time.perf_counter() - start
+    messages = sum(len(data) for data in store.values())
+
+    if stage != 'decode':
+        exporter = { 'csv': tp.export_csv, 'excel': tp.export_excel, 'report': tp.export_report, 'parquet': tp.export_parquet }[stage]
+        start = time.perf_counter()
+        exporter(output, store)
+        seconds = time.perf_counter() - start
+
+    return { 'seconds': seconds, 'messages': messages, 'peak_rss_mb': peak_rss_mb() }
+
+def benchmark(stage, tlog, output, repeat):
+    runs = []
+    for _ in range(repeat):
+        # a fresh interpreter for every run so peak RSS belongs to this stage alone
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            runs.append(executor.submit(run_stage, stage, tlog, output).result())
+
+    result = min(runs, key=lambda x: x['seconds'])
+    result['runs'] = [x['seconds'] for x in runs]
+    result['median_seconds'] = statistics.median(result['runs'])
+    return result
+
+def compare(results, previous_file):
+    before = benchmark_report.load_previous(previous_file, lambda x: (x['scale'], x['stage']))
+    for result in results:
+        old = before.get((result['scale'], result['stage']))
+        if old is None or result.get('error') is not None:
+            continue
+        speedup = old['seconds'] / result['seconds'] if result['seconds'] else float('inf')
+        print(f"  x{result['scale']:<4} {result['stage']:<11} {old['seconds']:8.3f}s -> {result['seconds']:8.3f}s ({speedup:.2f}x)")
+
+def main():
+    args = parse_args()
+
+    if not os.path.isfile(args.input):
+        print(f"Error: Input file is not a file: {args.input}")
+        exit()
+
+    results = []
+    for scale in args.scales:
+        print(f"Preparing x{scale} log")
+        tlog = make_fixture(args.input, scale, args.work_dir)
+        size = os.path.getsize(tlog)
+
+        for stage in args.stages:
+            output = os.path.join(args.work_dir, f"output_x{scale}_{stage}")
+            result = { 'scale': scale, 'stage': stage, 'bytes': size }
+            try:
+                result.update(benchmark(stage, tlog, output, args.repeat))
+            except Exception as exc:
+                result['error'] = str(exc)
+                print(f"  x{scale:<4} {stage:<11} failed: {exc}")
+                results.append(result)
+                continue
+
+            result['mb_per_s'] = size / 1E6 / result['seconds'] if result['seconds'] else None
+            result['messages_per_s'] = result['messages'] / result['seconds'] if result['messages'] and result['seconds'] else None
+            results.append(result)
+
+            rate = f", {result['messages_per_s']:.0f} messages/s" if result['messages_per_s'] else ''
+            rss = f", peak RSS {result['peak_rss_mb']:.0f} MB" if result['peak_rss_mb'] else ''
+            print(f"  x{scale:<4} {stage:<11} {result['seconds']:8.3f}s ({result['mb_per_s']:.2f} MB/s{rate}{rss})")
+
+    report = benchmark_report.environment()
+    report.update({
+        'input': os.path.basename(args.input),
+        'repeat': args.repeat,
+        'results': results,
+    })
+    benchmark_report.write_report(report, args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == "__main__":
+    main()
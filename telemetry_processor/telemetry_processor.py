@@ -5,44 +5,183 @@ import csv
 import argparse
 import math
 import shutil
+import array
+import glob
+import time
+import importlib.util
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
 import pandas as pd
 from datetime import datetime, timezone
 import plotly.graph_objs as go
 from plotly.subplots import make_subplots
+from pymavlink import mavutil
 
-# aero-pada % find /Users/jeff/Desktop/2024-01-31/*.tlog -type f -print0 | xargs -0 -I {} python3 telemetry_processor/telemetry_processor.py -m ~/code/pymavlink/tools/mavlogdump.py --all --overwrite "{}"
+from TlogIndex import TlogIndex
+from TelemetryQuery import TelemetryQuery
+
+# aero-pada % python3 telemetry_processor/telemetry_processor.py --all --overwrite --jobs 8 /Users/jeff/Desktop/2024-01-31/
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Analyze PADA video and telemetry to attempt lamding at markers")
-    parser.add_argument('INPUT', type=str, help="The telemetry log to process (.tlog file)")
-    parser.add_argument('-o', '--output', type=str, help="The path directory to output the files to")
-    parser.add_argument('-m', '--mavlogdump', type=str, default='mavlogdump.py', help="The path to the mavlogdump.py executable")
+    parser.add_argument('INPUT', type=str, nargs='+', help="The telemetry logs to process (.tlog files, directories or glob patterns)")
+    parser.add_argument('-o', '--output', type=str, help="The path directory to output the files to (the parent directory when processing multiple logs)")
+    parser.add_argument('-m', '--mavlogdump', type=str, default=None, help="Decode with the mavlogdump.py executable at this path instead of the built-in decoder")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="The number of worker processes to use when processing multiple logs")
+    parser.add_argument('--start', type=float, help="Only process messages at least this many seconds after the start of the log")
+    parser.add_argument('--end', type=float, help="Only process messages at most this many seconds after the start of the log")
+    parser.add_argument('--types', type=str, help="Only process these message types (comma separated, eg. GLOBAL_POSITION_INT,ATTITUDE)")
+    parser.add_argument('-F', '--follow', action='store_true', help="Keep processing the log as it is written, only decoding the newly appended messages")
+    parser.add_argument('--refresh', type=float, default=5.0, help="How often (seconds) --follow refreshes the report and columnar files")
+    parser.add_argument('--idle-timeout', type=float, help="Stop following once the log hasn't grown for this many seconds (Defaults to following until ctrl+c)")
     parser.add_argument('-t', '--no-copy-tlog', action='store_true', help="Don't copy the .tlog file to the output directory")
     parser.add_argument('-w', '--overwrite', action='store_true', help="Allow overwriting of the output directory")
     parser.add_argument('-a', '--all', action='store_true', help="Enable all export formats")
     parser.add_argument('-c', '--csv', action='store_true', help="Output a csv for each mavlink message")
+    parser.add_argument('-s', '--stream', action='store_true', help="Write the csv files while the log is being decoded so memory use doesn't grow with the log length")
     parser.add_argument('-e', '--excel', action='store_true', help="Output an Excel file with the data")
     parser.add_argument('-r', '--report', action='store_true', help="Output an HTML report")
+    parser.add_argument('--report-points', type=int, default=REPORT_MAX_POINTS, help="The maximum number of points to draw for each trace in the report, 0 draws every sample")
+    parser.add_argument('--webgl', action='store_true', help="Draw the report's traces with WebGL")
+    parser.add_argument('-q', '--query', type=str, help="Output query.csv with these fields (comma separated TYPE.field, eg. GLOBAL_POSITION_INT.lat,ATTITUDE.yaw)")
+    parser.add_argument('--on', type=str, help="Sample the query fields at the timestamps of this message type (Defaults to the type of the first query field)")
+    parser.add_argument('--rate', type=float, help="Resample the query fields to this rate (Hz) instead of joining them on a message type")
+    parser.add_argument('--method', type=str, choices=TelemetryQuery.METHODS, help="How query fields are sampled (Defaults to linear with --rate, previous otherwise)")
+    parser.add_argument('--tolerance', type=float, help="Leave query fields empty when the nearest message is further than this many seconds away")
+    parser.add_argument('-p', '--parquet', action='store_true', help="Output a compressed parquet file for each mavlink message (requires pyarrow)")
+    parser.add_argument('-f', '--feather', action='store_true', help="Output an uncompressed, memory mappable Arrow IPC (feather) file for each mavlink message (requires pyarrow)")
 
     args = parser.parse_args()
-    
-    if(args.output is None):
-        input_name = os.path.splitext(os.path.basename(args.INPUT))[0]
-        output_name = input_name.replace(' ', '_')
-        args.output = os.path.join(os.path.dirname(args.INPUT), output_name)
 
     if(args.all):
         args.csv = True
         args.excel = True
         args.report = True
-
-    args.INPUT = os.path.expanduser(args.INPUT)
-    args.output = os.path.expanduser(args.output)
-    args.mavlogdump = os.path.expanduser(args.mavlogdump)
+        # the columnar formats are optional since they need pyarrow
+        args.parquet = args.parquet or HAS_PYARROW
+        args.feather = args.feather or HAS_PYARROW
+
+    args.batch = len(args.INPUT) > 1 or any(os.path.isdir(os.path.expanduser(x)) or glob.has_magic(x) for x in args.INPUT)
+    if(args.follow and (args.batch or args.mavlogdump or args.start is not None or args.end is not None)):
+        parser.error("--follow takes a single log and can't be combined with --mavlogdump, --start or --end")
+    args.INPUT = expand_inputs(args.INPUT)
+    if(args.output is not None):
+        args.output = os.path.expanduser(args.output)
+    if(args.mavlogdump is not None):
+        args.mavlogdump = os.path.expanduser(args.mavlogdump)
+    if(args.types is not None):
+        args.types = [x.strip().upper() for x in args.types.split(',') if x.strip()]
+    if(args.query is not None):
+        args.query = [x.strip() for x in args.query.split(',') if x.strip()]
+        for selector in args.query:
+            if('.' not in selector.strip('.')):
+                parser.error(f"query fields look like TYPE.field, got '{selector}'")
 
     return args
 
-def tlog2lists(file, mavlogdump):
+def expand_inputs(inputs):
+    """Expand directories and glob patterns into a list of telemetry logs
+
+    Args:
+        inputs (list): Paths to .tlog files, directories (searched recursively) or glob patterns
+
+    Returns:
+        list: The telemetry logs in the order given, without duplicates
+    """
+    files = []
+    for item in inputs:
+        item = os.path.expanduser(item)
+        if os.path.isdir(item):
+            files.extend(sorted(glob.glob(os.path.join(item, '**', '*.tlog'), recursive=True)))
+        elif glob.has_magic(item):
+            files.extend(sorted(glob.glob(item, recursive=True)))
+        else:
+            files.append(item)
+
+    return list(dict.fromkeys(files))
+
+def output_dir(input, output=None, batch=False):
+    """Get the output directory for a telemetry log
+
+    Args:
+        input (str): The telemetry log
+        output (str, optional): The output directory given on the command line
+        batch (bool, optional): Whether multiple logs are being processed, in which case each log gets a sub directory of output
+
+    Returns:
+        str: The directory to export the log to
+    """
+    if(output is not None and not batch):
+        return output
+
+    input_name = os.path.splitext(os.path.basename(input))[0]
+    output_name = input_name.replace(' ', '_')
+    return os.path.join(os.path.dirname(input) if output is None else output, output_name)
+
+def message_fields(msg):
+    """Get a decoded message's fields the way mavlogdump's json output has them
+
+    Arrays become lists and byte strings become str so the exporters see identical values either way.
+
+    Args:
+        msg: The pymavlink message
+
+    Returns:
+        dict: field name => value
+    """
+    fields = msg.to_dict()
+    del fields['mavpackettype']
+    for key, value in fields.items():
+        if type(value) == array.array:
+            fields[key] = list(value)
+        elif type(value) == bytes:
+            fields[key] = value.decode(errors='backslashreplace')
+    return fields
+
+def decode_tlog(file, types=None, low_memory=False, start=None, end=None):
+    """Decode a .tlog file in-process, one message at a time
+
+    BAD_DATA records are skipped. When types, start or end are given the records are read through the
+    log's TlogIndex so only the selected messages are decoded.
+
+    Args:
+        file (str): The telemetry log to decode (.tlog file)
+        types (list, optional): Only yield these message types (Defaults to all types)
+        low_memory (bool, optional): Read the file sequentially instead of through pymavlink's mmap reader, which is
+                                     faster but keeps an offset index that grows with the log (Defaults to False)
+        start (float, optional): Only yield messages at least this many seconds after the first message in the log
+        end (float, optional): Only yield messages at most this many seconds after the first message in the log
+
+    Yields:
+        tuple: (timestamp, msg_type, fields)
+    """
+    if(types is not None or start is not None or end is not None):
+        index = TlogIndex(file)
+        if(len(index) == 0):
+            return
+        t0 = index.timestamps[0]
+        start = None if start is None else t0 + start
+        end = None if end is None else t0 + end
+        for timestamp, msg in index.read(types, start, end):
+            yield timestamp, msg.get_type(), message_fields(msg)
+        return
+
+    mlog = mavutil.mavlogfile(file) if low_memory else mavutil.mavlink_connection(file)
+    try:
+        while True:
+            msg = mlog.recv_match()
+            if msg is None:
+                break
+
+            msg_type = msg.get_type()
+            if msg_type == 'BAD_DATA':
+                continue
+
+            yield getattr(msg, '_timestamp', 0.0), msg_type, message_fields(msg)
+    finally:
+        mlog.close()
+
+def mavlogdump2lists(file, mavlogdump):
     cmd = ['python3', mavlogdump, file, '--format', 'json']
     try:
         ret = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
@@ -62,36 +201,420 @@ def tlog2lists(file, mavlogdump):
 
         return messages
 
-def export_csv(output_dir, messages):
+# array.array typecodes for the MAVLink wire types so that each column is stored at its native width
+MAVLINK_TYPECODES = {
+    'int8_t': 'b',
+    'uint8_t': 'B',
+    'int16_t': 'h',
+    'uint16_t': 'H',
+    'int32_t': 'i',
+    'uint32_t': 'I',
+    'int64_t': 'q',
+    'uint64_t': 'Q',
+    'float': 'f',
+    'double': 'd',
+}
+
+# dialect module name => { msg_type: message class }
+MAVLINK_CLASSES = {}
+
+HAS_PYARROW = importlib.util.find_spec('pyarrow') is not None
+
+def mavlink_typecodes(msg_type):
+    """Look up the array.array typecode of each field in a MAVLink message type
+
+    Args:
+        msg_type (str): The MAVLink message name (eg. VFR_HUD)
+
+    Returns:
+        dict: field name => typecode, the typecode is None for fields kept as Python objects (strings and arrays)
+    """
+    # pymavlink switches to the MAVLink 2 dialect (with extra fields) once it sees a v2 packet
+    classes = MAVLINK_CLASSES.get(mavutil.mavlink.__name__)
+    if classes is None:
+        classes = MAVLINK_CLASSES[mavutil.mavlink.__name__] = { cls.msgname: cls for cls in mavutil.mavlink.mavlink_map.values() }
+
+    cls = classes.get(msg_type)
+    if cls is None:
+        return {}
+
+    array_lengths = dict(zip(cls.ordered_fieldnames, cls.array_lengths))
+    return { name: None if array_lengths.get(name) else MAVLINK_TYPECODES.get(field_type) for name, field_type in zip(cls.fieldnames, cls.fieldtypes) }
+
+class MessageColumns:
+    """Accumulates the fields of one message type into typed columns
+
+    Numeric fields are appended to array.array buffers of the field's MAVLink type, strings and arrays
+    are kept in lists. If the field set changes part way through the log, missing values are filled with
+    NaN (float columns) or None (everything else, which falls back to a list).
+    """
+    timestamps: array.array = None
+    columns: dict = {}
+    typecodes: dict = {}
+
+    def __init__(self, msg_type: str):
+        self.typecodes = mavlink_typecodes(msg_type)
+        self.timestamps = array.array('d')
+        self.columns = {}
+
+    def new_column(self, key, value, length):
+        if key in self.typecodes:
+            typecode = self.typecodes[key]
+        elif type(value) == float:
+            typecode = 'd'
+        elif type(value) == int:
+            typecode = 'q'
+        else:
+            typecode = None
+
+        if typecode in ('f', 'd'):
+            return array.array(typecode, [math.nan]) * length
+        if typecode is not None and length == 0:
+            return array.array(typecode)
+        return [None] * length
+
+    def append(self, timestamp: float, fields: dict):
+        length = len(self.timestamps)
+        for key, value in fields.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = self.new_column(key, value, length)
+            try:
+                column.append(value)
+            except (TypeError, OverflowError):
+                # the value doesn't fit the column's typecode, keep the column as objects from now on
+                column = self.columns[key] = list(column)
+                column.append(value)
+
+        # schema drift: pad the columns this message didn't have
+        if len(fields) != len(self.columns):
+            for key, column in self.columns.items():
+                if len(column) > length:
+                    continue
+                if isinstance(column, array.array) and column.typecode in ('f', 'd'):
+                    column.append(math.nan)
+                else:
+                    column = self.columns[key] = list(column)
+                    column.append(None)
+
+        self.timestamps.append(timestamp)
+
+    def to_frame(self, copy=False):
+        """Build a DataFrame from the columns
+
+        Args:
+            copy (bool, optional): Copy the numeric columns, needed if more messages will be appended
+                                   afterwards since a buffer being viewed can't be resized (Defaults to False)
+
+        Returns:
+            pd.DataFrame: A float64 'timestamp' column followed by one column per field
+        """
+        convert = np.array if copy else np.frombuffer
+        data = { 'timestamp': convert(self.timestamps, dtype=np.float64) }
+        for key, column in self.columns.items():
+            if isinstance(column, array.array):
+                data[key] = convert(column, dtype=column.typecode)
+            else:
+                data[key] = pd.Series(column, dtype=object)
+        return pd.DataFrame(data, copy=False)
+
+def append_records(builders, records):
+    """Add decoded messages to a dict of msg_type => MessageColumns"""
+    for timestamp, msg_type, fields in records:
+        builder = builders.get(msg_type)
+        if builder is None:
+            builder = builders[msg_type] = MessageColumns(msg_type)
+        builder.append(timestamp, fields)
+
+def records2store(records):
+    """Build the columnar telemetry store from a stream of decoded messages
+
+    Args:
+        records (iterable): (timestamp, msg_type, fields) tuples, eg. from decode_tlog()
+
+    Returns:
+        dict: msg_type => pd.DataFrame
+    """
+    builders = {}
+    append_records(builders, records)
+    return { msg_type: builder.to_frame() for msg_type, builder in builders.items() }
+
+def filter_records(records, t0, types=None, start=None, end=None):
+    """Apply decode_tlog()'s types, start and end filters to already decoded records, t0 is the log's first timestamp"""
+    types = None if types is None else set(x.upper() for x in types)
+    for timestamp, msg_type, fields in records:
+        if types is not None and msg_type not in types:
+            continue
+        if (start is not None and timestamp < t0 + start) or (end is not None and timestamp > t0 + end):
+            continue
+        yield timestamp, msg_type, fields
+
+def tlog2records(file, mavlogdump=None, low_memory=False, types=None, start=None, end=None):
+    if(mavlogdump is not None):
+        # the external mavlogdump.py is only used when explicitly requested
+        messages = mavlogdump2lists(file, mavlogdump)
+        if(messages is None):
+            return None
+        records = ((timestamp, msg_type, data) for msg_type in messages for timestamp, data in messages[msg_type])
+        if(types is not None or start is not None or end is not None):
+            t0 = min((values[0][0] for values in messages.values() if values), default=0.0)
+            return filter_records(records, t0, types, start, end)
+        return records
+
+    return decode_tlog(file, types=types, low_memory=low_memory, start=start, end=end)
+
+def tlog2store(file, mavlogdump=None, csv_stream=None, keep_store=True, types=None, start=None, end=None):
+    """Decode a telemetry log into the columnar store
+
+    Args:
+        file (str): The telemetry log to decode (.tlog file)
+        mavlogdump (str, optional): Decode with this mavlogdump.py instead of the built-in decoder
+        csv_stream (CsvStream, optional): Also write every message to these csv files while decoding
+        keep_store (bool, optional): Build the store, when False the messages are only streamed to csv_stream
+        types, start, end: Only decode part of the log, see decode_tlog()
+
+    Returns:
+        dict: msg_type => pd.DataFrame (empty if keep_store is False), None if decoding failed
+    """
+    records = tlog2records(file, mavlogdump, low_memory=not keep_store, types=types, start=start, end=end)
+    if(records is None):
+        return None
+
+    if(csv_stream is not None):
+        records = csv_stream.tee(records)
+
+    try:
+        if(keep_store):
+            return records2store(records)
+        for _ in records:
+            pass
+        return {}
+    except Exception as exc:
+        print(f"{exc}\n\nDecoding failed with above error while processing input: {file}")
+        return None
+
+class CsvFile:
+    """One message type's csv file, rows are buffered and written in batches"""
+    file = None
+    writer = None
+    fields: list = []
+    rows: list = []
+
+    def __init__(self, path: str, fields: list):
+        self.file = open(path, 'w', newline='', buffering=CsvStream.BUFFER_SIZE)
+        self.writer = csv.writer(self.file)
+        self.fields = fields
+        self.field_set = set(fields)
+        self.rows = []
+        self.writer.writerow(['timestamp'] + fields)
+
+    def append(self, row: list):
+        self.rows.append(row)
+        if len(self.rows) >= CsvStream.BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.writer.writerows(self.rows)
+        self.rows.clear()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class CsvStream:
+    """Writes a csv for each message type while the log is being decoded
+
+    Only BATCH_SIZE rows per message type are held in memory. If a message type's field set changes, missing
+    fields are left empty and new fields start a new file ({msg_type}.1.csv, {msg_type}.2.csv, ...) with the
+    extended header.
+    """
+    BATCH_SIZE = 1024
+    BUFFER_SIZE = 1 << 16
+
+    output_dir: str = None
+    files: dict = {}
+    parts: dict = {}
+    count: int = 0
+
+    def __init__(self, output_dir: str):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.files = {}
+        self.parts = {}
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self, msg_type, fields):
+        part = self.parts.get(msg_type, 0)
+        self.parts[msg_type] = part + 1
+        name = msg_type.lower() if part == 0 else f"{msg_type.lower()}.{part}"
+        self.files[msg_type] = CsvFile(os.path.join(self.output_dir, f"{name}.csv"), fields)
+        return self.files[msg_type]
+
+    def write(self, timestamp: float, msg_type: str, fields: dict):
+        file = self.files.get(msg_type)
+        if file is None:
+            file = self.open(msg_type, list(fields))
+
+        keys = list(fields)
+        if keys == file.fields:
+            row = [timestamp]
+            row.extend(fields.values())
+        else:
+            if not file.field_set.issuperset(keys):
+                file.close()
+                file = self.open(msg_type, file.fields + [key for key in keys if key not in file.field_set])
+            row = [timestamp] + [fields.get(key, '') for key in file.fields]
+
+        file.append(row)
+        self.count += 1
+
+    def tee(self, records):
+        """Write every record while passing it through
+
+        Args:
+            records (iterable): (timestamp, msg_type, fields) tuples, eg. from decode_tlog()
+
+        Yields:
+            tuple: (timestamp, msg_type, fields)
+        """
+        for record in records:
+            self.write(*record)
+            yield record
+
+    def flush(self):
+        """Write out every buffered row so the files are complete up to the last message"""
+        for file in self.files.values():
+            file.flush()
+            file.file.flush()
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+def widen_floats(data):
+    # float fields are written as the doubles pymavlink decodes them to (eg. 1.1629976034164429 rather than
+    # the float32's 1.1629976), the same text as CsvStream and the csv module
+    floats = { key: np.float64 for key, dtype in data.dtypes.items() if dtype == np.float32 }
+    return data.astype(floats) if floats else data
+
+def export_csv(output_dir, store):
+    os.makedirs(output_dir, exist_ok=True)
+    for msg_type, data in store.items():
+        data = widen_floats(data)
+        data.to_csv(os.path.join(output_dir, f"{msg_type.lower()}.csv"), index=False, lineterminator='\r\n')
+
+def columnar_path(output_dir, msg_type, extension, part=None):
+    # --follow appends numbered part files to a directory per message type instead of writing one file
+    if(part is None):
+        return os.path.join(output_dir, f"{msg_type.lower()}.{extension}")
+    os.makedirs(os.path.join(output_dir, msg_type.lower()), exist_ok=True)
+    return os.path.join(output_dir, msg_type.lower(), f"part-{part:05d}.{extension}")
+
+def export_parquet(output_dir, store, part=None):
+    os.makedirs(output_dir, exist_ok=True)
+    for msg_type, data in store.items():
+        data.to_parquet(columnar_path(output_dir, msg_type, 'parquet', part), index=False, compression='zstd')
+
+def export_feather(output_dir, store, part=None):
     os.makedirs(output_dir, exist_ok=True)
-    for msg_type in messages.keys():
-        with open(os.path.join(output_dir, f"{msg_type.lower()}.csv"), 'w') as file:
-            writer = csv.writer(file)
-            headers = ['timestamp'] + list(messages[msg_type][0][1].keys())
-            writer.writerow(headers)
-            for tlm_value in messages[msg_type]:
-                row = [tlm_value[0]] + list(tlm_value[1].values())
-                writer.writerow(row)
-
-def message2df(message):
-    rows = []
-    for timestamp, metrics in message:
-        row = {'timestamp': timestamp}
-        row.update(metrics)
-        rows.append(row)
-
-    return pd.DataFrame(rows)
-
-def export_excel(output_dir, messages):
+    for msg_type, data in store.items():
+        # left uncompressed so that readers can memory map the columns without copying them
+        data.to_feather(columnar_path(output_dir, msg_type, 'feather', part), compression='uncompressed')
+
+def read_columnar(file, columns=None):
+    """Load a message type exported with --parquet or --feather
+
+    Only the requested columns are read, feather files are memory mapped.
+
+    Args:
+        file (str): The .parquet or .feather file (eg. output/vfr_hud.parquet), or the directory of part files
+                    written by --follow (eg. output/vfr_hud)
+        columns (list, optional): The columns to load (eg. ['timestamp', 'alt']), defaults to all columns
+
+    Returns:
+        pd.DataFrame: The message's data
+    """
+    if(os.path.isdir(file)):
+        from pyarrow import dataset
+        parts = sorted(glob.glob(os.path.join(file, 'part-*')))
+        file_format = 'feather' if parts and parts[0].endswith('.feather') else 'parquet'
+        return dataset.dataset(parts, format=file_format).to_table(columns=columns).to_pandas()
+
+    if(os.path.splitext(file)[1] == '.feather'):
+        from pyarrow import feather
+        return feather.read_table(file, columns=columns, memory_map=True).to_pandas()
+    return pd.read_parquet(file, columns=columns)
+
+def export_excel(output_dir, store):
     os.makedirs(output_dir, exist_ok=True)
 
     with pd.ExcelWriter(os.path.join(output_dir, f"data.xlsx")) as writer:
-        for message in messages.keys():
-            data = message2df(messages[message])
-            data.to_excel(writer, sheet_name=message.lower(), index=None)
+        for msg_type, data in store.items():
+            data.to_excel(writer, sheet_name=msg_type.lower(), index=None)
+
+
+# default maximum number of points drawn for each trace in the report
+REPORT_MAX_POINTS = 4000
+
+def localtime(timestamps):
+    """Convert unix timestamps to local wall-clock datetime64 values
+
+    Plotly shows datetimes as wall-clock time anyway and serializes datetime64 arrays in one go,
+    where timezone aware values are converted one datetime object at a time.
+    """
+    timestamps = np.asarray(timestamps)
+    if(len(timestamps) == 0):
+        return timestamps.astype('datetime64[us]')
+
+    # use the local UTC offset at the start of the trace, a flight won't cross a DST change
+    local_timezone = datetime.fromtimestamp(float(timestamps[0]), timezone.utc).astimezone().tzinfo
+    return pd.to_datetime(timestamps, unit='s', utc=True).tz_convert(local_timezone).tz_localize(None).to_numpy()
+
+def downsample(values, max_points):
+    """Pick the samples of a trace to plot so that it has roughly max_points points
+
+    The trace is split into equal sized buckets and the minimum and maximum sample of each bucket
+    are kept (along with the first and last sample) so peaks and steps survive the decimation.
 
+    Args:
+        values (np.ndarray): The y values of the trace
+        max_points (int): The point budget, 0 or None keeps every sample
 
-def export_report(output_dir, messages):
+    Returns:
+        np.ndarray: The sorted indices of the samples to keep
+    """
+    count = len(values)
+    if(not max_points or count <= max_points):
+        return np.arange(count)
+
+    buckets = max(1, (max_points - 2) // 2)
+    size = -(-count // buckets)
+
+    padded = np.full(buckets * size, np.nan)
+    padded[:count] = values
+    padded = padded.reshape(buckets, size)
+    missing = np.isnan(padded)
+    offsets = np.arange(buckets) * size
+
+    lows = np.argmin(np.where(missing, np.inf, padded), axis=1) + offsets
+    highs = np.argmax(np.where(missing, -np.inf, padded), axis=1) + offsets
+
+    indices = np.unique(np.concatenate(([0, count - 1], lows, highs)))
+    return indices[indices < count]
+
+def add_line(fig, timestamps, values, name, row, col, max_points=REPORT_MAX_POINTS, webgl=False):
+    values = np.asarray(values)
+    indices = downsample(values, max_points)
+    scatter = go.Scattergl if webgl else go.Scatter
+    fig.add_trace(scatter(x=localtime(np.asarray(timestamps)[indices]), y=values[indices], mode='lines', name=name), row=row, col=col)
+
+def export_report(output_dir, store, max_points=REPORT_MAX_POINTS, webgl=False):
     os.makedirs(output_dir, exist_ok=True)
 
     fig = make_subplots(
@@ -109,126 +632,380 @@ def export_report(output_dir, messages):
     min_timestamp = None
     max_timestamp = None
 
-    for key in messages:
-        timestamps = [item[0] for item in messages[key]]
-        if timestamps:
-            min_key_timestamp = min(timestamps)
-            max_key_timestamp = max(timestamps)
+    for data in store.values():
+        timestamps = data['timestamp']
+        if len(timestamps):
+            min_key_timestamp = timestamps.min()
+            max_key_timestamp = timestamps.max()
             min_timestamp = min(min_timestamp, min_key_timestamp) if min_timestamp is not None else min_key_timestamp
             max_timestamp = max(max_timestamp, max_key_timestamp) if max_timestamp is not None else max_key_timestamp
 
-    flight_time = max_timestamp-min_timestamp
+    flight_time = max_timestamp-min_timestamp if min_timestamp is not None else 0.0
 
     fig.update_layout(title_text=f"Flight on {os.path.basename(output_dir)} (Duration: {flight_time:.1f}s)")
 
-    if('VFR_HUD' in messages.keys()):
-        vfr = message2df(messages['VFR_HUD'])
-
-        vfr['localtime'] = [datetime.utcfromtimestamp(t).replace(tzinfo=timezone.utc).astimezone() for t in vfr['timestamp']]
-        maximum = vfr.max()
-        fig.layout.annotations[0].update(text=f"Altitude (VFR_HUD) - Max: {maximum['alt']:.2f}m")
+    if('VFR_HUD' in store):
+        vfr = store['VFR_HUD']
+        timestamps = vfr['timestamp']
 
         # Altitude
-        fig.layout.annotations[0].update(text=f"Altitude - Max: {maximum['alt']:.2f}m")
-        fig.add_trace(go.Scatter(x=vfr['localtime'], y=vfr['alt'], mode='lines', name='Altitude'), row=1, col=1)
+        fig.layout.annotations[0].update(text=f"Altitude - Max: {vfr['alt'].max():.2f}m")
+        add_line(fig, timestamps, vfr['alt'], 'Altitude', 1, 1, max_points, webgl)
         fig.update_yaxes(title_text=f"Altitude (m)", row=1, col=1)
         fig.update_xaxes(title_text="Timestamp", row=1, col=1)
 
         # Air speed
-        fig.layout.annotations[1].update(text=f"Airspeed vs Time (VFR_HUD) - Max: {maximum['airspeed']:.2f}m/s")
-        fig.add_trace(go.Scatter(x=vfr['localtime'], y=vfr['airspeed'], mode='lines', name='Airspeed'), row=1, col=2)
+        fig.layout.annotations[1].update(text=f"Airspeed vs Time (VFR_HUD) - Max: {vfr['airspeed'].max():.2f}m/s")
+        add_line(fig, timestamps, vfr['airspeed'], 'Airspeed', 1, 2, max_points, webgl)
         fig.update_yaxes(title_text="Airspeed (m/s)", row=1, col=2)
         fig.update_xaxes(title_text="Timestamp", row=1, col=2)
 
         # Ground speed
-        fig.layout.annotations[2].update(text=f"Groundspeed vs Time (VFR_HUD) - Max: {maximum['groundspeed']:.2f}m/s")
-        fig.add_trace(go.Scatter(x=vfr['localtime'], y=vfr['groundspeed'], mode='lines', name='Groundspeed'), row=2, col=1)
+        fig.layout.annotations[2].update(text=f"Groundspeed vs Time (VFR_HUD) - Max: {vfr['groundspeed'].max():.2f}m/s")
+        add_line(fig, timestamps, vfr['groundspeed'], 'Groundspeed', 2, 1, max_points, webgl)
         fig.update_yaxes(title_text="Groundspeed (m/s)", row=2, col=1)
         fig.update_xaxes(title_text="Timestamp", row=2, col=1)
 
-    if('AHRS2' in messages.keys()):
-        ahrs = message2df(messages['AHRS2'])
-
-        ahrs['localtime'] = [datetime.utcfromtimestamp(t).replace(tzinfo=timezone.utc).astimezone() for t in ahrs['timestamp']]
-        ahrs['yaw'] = ahrs['yaw'].apply(lambda x: math.degrees(x))
-        ahrs['pitch'] = ahrs['pitch'].apply(lambda x: math.degrees(x))
-        ahrs['roll'] = ahrs['roll'].apply(lambda x: math.degrees(x))
+    if('AHRS2' in store):
+        ahrs = store['AHRS2']
+        timestamps = ahrs['timestamp']
 
         fig.layout.annotations[3].update(text=f"Attitude vs Time (AHRS2)")
-        fig.add_trace(go.Scatter(x=ahrs['localtime'], y=ahrs['yaw'], mode='lines', name='Yaw'), row=2, col=2)
-        fig.add_trace(go.Scatter(x=ahrs['localtime'], y=ahrs['pitch'], mode='lines', name='Pitch'), row=2, col=2)
-        fig.add_trace(go.Scatter(x=ahrs['localtime'], y=ahrs['roll'], mode='lines', name='Roll'), row=2, col=2)
+        add_line(fig, timestamps, np.degrees(ahrs['yaw'].to_numpy()), 'Yaw', 2, 2, max_points, webgl)
+        add_line(fig, timestamps, np.degrees(ahrs['pitch'].to_numpy()), 'Pitch', 2, 2, max_points, webgl)
+        add_line(fig, timestamps, np.degrees(ahrs['roll'].to_numpy()), 'Roll', 2, 2, max_points, webgl)
 
         fig.update_yaxes(title_text=f"Attitude (degrees)", row=2, col=2)
         fig.update_xaxes(title_text="Timestamp", row=2, col=2)
 
-    if('HEARTBEAT' in messages.keys()):
+    if('HEARTBEAT' in store):
         MAV_TYPE_FIXED_WING = 1
-        hb = message2df(messages['HEARTBEAT'])
-
-        hb = hb.drop(hb[hb['type'] != MAV_TYPE_FIXED_WING].index)
-        hb['mode_auto'] = [1 if (x & (1 << 2)) else 0 for x in hb['base_mode']]
-        hb['mode_guided'] = [1 if (x & (1 << 3)) else 0 for x in hb['base_mode']]
-        hb['mode_stabilize'] = [1 if (x & (1 << 4)) else 0 for x in hb['base_mode']]
-        hb['mode_manual'] = [1 if (x & (1 << 6)) else 0 for x in hb['base_mode']]
-        hb['mode_safety'] = [1 if (x & (1 << 7)) else 0 for x in hb['base_mode']]
+        hb = store['HEARTBEAT']
 
-        hb['localtime'] = [datetime.utcfromtimestamp(t).replace(tzinfo=timezone.utc).astimezone() for t in hb['timestamp']]
+        fixed_wing = hb['type'].to_numpy() == MAV_TYPE_FIXED_WING
+        timestamps = hb['timestamp'].to_numpy()[fixed_wing]
+        base_mode = hb['base_mode'].to_numpy()[fixed_wing]
 
         fig.layout.annotations[4].update(text=f"Mode (HEARTBEAT)")
-        fig.add_trace(go.Scatter(x=hb['localtime'], y=hb['mode_auto'], mode='lines', name='Auto'), row=3, col=1)
-        fig.add_trace(go.Scatter(x=hb['localtime'], y=hb['mode_guided'], mode='lines', name='Guided'), row=3, col=1)
-        fig.add_trace(go.Scatter(x=hb['localtime'], y=hb['mode_stabilize'], mode='lines', name='Stabilize'), row=3, col=1)
-        fig.add_trace(go.Scatter(x=hb['localtime'], y=hb['mode_manual'], mode='lines', name='Manual'), row=3, col=1)
-        fig.add_trace(go.Scatter(x=hb['localtime'], y=hb['mode_safety'], mode='lines', name='Safety'), row=3, col=1)
+        for name, bit in [('Auto', 2), ('Guided', 3), ('Stabilize', 4), ('Manual', 6), ('Safety', 7)]:
+            add_line(fig, timestamps, (base_mode >> bit) & 1, name, 3, 1, max_points, webgl)
 
         fig.update_yaxes(title_text=f"Mode", row=3, col=1)
         fig.update_xaxes(title_text="Timestamp", row=3, col=1)
 
     fig.write_html(os.path.join(output_dir, "report.html"))
 
-def main():
-    args = parse_args()
-
-    if(args.INPUT == args.output):
-        print(f"Error: Input file and output file is the same: {args.INPUT}")
-
-    if(not os.path.exists(args.INPUT)):
-        print(f"Error: Input file does not exist: f{args.INPUT}")
-        exit()
-
-    if(not os.path.isfile(args.INPUT)):
-        print(f"Error: Input file is not a file: f{args.INPUT}")
-        exit()
-
-    if(os.path.exists(args.output) and not args.overwrite):
-        print(f"Error: Output directory already exists {args.output}")
-        exit()
+def export_query(output_dir, store, selectors, on=None, rate=None, method=None, tolerance=None):
+    """Output query.csv with the selected fields joined on a message type or resampled to a fixed rate
+
+    Args:
+        output_dir (str): The directory to export to
+        store (dict): The telemetry store
+        selectors (list): 'TYPE.field' strings
+        on (str, optional): The message type to join on (Defaults to the first selector's type)
+        rate (float, optional): Resample to this rate (Hz) instead of joining
+        method (str, optional): See TelemetryQuery.sample()
+        tolerance (float, optional): See TelemetryQuery.sample()
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    query = TelemetryQuery(store)
 
-    messages = tlog2lists(args.INPUT, args.mavlogdump)
-    if(messages is None):
-        exit()
+    if(rate is not None):
+        data = query.resample(selectors, rate, method=method or 'linear', tolerance=tolerance)
+    else:
+        on = on or TelemetryQuery.parse_selector(selectors[0])[0]
+        data = query.join(on, selectors, fields=[], method=method or 'previous', tolerance=tolerance)
+
+    # the same text for a field as export_csv()
+    widen_floats(data).to_csv(os.path.join(output_dir, "query.csv"), index=False)
+
+def query_types(args):
+    types = [TelemetryQuery.parse_selector(x)[0] for x in args.query]
+    if(args.on is not None and args.rate is None):
+        types.append(args.on.upper())
+    return list(dict.fromkeys(types))
+
+def process_tlog(input, output, args):
+    """Decode a telemetry log and export it in every format enabled in args
+
+    Args:
+        input (str): The telemetry log to process (.tlog file)
+        output (str): The directory to export to
+        args (argparse.Namespace): The parsed command line options
+
+    Returns:
+        dict: Summary of the run (input, output, bytes, messages, seconds, exported, error)
+    """
+    start = time.perf_counter()
+    result = { 'input': input, 'output': output, 'bytes': 0, 'messages': 0, 'seconds': 0.0, 'exported': [], 'error': None }
+
+    if(input == output):
+        result['error'] = f"Input file and output file is the same: {input}"
+    elif(not os.path.exists(input)):
+        result['error'] = f"Input file does not exist: {input}"
+    elif(not os.path.isfile(input)):
+        result['error'] = f"Input file is not a file: {input}"
+    elif(os.path.exists(output) and not args.overwrite):
+        result['error'] = f"Output directory already exists {output}"
+    if(result['error'] is not None):
+        return result
+
+    result['bytes'] = os.path.getsize(input)
+
+    exported = result['exported']
+
+    types = args.types
+    if(args.query and types is None and not (args.csv or args.excel or args.report or args.parquet or args.feather)):
+        # only the queried message types need to be decoded
+        types = query_types(args)
+
+    if(args.csv and args.stream):
+        # the store is only built when another format needs the whole log in memory
+        keep_store = args.excel or args.report or args.parquet or args.feather
+        with CsvStream(output) as csv_stream:
+            store = tlog2store(input, args.mavlogdump, csv_stream=csv_stream, keep_store=keep_store or bool(args.query), types=types, start=args.start, end=args.end)
+        if(store is not None):
+            exported.append('CSV')
+            result['messages'] = csv_stream.count
+    else:
+        store = tlog2store(input, args.mavlogdump, types=types, start=args.start, end=args.end)
+        if(store is not None):
+            result['messages'] = sum(len(data) for data in store.values())
 
-    exported = []
+    if(store is None):
+        result['error'] = f"Could not decode {input}"
+        return result
 
-    if(args.csv):
+    if(args.csv and not args.stream):
         exported.append('CSV')
-        export_csv(args.output, messages)
+        export_csv(output, store)
 
     if(args.excel):
         exported.append('Excel')
-        export_excel(args.output, messages)
+        export_excel(output, store)
 
     if(args.report):
         exported.append('Report')
-        export_report(args.output, messages)
+        export_report(output, store, max_points=args.report_points, webgl=args.webgl)
+
+    if(args.parquet):
+        exported.append('Parquet')
+        export_parquet(output, store)
+
+    if(args.feather):
+        exported.append('Feather')
+        export_feather(output, store)
+
+    if(args.query):
+        try:
+            export_query(output, store, args.query, on=args.on, rate=args.rate, method=args.method, tolerance=args.tolerance)
+        except (KeyError, ValueError) as exc:
+            result['error'] = f"Query failed: {exc}"
+            return result
+        exported.append('Query')
+
+    if(exported and not args.no_copy_tlog):
+        shutil.copy2(input, output)
+
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+# how often --follow checks the log for new records (seconds)
+FOLLOW_POLL_INTERVAL = 0.5
+
+def follow_tlog(input, output, args):
+    """Process a log that is still being written, decoding only the records appended since the last poll
+
+    Csv files are appended to as messages arrive. The report and the parquet/feather part files are
+    refreshed every args.refresh seconds from the in-memory store, and the Excel and query outputs are
+    written once following stops (ctrl+c, or args.idle_timeout seconds without the log growing).
+
+    Args:
+        input (str): The telemetry log being written (.tlog file)
+        output (str): The directory to export to
+        args (argparse.Namespace): The parsed command line options
+
+    Returns:
+        dict: Summary of the run, see process_tlog()
+    """
+    start = time.perf_counter()
+    result = { 'input': input, 'output': output, 'bytes': 0, 'messages': 0, 'seconds': 0.0, 'exported': [], 'error': None }
+    os.makedirs(output, exist_ok=True)
+
+    keep_store = args.report or args.excel or args.parquet or args.feather or args.query
+    csv_stream = CsvStream(output) if args.csv else None
+    index = TlogIndex(input, save=False)
+    msgids = None if args.types is None else TlogIndex.msgids_for(args.types)
+
+    builders = {}
+    written = {}
+    part = 0
+    position = 0
+    changed = False
+    last_refresh = 0.0
+    last_growth = time.monotonic()
+
+    def refresh():
+        nonlocal part
+        store = { msg_type: builder.to_frame(copy=True) for msg_type, builder in builders.items() }
+        if(args.report and store):
+            export_report(output, store, max_points=args.report_points, webgl=args.webgl)
+        if(args.parquet or args.feather):
+            new_rows = { msg_type: data.iloc[written.get(msg_type, 0):] for msg_type, data in store.items() if len(data) > written.get(msg_type, 0) }
+            if(new_rows):
+                if(args.parquet):
+                    export_parquet(output, new_rows, part=part)
+                if(args.feather):
+                    export_feather(output, new_rows, part=part)
+                part += 1
+                written.update({ msg_type: len(store[msg_type]) for msg_type in new_rows })
+        return store
+
+    print(f"Following {input}, press ctrl+c to stop")
+    try:
+        while True:
+            index.update()
+            if(len(index) > position):
+                positions = np.arange(position, len(index))
+                if(msgids is not None):
+                    positions = positions[np.isin(index.msgids[positions], msgids)]
+                position = len(index)
+                last_growth = time.monotonic()
+
+                for timestamp, msg in index.decode(positions):
+                    msg_type = msg.get_type()
+                    if(msg_type == 'BAD_DATA'):
+                        continue
+                    fields = message_fields(msg)
+                    if(csv_stream is not None):
+                        csv_stream.write(timestamp, msg_type, fields)
+                    if(keep_store):
+                        append_records(builders, [(timestamp, msg_type, fields)])
+                    result['messages'] += 1
+
+                if(csv_stream is not None):
+                    csv_stream.flush()
+                changed = True
+
+            now = time.monotonic()
+            if(changed and now - last_refresh >= args.refresh):
+                refresh()
+                changed = False
+                last_refresh = now
+                print(f"{result['messages']} messages, {index.size/1E6:.1f} MB")
+
+            if(args.idle_timeout is not None and now - last_growth >= args.idle_timeout):
+                break
+
+            time.sleep(FOLLOW_POLL_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if(csv_stream is not None):
+            csv_stream.close()
+
+    store = refresh()
+    exported = result['exported']
+    for enabled, name in [(args.csv, 'CSV'), (args.report, 'Report'), (args.parquet, 'Parquet'), (args.feather, 'Feather')]:
+        if(enabled):
+            exported.append(name)
+
+    if(args.excel):
+        exported.append('Excel')
+        export_excel(output, store)
+
+    if(args.query):
+        try:
+            export_query(output, store, args.query, on=args.on, rate=args.rate, method=args.method, tolerance=args.tolerance)
+        except (KeyError, ValueError) as exc:
+            result['error'] = f"Query failed: {exc}"
+            return result
+        exported.append('Query')
+
+    if(not args.no_copy_tlog):
+        shutil.copy2(input, output)
+
+    result['bytes'] = index.size
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def init_worker():
+    # pay for the MAVLink class lookup and plotly's lazy imports once per worker instead of once per log
+    mavlink_typecodes('HEARTBEAT')
+    make_subplots(rows=1, cols=1)
+
+def process_batch(args):
+    """Process every input log across a pool of worker processes and print a summary
+
+    Args:
+        args (argparse.Namespace): The parsed command line options
+    """
+    jobs = max(1, min(args.jobs or 1, len(args.INPUT)))
+    print(f"Processing {len(args.INPUT)} logs with {jobs} workers")
+
+    start = time.perf_counter()
+    results = {}
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+        futures = { executor.submit(process_tlog, input, output_dir(input, args.output, batch=True), args): input for input in args.INPUT }
+        for future in as_completed(futures):
+            input = futures[future]
+            try:
+                results[input] = future.result()
+            except Exception as exc:
+                results[input] = { 'input': input, 'bytes': 0, 'messages': 0, 'seconds': 0.0, 'exported': [], 'error': str(exc) }
+            print(f"[{len(results)}/{len(futures)}] {input}")
+    elapsed = time.perf_counter() - start
+
+    print()
+    for input in args.INPUT:
+        result = results[input]
+        if(result['error'] is not None):
+            print(f"FAILED {input}: {result['error']}")
+        else:
+            print(f"OK     {input}: {result['messages']} messages, {result['bytes']/1E6:.1f} MB in {result['seconds']:.1f}s -> '{result['output']}'")
+
+    processed = [result for result in results.values() if result['error'] is None]
+    total_bytes = sum(result['bytes'] for result in processed)
+    total_messages = sum(result['messages'] for result in processed)
+    print(f"\nProcessed {len(processed)}/{len(results)} logs ({total_bytes/1E6:.1f} MB, {total_messages} messages) in {elapsed:.1f}s: "
+          f"{total_bytes/1E6/elapsed:.2f} MB/s, {total_messages/elapsed:.0f} messages/s")
 
-    if(not exported):
+def main():
+    args = parse_args()
+
+    if(not args.csv and not args.excel and not args.report and not args.parquet and not args.feather and not args.query):
         print("Warning: no export formats were chosen")
+        exit()
+
+    if((args.parquet or args.feather) and not HAS_PYARROW):
+        print("Error: pyarrow is required for parquet and feather export (python3 -m pip install pyarrow)")
+        exit()
+
+    if(not args.INPUT):
+        print("Error: No telemetry logs found")
+        exit()
+
+    if(args.batch):
+        process_batch(args)
+        return
+
+    input = args.INPUT[0]
+    if(args.follow):
+        output = output_dir(input, args.output)
+        if(not os.path.isfile(input)):
+            print(f"Error: Input file is not a file: {input}")
+            exit()
+        if(os.path.exists(output) and not args.overwrite):
+            print(f"Error: Output directory already exists {output}")
+            exit()
+        result = follow_tlog(input, output, args)
     else:
-        if(not args.no_copy_tlog):
-            shutil.copy2(args.INPUT, args.output)
-        print(f"Exported formats: {', '.join(exported)} to '{args.output}'")
+        result = process_tlog(input, output_dir(input, args.output), args)
+    if(result['error'] is not None):
+        print(f"Error: {result['error']}")
+        exit()
+
+    print(f"Exported formats: {', '.join(result['exported'])} to '{result['output']}'")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+import os
+import sys
+import json
+import struct
+import subprocess
+
+from pymavlink.dialects.v20 import ardupilotmega as mavlink2
+
+# decodes the log in a fresh interpreter (so pymavlink starts on its default MAVLink 1 dialect) with the
+# index and with a full read, and prints the fields of each
+COMPARE = """
+import sys, json
+from pymavlink import mavutil
+from TlogIndex import TlogIndex
+
+def fields(msg):
+    return { name: getattr(msg, name) for name in msg.get_fieldnames() }
+
+index = TlogIndex(sys.argv[1], save=False)
+indexed = [(msg.get_type(), fields(msg)) for _, msg in index.read()]
+
+full = []
+log = mavutil.mavlink_connection(sys.argv[1])
+while True:
+    msg = log.recv_match()
+    if msg is None:
+        break
+    full.append((msg.get_type(), fields(msg)))
+print(json.dumps({ 'indexed': indexed, 'full': full }))
+"""
+
+def write_v2_log(path: str):
+    mav = mavlink2.MAVLink(None, srcSystem=1, srcComponent=1)
+    messages = [
+        mav.heartbeat_encode(1, 3, 81, 0, 4),
+        # both have MAVLink 2 extension fields
+        mav.gps_raw_int_encode(1000, 3, 429792118, -811439136, 250000, 80, 120, 1500, 9000, 12, alt_ellipsoid=251000, h_acc=1200, v_acc=1800, vel_acc=300, hdg_acc=5000, yaw=4500),
+        mav.servo_output_raw_encode(2000, 0, 1100, 1200, 1300, 1400, 1500, 1600, 1700, 1800, servo9_raw=1900, servo16_raw=2000),
+    ]
+    with open(path, 'wb') as file:
+        for i, msg in enumerate(messages):
+            file.write(struct.pack('>Q', 1700000000000000 + i * 100000))
+            file.write(msg.pack(mav))
+
+def test_indexed_decode_matches_full_decode_of_v2_log(tmp_path):
+    log = str(tmp_path / 'v2.tlog')
+    write_v2_log(log)
+
+    env = { name: value for name, value in os.environ.items() if name != 'MAVLINK20' }
+    result = subprocess.run([sys.executable, '-c', COMPARE, log], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                            capture_output=True, text=True, check=True)
+    decoded = json.loads(result.stdout)
+
+    assert len(decoded['indexed']) == 3
+    assert decoded['indexed'] == decoded['full']
+    gps = dict(decoded['indexed'])['GPS_RAW_INT']
+    assert gps['alt_ellipsoid'] == 251000 and gps['yaw'] == 4500
+    assert dict(decoded['indexed'])['SERVO_OUTPUT_RAW']['servo9_raw'] == 1900
@@ -0,0 +1,154 @@
+import json
+
+import cv2
+import numpy as np
+
+class CameraModel:
+    """Pinhole camera intrinsics and lens distortion, with a cached table of the ray through each pixel
+
+    Undistorting a pixel is an iterative solve (cv2.undistortPoints), so the rays are computed once per
+    resolution on a grid of every step pixels and looked up with bilinear interpolation afterwards. The
+    table is kept on the instance, so the live loop and offline analysis sharing a CameraModel share it too.
+
+    Rays are in camera space: x=width (right), y=height (down), z=into the page.
+    """
+
+    fx: float = None
+    fy: float = None
+    cx: float = None
+    cy: float = None
+    dist: np.ndarray = None
+    width: int = None
+    height: int = None
+    step: int = 4
+    tables: dict = {}
+
+    def __init__(self, fx: float, fy: float, cx: float = None, cy: float = None, dist=None, width: int = None, height: int = None, step: int = 4):
+        """
+        Args:
+            fx (float): Focal length (pixels)
+            fy (float): Focal length (pixels)
+            cx (float, optional): Principal point (pixels, Defaults to the centre pixel)
+            cy (float, optional): Principal point (pixels, Defaults to the centre pixel)
+            dist (list, optional): OpenCV distortion coefficients (k1, k2, p1, p2[, k3, ...]) (Defaults to no distortion)
+            width (int, optional): The resolution the intrinsics were calibrated at, they're scaled to other
+                                   resolutions (Defaults to using the intrinsics at any resolution as they are)
+            height (int, optional): See width
+            step (int, optional): Pixels between the rays in the table, 1 for every pixel (Defaults to 4)
+        """
+        self.fx = fx
+        self.fy = fy
+        self.cx = cx
+        self.cy = cy
+        self.dist = None if dist is None or not np.any(dist) else np.asarray(dist, dtype=np.float64)
+        self.width = width
+        self.height = height
+        self.step = max(1, int(step))
+        self.tables = {}
+
+    @classmethod
+    def from_fov(cls, hfov: float, width: int, height: int, dist=None, step: int = 4):
+        """Create a camera from its horizontal field of view (square pixels, centred principal point)
+
+        Args:
+            hfov (float): Horizontal field of view (degrees)
+            width (int): The image width (pixels)
+            height (int): The image height (pixels)
+            dist, step: See __init__()
+        """
+        f = (width / 2) / np.tan(np.radians(hfov) / 2)
+        return cls(f, f, (width - 1) / 2, (height - 1) / 2, dist, width, height, step)
+
+    @classmethod
+    def load(cls, file: str):
+        """Load a calibration from a JSON file
+
+        eg. { "width": 1920, "height": 1080, "fx": 1400.2, "fy": 1398.7, "cx": 961.5, "cy": 537.1, "dist": [-0.12, 0.08, 0, 0, 0] }
+        or  { "width": 1920, "height": 1080, "hfov": 84 }
+
+        Args:
+            file (str): The calibration file
+
+        Returns:
+            CameraModel: The camera
+        """
+        with open(file, 'r') as f:
+            calibration = json.load(f)
+
+        step = calibration.get('step', 4)
+        if 'hfov' in calibration:
+            return cls.from_fov(calibration['hfov'], calibration['width'], calibration['height'], calibration.get('dist'), step)
+        return cls(calibration['fx'], calibration['fy'], calibration.get('cx'), calibration.get('cy'), calibration.get('dist'),
+                   calibration.get('width'), calibration.get('height'), step)
+
+    def intrinsics(self, width: int, height: int):
+        """Get the camera matrix at a resolution
+
+        Args:
+            width (int): The image width (pixels)
+            height (int): The image height (pixels)
+
+        Returns:
+            np.ndarray: The 3x3 camera matrix
+        """
+        scale_x = 1 if self.width is None else width / self.width
+        scale_y = 1 if self.height is None else height / self.height
+        cx = int(width/2) if self.cx is None else self.cx * scale_x
+        cy = int(height/2) if self.cy is None else self.cy * scale_y
+        return np.array([[self.fx * scale_x, 0, cx], [0, self.fy * scale_y, cy], [0, 0, 1]], dtype=np.float64)
+
+    def ray_table(self, width: int, height: int):
+        """Get the table of rays for a resolution, building it the first time
+
+        Args:
+            width (int): The image width (pixels)
+            height (int): The image height (pixels)
+
+        Returns:
+            np.ndarray: (rows, columns, 2) array of the undistorted normalized (x, y) (ie. the ray (x, y, 1))
+                        through pixels (column * step, row * step). The grid reaches one step past the last pixel.
+        """
+        key = (width, height)
+        if key not in self.tables:
+            xs = np.arange(0, max(width - 1, 1) + self.step, self.step, dtype=np.float64)
+            ys = np.arange(0, max(height - 1, 1) + self.step, self.step, dtype=np.float64)
+            grid = np.stack(np.meshgrid(xs, ys), axis=-1)
+
+            K = self.intrinsics(width, height)
+            if self.dist is None:
+                table = (grid - K[:2, 2]) / (K[0, 0], K[1, 1])
+            else:
+                table = cv2.undistortPoints(grid.reshape(-1, 1, 2), K, self.dist).reshape(grid.shape)
+
+            table.flags.writeable = False
+            self.tables[key] = table
+
+        return self.tables[key]
+
+    def pixels2rays(self, x, y, width: int, height: int):
+        """Get the unit rays through pixels
+
+        Args:
+            x (np.ndarray): The x pixel coordinates
+            y (np.ndarray): The y pixel coordinates
+            width (int): The image width (pixels)
+            height (int): The image height (pixels)
+
+        Returns:
+            np.ndarray: (N, 3) unit rays in camera space
+        """
+        table = self.ray_table(width, height)
+        gx = np.asarray(x, dtype=np.float64).ravel() / self.step
+        gy = np.asarray(y, dtype=np.float64).ravel() / self.step
+
+        # bilinear interpolation between the four surrounding rays (exact for a camera without distortion)
+        ix = np.clip(np.floor(gx).astype(np.intp), 0, table.shape[1] - 2)
+        iy = np.clip(np.floor(gy).astype(np.intp), 0, table.shape[0] - 2)
+        tx = (gx - ix)[:, None]
+        ty = (gy - iy)[:, None]
+        top = table[iy, ix] * (1 - tx) + table[iy, ix + 1] * tx
+        bottom = table[iy + 1, ix] * (1 - tx) + table[iy + 1, ix + 1] * tx
+        xy = top * (1 - ty) + bottom * ty
+
+        rays = np.concatenate([xy, np.ones((len(xy), 1))], axis=1)
+        return rays / np.linalg.norm(rays, axis=1, keepdims=True)
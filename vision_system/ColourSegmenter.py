@@ -0,0 +1,100 @@
+import cv2
+import numpy as np
+
+class ColourSegmenter:
+    """Labels every colour of an HLS frame in a single pass using lookup tables
+
+    Each colour is one or more boxes in HLS space (an inclusive lower and upper bound per channel, the same
+    as cv2.inRange). The boxes are compiled once into a lookup table per channel whose entries are bit masks
+    of the boxes containing that channel value. A pixel lies in the boxes set in all three of its channels'
+    bit masks, and a second table maps those bits to the label of the colour. Where the colours overlap,
+    the first colour in colour_ranges wins.
+
+    That replaces an inRange, bitwise_or, bitwise_and and cvtColor pass over the frame for every colour
+    with three table lookups and two ANDs for all of them.
+    """
+
+    # cv2.LUT works on 8 or 16 bit tables, so that's the most boxes that fit in a bit mask
+    MAX_RANGES = 16
+
+    colours: list = []
+    channel_lut: np.ndarray = None
+    label_lut: np.ndarray = None
+    # optional StageTimer for the time spent finding each colour's blobs ('contours.<colour>')
+    timer = None
+
+    def __init__(self, colour_ranges: dict):
+        """
+        Args:
+            colour_ranges (dict): colour name => list of [(lower h, l, s), (upper h, l, s)] boxes
+        """
+        self.colours = list(colour_ranges.keys())
+        boxes = [(label, lower, upper) for label, colour in enumerate(self.colours, 1) for lower, upper in colour_ranges[colour]]
+        if len(boxes) > self.MAX_RANGES:
+            raise ValueError(f"At most {self.MAX_RANGES} colour ranges are supported, got {len(boxes)}")
+
+        dtype = np.uint8 if len(boxes) <= 8 else np.uint16
+        values = np.arange(256)
+
+        # bit i of channel_lut[c][v] is set if box i contains the value v on channel c
+        self.channel_lut = np.zeros((3, 256), dtype=dtype)
+        for bit, (_, lower, upper) in enumerate(boxes):
+            for channel in range(3):
+                inside = (values >= lower[channel]) & (values <= upper[channel])
+                self.channel_lut[channel, inside] |= dtype(1 << bit)
+
+        # label of the lowest set bit, ie. the first matching colour
+        masks = np.arange(1 << (8 * np.dtype(dtype).itemsize))
+        self.label_lut = np.zeros(len(masks), dtype=np.uint8)
+        for bit, (label, _, _) in reversed(list(enumerate(boxes))):
+            self.label_lut[(masks >> bit) & 1 == 1] = label
+
+        self.timer = None
+
+    def labels(self, hls: cv2.typing.MatLike):
+        """Label the pixels of a frame by colour
+
+        Args:
+            hls (cv2.typing.MatLike): The frame converted to HLS
+
+        Returns:
+            np.ndarray: uint8 image where 0 is background and n means the pixel is self.colours[n-1]
+        """
+        # a 3 channel table is slower than splitting the planes and looking them up one at a time
+        h, l, s = [cv2.LUT(plane, lut) for plane, lut in zip(cv2.split(hls), self.channel_lut)]
+        bits = cv2.bitwise_and(cv2.bitwise_and(h, l), s)
+        if bits.dtype == np.uint8:
+            return cv2.LUT(bits, self.label_lut)
+        return self.label_lut[bits]
+
+    def bounding_boxes(self, labels: np.ndarray):
+        """Find the blobs of every colour in a label image
+
+        Blobs are the outer contours of each colour's mask, found with cv2.findContours rather than
+        cv2.connectedComponentsWithStats: the masks are sparse, and tracing only the blob outlines is more
+        than ten times faster than labelling every pixel.
+
+        Args:
+            labels (np.ndarray): Label image from labels()
+
+        Returns:
+            list: (colour, boxes) for each colour present, where boxes is a list of (x, y, w, h) bounding rectangles
+        """
+        timer = self.timer
+        found = []
+        for label, colour in enumerate(self.colours, 1):
+            if timer:
+                start = timer.now()
+            mask = cv2.compare(labels, label, cv2.CMP_EQ)
+            if not cv2.countNonZero(mask):
+                if timer:
+                    timer.lap('contours.' + colour, start)
+                continue
+
+            cnts = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            cnts = cnts[0] if len(cnts) == 2 else cnts[1] # if an older verison of findContours()
+            found.append((colour, [cv2.boundingRect(c) for c in cnts]))
+            if timer:
+                timer.lap('contours.' + colour, start)
+
+        return found
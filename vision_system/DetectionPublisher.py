@@ -0,0 +1,158 @@
+import sys
+import json
+import socket
+from urllib.parse import urlparse
+
+import numpy as np
+
+from Detections import Detections
+
+# a binary record is HEADER_DTYPE followed by count TARGET_DTYPE rows (little endian)
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('frame', '<u4'),
+    ('time', '<f8'),
+    ('count', '<u2'),
+])
+TARGET_DTYPE = np.dtype([
+    ('x', '<u2'),
+    ('y', '<u2'),
+    ('w', '<u2'),
+    ('h', '<u2'),
+    ('color', 'u1'),
+    # the track ID, 0 without tracking
+    ('id', '<i4'),
+    # whether lat and lon are a location, one of DetectionPublisher.GEO_STATUS
+    ('geo', 'u1'),
+    # NaN when geo isn't valid
+    ('lat', '<f8'),
+    ('lon', '<f8'),
+])
+
+class DetectionPublisher:
+    """Publishes each frame's detections as a compact record to a file or UDP
+
+    Formats:
+        json: one line of JSON per frame (NDJSON), eg.
+              {"frame":12,"time":1699301978.41,"targets":[{"x":812,"y":404,"w":40,"h":38,"color":"red","geo":"valid","lat":42.97921,"lon":-81.14391}]}
+        binary: a HEADER_DTYPE header (magic b'PADA') then a TARGET_DTYPE row per target, where color indexes
+                TargetDetect's colours (red, orange, yellow, blue, purple) and geo indexes GEO_STATUS
+
+    Each target's geo tells a consumer why it has no location: no_telemetry when the frame couldn't be
+    georeferenced at all, above_horizon when the target's ray never meets the ground (eg. a steep bank),
+    otherwise valid. lat and lon are null (NaN in binary) unless it's valid.
+
+    Over UDP each frame is one datagram.
+    """
+
+    FORMATS = ['json', 'binary']
+    MAGIC = b'PADA'
+    GEO_STATUS = ['no_telemetry', 'valid', 'above_horizon']
+    GEO_NO_TELEMETRY, GEO_VALID, GEO_ABOVE_HORIZON = range(3)
+
+    target: str = None
+    format: str = 'json'
+    count: int = 0
+
+    def __init__(self, target: str, format: str = 'json'):
+        """
+        Args:
+            target (str): udp://host:port, a file, or - for stdout
+            format (str, optional): json or binary (Defaults to json)
+        """
+        if format not in self.FORMATS:
+            raise Exception(f"Unknown publish format {format} (expected {', '.join(self.FORMATS)})")
+        self.target = target
+        self.format = format
+        self.count = 0
+
+        self.sock = None
+        self.file = None
+        url = urlparse(target)
+        if url.scheme == 'udp':
+            self.address = (url.hostname, url.port)
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif target == '-':
+            self.file = sys.stdout.buffer
+        else:
+            self.file = open(target, 'wb')
+
+    def encode(self, frame: int, time: float, centroids: Detections, coords: dict = None):
+        """Encode one frame's record
+
+        Args:
+            frame (int): The frame number
+            time (float): When the frame was captured (time.time())
+            centroids (Detections): The targets
+            coords (dict, optional): Their coordinates from TargetDetect.pixels2coords_batch() (Defaults to None)
+
+        Returns:
+            bytes: The record
+        """
+        ids = centroids['id'] if 'id' in centroids.array.dtype.names else None
+        if coords is None:
+            geo = np.full(len(centroids), self.GEO_NO_TELEMETRY, dtype=np.uint8)
+        else:
+            geo = np.where(coords['valid'], self.GEO_VALID, self.GEO_ABOVE_HORIZON).astype(np.uint8)
+
+        if self.format == 'json':
+            targets = []
+            for i, (c, colour) in enumerate(zip(centroids.array.tolist(), centroids.colour_names())):
+                # the tracker's velocities don't need float32's digits
+                target = { name: round(value, 2) if isinstance(value, float) else value for name, value in zip(centroids.array.dtype.names, c) }
+                del target['frame']
+                target['color'] = colour
+                target['geo'] = self.GEO_STATUS[geo[i]]
+                # null (NaN isn't JSON) without a location
+                valid = geo[i] == self.GEO_VALID
+                target['lat'] = round(float(coords['lat'][i]), 8) if valid else None
+                target['lon'] = round(float(coords['lon'][i]), 8) if valid else None
+                targets.append(target)
+            record = { 'frame': frame, 'time': time, 'targets': targets }
+            return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+        header = np.zeros(1, dtype=HEADER_DTYPE)
+        header['magic'] = self.MAGIC
+        header['frame'] = frame
+        header['time'] = time
+        header['count'] = len(centroids)
+
+        targets = np.zeros(len(centroids), dtype=TARGET_DTYPE)
+        for name in ('x', 'y', 'w', 'h', 'color'):
+            targets[name] = centroids[name]
+        if ids is not None:
+            targets['id'] = ids
+        targets['geo'] = geo
+        targets['lat'] = coords['lat'] if coords is not None else np.nan
+        targets['lon'] = coords['lon'] if coords is not None else np.nan
+        return header.tobytes() + targets.tobytes()
+
+    def publish(self, frame: int, time: float, centroids: Detections, coords: dict = None):
+        """Publish one frame's record, see encode()"""
+        record = self.encode(frame, time, centroids, coords)
+        if self.sock is not None:
+            self.sock.sendto(record, self.address)
+        else:
+            self.file.write(record)
+        self.count += 1
+
+    @classmethod
+    def decode(cls, data: bytes):
+        """Decode a binary record
+
+        Returns:
+            tuple: (the HEADER_DTYPE header, the TARGET_DTYPE targets)
+        """
+        header = np.frombuffer(data, dtype=HEADER_DTYPE, count=1)[0]
+        if header['magic'] != cls.MAGIC:
+            raise Exception("Not a detection record")
+        targets = np.frombuffer(data, dtype=TARGET_DTYPE, count=int(header['count']), offset=HEADER_DTYPE.itemsize)
+        return header, targets
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        elif self.file is not None and self.file is not sys.stdout.buffer:
+            self.file.close()
+        else:
+            self.file.flush()
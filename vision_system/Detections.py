@@ -0,0 +1,115 @@
+import numpy as np
+
+# one row per detected target, 'color' is an index into Detections.colours
+DETECTION_DTYPE = np.dtype([
+    ('frame', np.int32),
+    ('x', np.int32),
+    ('y', np.int32),
+    ('w', np.int32),
+    ('h', np.int32),
+    ('A', np.int32),
+    ('color', np.uint8),
+])
+
+class Detections:
+    """Detected targets backed by a NumPy structured array (see DETECTION_DTYPE)
+
+    Columns are read with detections['x'] etc. (views, not copies), so they can be handed straight to the
+    georeferencing and tracking code. Indexing with a slice, mask or index array gives another Detections.
+    Extra fields can be added to the dtype (eg. the tracker's track IDs) as long as the DETECTION_DTYPE
+    fields are there.
+    """
+
+    array: np.ndarray = None
+    colours: tuple = ()
+
+    def __init__(self, array: np.ndarray = None, colours=()):
+        """
+        Args:
+            array (np.ndarray, optional): Structured array of the detections (Defaults to no detections)
+            colours (tuple, optional): The colour names the 'color' codes index into
+        """
+        self.array = np.empty(0, dtype=DETECTION_DTYPE) if array is None else array
+        self.colours = tuple(colours)
+
+    @classmethod
+    def from_boxes(cls, boxes, color, colours, offset=(0, 0), frame: int = 0):
+        """Create detections from bounding rectangles
+
+        Args:
+            boxes (np.ndarray): (N, 4) array of (x, y, w, h) bounding rectangles
+            color (np.ndarray): The colour code of each rectangle (or one code for all of them)
+            colours (tuple): The colour names
+            offset (tuple, optional): (x, y) added to the coordinates (Defaults to (0, 0))
+            frame (int, optional): The frame number (Defaults to 0)
+
+        Returns:
+            Detections: The detections, centred on each rectangle
+        """
+        boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        array = np.empty(len(boxes), dtype=DETECTION_DTYPE)
+        array['frame'] = frame
+        array['x'] = boxes[:, 0] + offset[0] + boxes[:, 2] // 2
+        array['y'] = boxes[:, 1] + offset[1] + boxes[:, 3] // 2
+        array['w'] = boxes[:, 2]
+        array['h'] = boxes[:, 3]
+        array['A'] = boxes[:, 2] * boxes[:, 3]
+        array['color'] = color
+        return cls(array, colours)
+
+    @classmethod
+    def concatenate(cls, detections, colours=None):
+        """Join detections into one
+
+        Args:
+            detections (list): Detections to join (all with the same dtype)
+            colours (tuple, optional): The colour names (Defaults to those of the first detections)
+
+        Returns:
+            Detections: All of the detections in order
+        """
+        detections = list(detections)
+        if colours is None:
+            colours = detections[0].colours if detections else ()
+        if not detections:
+            return cls(None, colours)
+        return cls(np.concatenate([d.array for d in detections]), colours)
+
+    def __len__(self):
+        return len(self.array)
+
+    def __iter__(self):
+        # rows are np.void records, so row['x'] works the same as it did on the old centroid dicts
+        return iter(self.array)
+
+    def __getitem__(self, key):
+        # a column or a single record
+        if isinstance(key, (str, int, np.integer)):
+            return self.array[key]
+        return Detections(self.array[key], self.colours)
+
+    def __repr__(self):
+        return f"Detections({self.to_dicts()})"
+
+    def colour_names(self):
+        """Get the colour name of every detection
+
+        Returns:
+            list: The colour names
+        """
+        return [self.colours[code] for code in self.array['color'].tolist()]
+
+    def with_frame(self, frame: int):
+        self.array['frame'] = frame
+        return self
+
+    def to_dicts(self):
+        """Convert to the old list of centroid dicts, eg. for printing or JSON
+
+        Returns:
+            list: { 'x': int, 'y': int, 'w': int, 'h': int, 'A': int, 'color': str, ... } for each detection
+        """
+        names = [name for name in self.array.dtype.names if name != 'frame']
+        columns = { name: self.array[name].tolist() for name in names }
+        columns['color'] = self.colour_names()
+        return [dict(zip(names, values)) for values in zip(*[columns[name] for name in names])]
@@ -0,0 +1,168 @@
+import os
+import re
+import json
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+class FFmpegCapture:
+    """Reads a video stream through an ffmpeg subprocess that outputs raw frames on a pipe
+
+    Unlike cv2.VideoCapture, the decoder's threads and buffering can be set, and frames are read straight
+    from the pipe into preallocated NumPy buffers (readinto), so reading a frame allocates nothing. It has
+    the cv2.VideoCapture methods Video uses (isOpened, get, read, grab and release), so Video can use either.
+
+    read() without an image returns the next of pool_size buffers, so a frame is only valid until pool_size
+    more frames have been read. Video's threaded capture passes its own ring buffers instead.
+    """
+
+    # output pixel formats and their number of channels (TargetDetect needs bgr24)
+    PIXEL_FORMATS = { 'bgr24': 3, 'rgb24': 3, 'bgra': 4, 'gray': 1 }
+    # don't buffer or probe the stream before decoding, so frames come out as soon as they arrive
+    LOW_LATENCY_FLAGS = ['-fflags', 'nobuffer', '-flags', 'low_delay', '-probesize', '32', '-analyzeduration', '0']
+
+    conn: str = None
+    width: int = None
+    height: int = None
+    fps: float = 0.0
+    channels: int = 3
+    proc: subprocess.Popen = None
+    pool: list = []
+
+    def __init__(self, conn: str, threads: int = 0, low_latency: bool = False, pix_fmt: str = 'bgr24', size: tuple = None,
+                 pool_size: int = 4, ffmpeg: str = 'ffmpeg'):
+        """
+        Args:
+            conn (str): The stream URL or video file
+            threads (int, optional): Decoder threads (Defaults to 0, ffmpeg chooses)
+            low_latency (bool, optional): Decode without buffering (see LOW_LATENCY_FLAGS) (Defaults to False)
+            pix_fmt (str, optional): The output pixel format, one of PIXEL_FORMATS (Defaults to bgr24, the same as OpenCV)
+            size (tuple, optional): (width, height) to scale the frames to (Defaults to the stream's size)
+            pool_size (int, optional): Buffers read() cycles through when it isn't given one (Defaults to 4)
+            ffmpeg (str, optional): The ffmpeg executable (Defaults to ffmpeg on the PATH)
+        """
+        if pix_fmt not in self.PIXEL_FORMATS:
+            raise Exception(f"Unsupported pixel format {pix_fmt} (expected {', '.join(self.PIXEL_FORMATS)})")
+        if shutil.which(ffmpeg) is None:
+            raise Exception(f"Could not find {ffmpeg}, install ffmpeg or use the OpenCV video backend")
+
+        self.conn = conn
+        self.ffmpeg = ffmpeg
+        self.channels = self.PIXEL_FORMATS[pix_fmt]
+        # options for opening the stream, used by the probe too so it doesn't spend seconds buffering a live stream
+        self.input_options = list(self.LOW_LATENCY_FLAGS) if low_latency else []
+
+        probed = self.probe()
+        if probed is None:
+            return
+        self.width, self.height, self.fps = probed
+        if size is not None:
+            self.width, self.height = size
+
+        cmd = [ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin'] + self.input_options
+        if threads:
+            cmd += ['-threads', str(threads)]
+        cmd += ['-i', conn, '-map', '0:v:0', '-an', '-sn']
+        if size is not None:
+            cmd += ['-s', f"{self.width}x{self.height}"]
+        cmd += ['-f', 'rawvideo', '-pix_fmt', pix_fmt, '-']
+
+        # unbuffered so frames are read from the pipe straight into the frame buffers
+        self.proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, bufsize=0)
+
+        self.pool = [np.empty(self.shape, dtype=np.uint8) for _ in range(max(1, pool_size))]
+        self.next_buffer = 0
+        self.scratch = np.empty(self.shape, dtype=np.uint8)
+
+    @property
+    def shape(self):
+        return (self.height, self.width) if self.channels == 1 else (self.height, self.width, self.channels)
+
+    def probe(self):
+        """Get the stream's size and frame rate with ffprobe (or from ffmpeg's output if there's no ffprobe)
+
+        Returns:
+            tuple: (width, height, fps), None if the stream couldn't be opened
+        """
+        ffprobe = os.path.join(os.path.dirname(self.ffmpeg), 'ffprobe') if os.path.dirname(self.ffmpeg) else 'ffprobe'
+        if shutil.which(ffprobe):
+            cmd = [ffprobe, '-v', 'error'] + self.input_options + ['-select_streams', 'v:0', '-show_entries', 'stream=width,height,avg_frame_rate', '-of', 'json', self.conn]
+            result = subprocess.run(cmd, capture_output=True, text=True)
+            streams = json.loads(result.stdout or '{}').get('streams') if result.returncode == 0 else None
+            if not streams:
+                return None
+            num, _, den = streams[0].get('avg_frame_rate', '0/1').partition('/')
+            fps = float(num) / float(den) if den and float(den) else 0.0
+            return streams[0]['width'], streams[0]['height'], fps
+
+        # ffmpeg prints the streams and exits with an error without an output
+        result = subprocess.run([self.ffmpeg, '-hide_banner', '-nostdin'] + self.input_options + ['-i', self.conn], capture_output=True, text=True)
+        match = re.search(r"Stream #\S+.*?Video: .*?, (\d{2,5})x(\d{2,5})", result.stderr)
+        if match is None:
+            return None
+        fps = re.search(r"([\d.]+) fps", match.string[match.end():].splitlines()[0])
+        return int(match.group(1)), int(match.group(2)), float(fps.group(1)) if fps else 0.0
+
+    def isOpened(self):
+        # a stream that fails after the probe ends the reads instead
+        return self.proc is not None
+
+    def get(self, prop: int):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width or 0
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height or 0
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        return 0
+
+    def readinto(self, buffer: np.ndarray):
+        # a pipe gives at most its buffer size (64KB) at a time, keep reading until the frame is complete
+        view = memoryview(buffer).cast('B')
+        filled = 0
+        while filled < len(view):
+            n = self.proc.stdout.readinto(view[filled:])
+            if not n:
+                return False
+            filled += n
+        return True
+
+    def read(self, image: np.ndarray = None):
+        """Read the next frame
+
+        Args:
+            image (np.ndarray, optional): The buffer to read into, used if it's the frame's shape and contiguous
+                                          (Defaults to the next buffer of the pool)
+
+        Returns:
+            tuple: (True, the frame) or (False, None) at the end of the stream
+        """
+        if self.proc is None:
+            return False, None
+        if image is None or image.shape != self.shape or image.dtype != np.uint8 or not image.flags.c_contiguous:
+            image = self.pool[self.next_buffer]
+            self.next_buffer = (self.next_buffer + 1) % len(self.pool)
+        if not self.readinto(image):
+            return False, None
+        return True, image
+
+    def grab(self):
+        """Skip the next frame
+
+        Returns:
+            bool: False at the end of the stream
+        """
+        return self.proc is not None and self.readinto(self.scratch)
+
+    def release(self):
+        if self.proc is None:
+            return
+        # killed rather than terminated, ffmpeg would otherwise keep trying to write the rest of the stream to
+        # the pipe (and complain when it's closed), and there's no output file for it to finish
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
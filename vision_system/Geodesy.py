@@ -0,0 +1,21 @@
+import numpy as np
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_E2 = 6.69437999014e-3
+
+def radii_of_curvature(lat):
+    """Get the WGS84 radii of curvature, for converting between degrees and metres on the local tangent plane
+
+    A degree of latitude is radians(1) * meridian metres and a degree of longitude radians(1) * normal * cos(lat) metres.
+
+    Args:
+        lat (float): Latitude (decimal degrees), or an np.ndarray of them
+
+    Returns:
+        tuple: (meridian, normal), the meridional and prime vertical radii of curvature (metres)
+    """
+    w = 1 - WGS84_E2 * np.sin(np.radians(lat))**2
+    meridian = WGS84_A * (1 - WGS84_E2) / w**1.5
+    normal = WGS84_A / np.sqrt(w)
+    return meridian, normal
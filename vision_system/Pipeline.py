@@ -0,0 +1,350 @@
+import time
+import queue
+import traceback
+import multiprocessing as mp
+from collections import deque
+from threading import Thread
+from multiprocessing import shared_memory
+
+import numpy as np
+
+class FramePool:
+    """A fixed set of frame buffers in shared memory
+
+    Stages pass frames by their slot number, so a frame is written once (eg. read straight into its slot
+    by the capture) and never pickled or copied on its way through the pipeline, even to another process.
+    Slots are handed out by acquire() and given back with release() by the last stage.
+    """
+
+    shape: tuple = None
+    count: int = 0
+    frames: np.ndarray = None
+
+    def __init__(self, shape: tuple, count: int, name: str = None):
+        """
+        Args:
+            shape (tuple): The shape of a frame, eg. (height, width, 3)
+            count (int): The number of frames
+            name (str, optional): Attach to the pool with this name (see attach()) instead of creating one (Defaults to None)
+        """
+        self.shape = tuple(shape)
+        self.count = count
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=int(np.prod(self.shape)) * count)
+        self.frames = np.ndarray((count,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+        self.free = queue.Queue()
+        if self.owner:
+            for slot in range(count):
+                self.free.put(slot)
+
+    @classmethod
+    def attach(cls, name: str, shape: tuple, count: int):
+        """Open a pool created by another process"""
+        return cls(shape, count, name)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def acquire(self, block: bool = True, timeout: float = None):
+        """Get a free slot
+
+        Returns:
+            int: The slot, None if none are free (without block, or after the timeout)
+        """
+        try:
+            return self.free.get(block, timeout)
+        except queue.Empty:
+            return None
+
+    def release(self, slot: int):
+        self.free.put(slot)
+
+    def close(self):
+        # the views have to go before the memory can be unmapped
+        self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class StageStats:
+    """Counters of a stage, in shared memory so a stage running in another process can update them"""
+
+    ITEMS, BUSY, WAITING_INPUT, WAITING_OUTPUT = range(4)
+
+    def __init__(self):
+        self.values = mp.RawArray('d', 4)
+
+    def add(self, waiting_input: float, busy: float, waiting_output: float):
+        self.values[self.ITEMS] += 1
+        self.values[self.BUSY] += busy
+        self.values[self.WAITING_INPUT] += waiting_input
+        self.values[self.WAITING_OUTPUT] += waiting_output
+
+class Stage:
+    """A pipeline stage running in a thread (for OpenCV and NumPy work, which release the GIL)
+
+    Items are dicts passed along bounded queues. work(item) returns the item for the next stage, or None to
+    drop it. A None item is the end of the stream and is passed on before the stage stops.
+    """
+
+    def __init__(self, name: str, work, inbox: queue.Queue, outbox: queue.Queue):
+        self.name = name
+        self.work = work
+        self.inbox = inbox
+        self.outbox = outbox
+        self.stats = StageStats()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, name=self.name)
+        self.thread.daemon = True # makes sure it cleans up on ctrl+c
+        self.thread.start()
+
+    def run(self):
+        while True:
+            start = time.perf_counter()
+            item = self.inbox.get()
+            received = time.perf_counter()
+            if item is None:
+                break
+
+            item = self.work(item)
+            done = time.perf_counter()
+            if item is not None:
+                # blocks while the next stage is behind, which holds up the stages before this one too
+                self.outbox.put(item)
+            self.stats.add(received - start, done - received, time.perf_counter() - done)
+
+        self.outbox.put(None)
+
+    def join(self, timeout: float = None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+class SourceStage(Stage):
+    """The first stage, work() makes the items (eg. captures a frame) and returns None at the end of the stream"""
+
+    running: bool = False
+
+    def __init__(self, name: str, work, outbox: queue.Queue):
+        super().__init__(name, work, None, outbox)
+        self.running = True
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            item = self.work()
+            done = time.perf_counter()
+            if item is None:
+                break
+            self.outbox.put(item)
+            self.stats.add(0.0, done - start, time.perf_counter() - done)
+
+        self.outbox.put(None)
+
+    def stop(self):
+        self.running = False
+
+def run_process_stage(setup, args, pool_name: str, shape: tuple, count: int, requests, results, stats: StageStats):
+    # the body of ProcessStage's process
+    pool = FramePool.attach(pool_name, shape, count)
+    try:
+        work = setup(*args)
+        while True:
+            start = time.perf_counter()
+            slot = requests.get()
+            received = time.perf_counter()
+            if slot is None:
+                break
+            result = work(pool.frames[slot])
+            done = time.perf_counter()
+            results.put(result)
+            stats.add(received - start, done - received, time.perf_counter() - done)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        results.put(None)
+        pool.close()
+
+class ProcessStage(Stage):
+    """A pipeline stage running in its own process (for Python heavy work that would hold the GIL)
+
+    Only the item's frame slot goes to the process, which reads the frame from the FramePool. work(frame)
+    returns a dict of (small, picklable) results that is merged into the item. The process handles one
+    frame at a time, so the items stay in order.
+
+    setup(*args) is called in the new process to create work(), so it has to be a module level function.
+    """
+
+    def __init__(self, name: str, setup, args: tuple, pool: FramePool, inbox: queue.Queue, outbox: queue.Queue):
+        super().__init__(name, None, inbox, outbox)
+        # spawned rather than forked, forking a process with running threads can deadlock
+        context = mp.get_context('spawn')
+        self.requests = context.Queue(maxsize=1)
+        self.results = context.Queue(maxsize=1)
+        self.pool = pool
+        self.pending = deque()
+        # the end of the stream has come in (to feed)
+        self.ended = False
+        self.process = context.Process(target=run_process_stage, name=name, daemon=True,
+                                       args=(setup, args, pool.name, pool.shape, pool.count, self.requests, self.results, self.stats))
+        self.threads = []
+
+    def start(self):
+        self.process.start()
+        self.threads = [Thread(target=self.feed, daemon=True), Thread(target=self.collect, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def feed(self):
+        while True:
+            item = self.inbox.get()
+            if item is None:
+                self.ended = True
+            else:
+                self.pending.append(item)
+            # give up if the process has died instead of waiting on it forever
+            while True:
+                try:
+                    self.requests.put(None if item is None else item['slot'], timeout=0.5)
+                    break
+                except queue.Full:
+                    if not self.process.is_alive():
+                        return
+            if item is None:
+                break
+
+    def collect(self):
+        while True:
+            # a process that died hard (eg. a segfault or killed for memory) never sends the end, so check on it
+            try:
+                result = self.results.get(timeout=0.5)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    break
+                continue
+            if result is None:
+                break
+            item = self.pending.popleft()
+            item.update(result)
+            self.outbox.put(item)
+
+        self.outbox.put(None)
+
+        # the process ended (or failed), drain anything still coming so the stages before can finish, and give
+        # back the slots of the frames it never finished since the last stage won't see them to release them
+        while not self.ended:
+            try:
+                item = self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is None:
+                if self.threads[0].is_alive():
+                    # feed is waiting for the end too
+                    self.inbox.put(None)
+                break
+            self.pool.release(item['slot'])
+        self.threads[0].join()
+        while self.pending:
+            self.pool.release(self.pending.popleft()['slot'])
+
+    def join(self, timeout: float = None):
+        for thread in self.threads:
+            thread.join(timeout)
+        self.process.join(timeout)
+
+class Pipeline:
+    """Stages connected by bounded queues, each running in its own thread or process
+
+    The stages work on different frames at the same time, so the frame rate approaches that of the slowest
+    stage instead of the sum of all of them. The queues hold at most queue_size items, so a slow stage holds
+    up the stages before it instead of frames piling up.
+
+    The last stage's items are read from results() by the caller, eg. the main thread for cv2.imshow().
+    """
+
+    stages: list = []
+
+    def __init__(self, queue_size: int = 2):
+        """
+        Args:
+            queue_size (int, optional): Items that can wait between two stages (Defaults to 2)
+        """
+        self.queue_size = queue_size
+        self.stages = []
+        self.outbox = queue.Queue(maxsize=queue_size)
+        self.start_time = None
+
+    def source(self, name: str, work):
+        """Add the first stage, see SourceStage"""
+        self.stages.append(SourceStage(name, work, self.outbox))
+        return self
+
+    def thread(self, name: str, work):
+        """Add a stage running in a thread, see Stage"""
+        inbox, self.outbox = self.outbox, queue.Queue(maxsize=self.queue_size)
+        self.stages.append(Stage(name, work, inbox, self.outbox))
+        return self
+
+    def process(self, name: str, setup, args: tuple, pool: FramePool):
+        """Add a stage running in a process, see ProcessStage"""
+        inbox, self.outbox = self.outbox, queue.Queue(maxsize=self.queue_size)
+        self.stages.append(ProcessStage(name, setup, args, pool, inbox, self.outbox))
+        return self
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        for stage in self.stages:
+            stage.start()
+
+    def results(self):
+        """Iterate over the items coming out of the last stage until the end of the stream"""
+        while True:
+            item = self.outbox.get()
+            if item is None:
+                break
+            yield item
+
+    def stop(self):
+        """Stop the source, the items in the pipeline still come out of results()"""
+        self.stages[0].stop()
+
+    def join(self, timeout: float = 5.0):
+        """Wait for the stages to finish
+
+        Args:
+            timeout (float, optional): Seconds to wait for each stage, in case a stage failed and the ones before it
+                                       are stuck on a full queue (Defaults to 5.0)
+        """
+        self.stop()
+        for stage in self.stages:
+            stage.join(timeout)
+
+    def get_stats(self):
+        """Get the utilization of each stage
+
+        Returns:
+            list: { 'stage', 'items', 'fps', 'busy', 'waiting_input', 'waiting_output' } for each stage, where busy
+                  and waiting are the fractions of the time since start() spent working and blocked on the queues
+        """
+        elapsed = time.perf_counter() - self.start_time if self.start_time else 0
+        stats = []
+        for stage in self.stages:
+            values = stage.stats.values
+            stats.append({
+                'stage': stage.name,
+                'items': int(values[StageStats.ITEMS]),
+                'fps': values[StageStats.ITEMS] / elapsed if elapsed else 0.0,
+                'busy': values[StageStats.BUSY] / elapsed if elapsed else 0.0,
+                'waiting_input': values[StageStats.WAITING_INPUT] / elapsed if elapsed else 0.0,
+                'waiting_output': values[StageStats.WAITING_OUTPUT] / elapsed if elapsed else 0.0,
+            })
+        return stats
+
+    def format_stats(self):
+        lines = [f"  {'stage':<16} {'items':>7} {'fps':>7} {'busy':>6} {'wait in':>8} {'wait out':>9}"]
+        for s in self.get_stats():
+            lines.append(f"  {s['stage']:<16} {s['items']:>7} {s['fps']:>7.1f} {s['busy']:>6.0%} {s['waiting_input']:>8.0%} {s['waiting_output']:>9.0%}")
+        return '\n'.join(lines)
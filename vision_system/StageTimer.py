@@ -0,0 +1,136 @@
+import math
+import time
+
+class StageTimer:
+    """Low overhead wall time histograms for the stages of a loop
+
+    Each stage's times go into log spaced buckets (BUCKETS_PER_DECADE per factor of 10, so percentiles are
+    within ~6%), so recording is a log10 and a list increment and memory doesn't grow with the run time.
+
+    Usage:
+        start = timer.now()
+        ...
+        start = timer.lap('blur', start)
+        ...
+        start = timer.lap('hls', start)
+        timer.tick()  # once per frame, prints a summary every summary_every seconds
+    """
+
+    BUCKETS_PER_DECADE = 20
+    # shortest time with its own bucket (seconds), anything shorter goes in the first bucket
+    MIN_TIME = 1e-7
+    DECADES = 9
+
+    histograms: dict = {}
+
+    def __init__(self, summary_every: float = 0, print_summary=print):
+        """
+        Args:
+            summary_every (float, optional): Print a summary every this many seconds (Defaults to 0, never)
+            print_summary (function, optional): What to call with the summary text (Defaults to print)
+        """
+        self.summary_every = summary_every
+        self.print_summary = print_summary
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        # stage => [count, total, min, max]
+        self.stats = {}
+        self.frames = 0
+        self.last_summary = time.perf_counter()
+
+    @staticmethod
+    def now():
+        return time.perf_counter()
+
+    def record(self, stage: str, seconds: float):
+        """Add one time to a stage's histogram
+
+        Args:
+            stage (str): The stage name, eg. 'blur' or 'contours.red'
+            seconds (float): The time it took
+        """
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = [0] * (self.DECADES * self.BUCKETS_PER_DECADE)
+            self.stats[stage] = [0, 0.0, math.inf, 0.0]
+
+        bucket = int((math.log10(seconds) - math.log10(self.MIN_TIME)) * self.BUCKETS_PER_DECADE) if seconds > self.MIN_TIME else 0
+        histogram[min(bucket, len(histogram) - 1)] += 1
+
+        stats = self.stats[stage]
+        stats[0] += 1
+        stats[1] += seconds
+        if seconds < stats[2]:
+            stats[2] = seconds
+        if seconds > stats[3]:
+            stats[3] = seconds
+
+    def lap(self, stage: str, start: float):
+        """Record the time since start for a stage
+
+        Args:
+            stage (str): The stage name
+            start (float): When the stage started (from now() or the previous lap())
+
+        Returns:
+            float: Now, ie. when the next stage starts
+        """
+        end = time.perf_counter()
+        self.record(stage, end - start)
+        return end
+
+    def tick(self):
+        """Count a frame, printing the summary if it's due"""
+        self.frames += 1
+        if self.summary_every and time.perf_counter() - self.last_summary >= self.summary_every:
+            self.last_summary = time.perf_counter()
+            self.print_summary(self.format_summary())
+
+    def percentile(self, stage: str, q: float):
+        """Estimate a percentile of a stage's times from its histogram
+
+        Args:
+            stage (str): The stage name
+            q (float): The percentile (0-100)
+
+        Returns:
+            float: The time (seconds), the geometric centre of the bucket the percentile falls in
+        """
+        histogram = self.histograms[stage]
+        count, _, low, high = self.stats[stage]
+        target = q / 100 * count
+
+        cumulative = 0
+        for bucket, n in enumerate(histogram):
+            cumulative += n
+            if cumulative >= target and n:
+                value = self.MIN_TIME * 10 ** ((bucket + 0.5) / self.BUCKETS_PER_DECADE)
+                return min(max(value, low), high)
+        return high
+
+    def summary(self):
+        """Get the statistics of every stage
+
+        Returns:
+            dict: stage => { 'count', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms' }
+        """
+        summary = {}
+        for stage, (count, total, _, high) in self.stats.items():
+            summary[stage] = {
+                'count': count,
+                'mean_ms': total / count * 1E3,
+                'p50_ms': self.percentile(stage, 50) * 1E3,
+                'p95_ms': self.percentile(stage, 95) * 1E3,
+                'p99_ms': self.percentile(stage, 99) * 1E3,
+                'max_ms': high * 1E3,
+            }
+        return summary
+
+    def format_summary(self):
+        lines = [f"Stage times over {self.frames} frames (ms):",
+                 f"  {'stage':<24} {'count':>7} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}"]
+        for stage, s in self.summary().items():
+            lines.append(f"  {stage:<24} {s['count']:>7} {s['mean_ms']:>8.3f} {s['p50_ms']:>8.3f} {s['p95_ms']:>8.3f} {s['p99_ms']:>8.3f} {s['max_ms']:>8.3f}")
+        return '\n'.join(lines)
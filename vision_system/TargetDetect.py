@@ -2,8 +2,15 @@ import cv2
 import numpy as np
 from scipy.spatial.transform import Rotation as R
 from geographiclib.geodesic import Geodesic
-from math import cos, sqrt, atan2, degrees
+from functools import lru_cache
 from typing import List, Tuple
+
+from ColourSegmenter import ColourSegmenter
+from CameraModel import CameraModel
+from Geodesy import radii_of_curvature
+from Detections import Detections
+from StageTimer import StageTimer
+
 class TargetDetect:
     """Detects targets in a CV2 frame
 
@@ -15,10 +22,28 @@ class TargetDetect:
     # minimum pixel area to consider in targets
     MINUMUM_AREA_PX = 400
 
-    def __init__(self):
+    # full resolution pixels around each pyramid candidate, on top of one downscaled pixel
+    PYRAMID_MARGIN_PX = 4
+
+    # camera: x=width, y=height, z=into the page
+    # drone: x=out of nose, y=right wing, z=out of belly
+    CAMERA_TO_DRONE = R.from_euler('xyz', [0, 0, 90], degrees=True).as_matrix()
+
+    def __init__(self, downscale: int = 1, camera: CameraModel = None, timer: StageTimer = None):
+        """
+        Args:
+            downscale (int, optional): Find candidates on a frame this many times smaller and only process small
+                                       full resolution regions around them (Defaults to 1, the whole frame at full resolution)
+            camera (CameraModel, optional): The camera's intrinsics and distortion for georeferencing
+                                            (Defaults to a pinhole camera with a focal length of FOCAL_LENGTH_MM pixels)
+            timer (StageTimer, optional): Time each stage of detection, eg. to find what's slow on the flight computer
+                                          (Defaults to None, no timing)
+        """
         # TODO: we'll probably want to accept some parameters here rather than hardcoding things
         #       eg. the colours to use, the minimum allowable area, etc.
-        
+        self.downscale = max(1, int(downscale))
+        self.camera = camera if camera is not None else CameraModel(self.FOCAL_LENGTH_MM, self.FOCAL_LENGTH_MM)
+
         self.colour_ranges = {
             "red": [
                 [(0,50,50),(10,255,255)],
@@ -37,7 +62,14 @@ class TargetDetect:
                 [(260, 50, 50), (280, 255,255)]
             ]
         }
-        
+
+        # compiled lookup tables for all of the colour ranges above
+        self.segmenter = ColourSegmenter(self.colour_ranges)
+        # the detections store colours as their index in segmenter.colours
+        self.colour_codes = { colour: code for code, colour in enumerate(self.segmenter.colours) }
+
+        self.timer = timer
+        self.segmenter.timer = timer
 
     @staticmethod
     def clampZero(x, thresh=0.001):
@@ -47,24 +79,95 @@ class TargetDetect:
             of the number causes other issues (eg. with atan2)
 
         Args:
-            x (float): The value to clamp
+            x (float): The value to clamp (or an np.ndarray of values)
             thresh (float, optional): _description_. The threshold to use (Defaults to 0.001)
 
         Returns:
             float: x if abs(x) > thresh, otherwise return zero
         """
-        if abs(x) > thresh:
+        if np.ndim(x):
+            return np.where(np.abs(x) < thresh, 0.0, x)
+        if abs(x) < thresh:
             x = 0
         return x
 
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def camera2world_matrix(vec_hdg: float, vec_pitch: float, vec_roll: float):
+        """Get the rotation from camera space to the world frame for one vehicle attitude
+
+        Cached since every target in a frame (and every frame until the next ATTITUDE message) shares the same attitude.
+
+        Args:
+            vec_hdg (float): The vehicle's heading (degrees)
+            vec_pitch (float): The vehicle's pitch (degrees)
+            vec_roll (float): The vehicle's roll (degrees)
+
+        Returns:
+            np.ndarray: 3x3 rotation matrix
+        """
+        drone_to_world = TargetDetect.euler2matrix(vec_hdg, vec_pitch, vec_roll)
+        matrix = drone_to_world @ TargetDetect.CAMERA_TO_DRONE
+        matrix.flags.writeable = False
+        return matrix
+
+    @staticmethod
+    def euler2matrix(yaw_deg, pitch_deg, roll_deg):
+        """Rotation matrices from the drone to the world (north, east, down) frame for heading, pitch and roll
+
+        Rz(yaw) @ Ry(pitch) @ Rx(roll), so the heading turns about the down axis, the same as
+        R.from_euler('ZYX', [yaw, pitch, roll], degrees=True).as_matrix(). Written out since scipy's
+        Rotation is ~50 times slower for large arrays of angles.
+
+        Args:
+            yaw_deg, pitch_deg, roll_deg: Angles (degrees), floats or arrays of the same shape
+
+        Returns:
+            np.ndarray: (..., 3, 3) rotation matrices
+        """
+        a, b, c = np.radians(roll_deg), np.radians(pitch_deg), np.radians(yaw_deg)
+        sa, ca, sb, cb, sc, cc = np.sin(a), np.cos(a), np.sin(b), np.cos(b), np.sin(c), np.cos(c)
+        return np.stack([
+            np.stack([cc*cb, cc*sb*sa - sc*ca, cc*sb*ca + sc*sa], axis=-1),
+            np.stack([sc*cb, sc*sb*sa + cc*ca, sc*sb*ca - cc*sa], axis=-1),
+            np.stack([-sb, cb*sa, cb*ca], axis=-1),
+        ], axis=-2)
+
+    @staticmethod
+    def merge_boxes(boxes: list):
+        """Merge overlapping boxes into their bounding boxes
+
+        Args:
+            boxes (list): [x0, y0, x1, y1, ...] boxes, anything after the coordinates is kept in a list of members
+
+        Returns:
+            list: [x0, y0, x1, y1, members] boxes that don't overlap, where members are the input boxes merged into each
+        """
+        merged = [[*box[:4], [box]] for box in boxes]
+        changed = True
+        while changed:
+            changed = False
+            for i in range(len(merged)):
+                for j in range(len(merged)-1, i, -1):
+                    a, b = merged[i], merged[j]
+                    if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                        merged[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]), a[4] + b[4]]
+                        del merged[j]
+                        changed = True
+        return merged
+
     def detect_color(self, frame: cv2.typing.MatLike, hls: cv2.typing.MatLike, ranges: List[List[Tuple]], color: str):
-        """_summary_
+        """Find the blobs of one colour with a mask per range (the reference for find_centroids())
 
         Args:
             frame (cv2.typing.MatLike): cv2 frame to process
             hls (cv2.typing.MatLike): frame converted to hls
             ranges (List[List[Tuple]]): lower and upper bounds for colors in hls
         """
+        timer = self.timer
+        if timer:
+            start = timer.now()
+
         # create masks for list of upper and lower bounds
         masks = []
         for range in ranges:
@@ -78,9 +181,13 @@ class TargetDetect:
 
         pixels = cv2.bitwise_and(frame, frame, mask=mask)
         gray = cv2.cvtColor(pixels, cv2.COLOR_BGR2GRAY)
+        if timer:
+            start = timer.lap('mask.' + color, start)
 
         cnts = cv2.findContours(gray, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         cnts = cnts[0] if len(cnts) == 2 else cnts[1] # if an older verison of findContours()
+        if timer:
+            start = timer.lap('contours.' + color, start)
 
         centroids = []
         for c in cnts:
@@ -95,47 +202,188 @@ class TargetDetect:
             centre = { 'x': int(x+w/2), 'y': int(y+h/2), 'w': w, 'h': h, 'A': A, "color": color}
             centroids.append(centre)  
 
+        if timer:
+            timer.lap('filter.' + color, start)
         return centroids
-      
+
+    def find_centroids(self, labels: np.ndarray, offset: Tuple[int, int] = (0, 0), cut_edges: Tuple[bool, bool, bool, bool] = None):
+        """Find the blobs of every colour in a label image
+
+        Args:
+            labels (np.ndarray): Label image from ColourSegmenter.labels()
+            offset (Tuple[int, int], optional): (x, y) added to the coordinates, eg. when labels is a crop of the frame
+            cut_edges (Tuple[bool, bool, bool, bool], optional): Which of the (left, top, right, bottom) edges of labels cut
+                                                                 through the frame, blobs touching them are skipped
+
+        Returns:
+            Detections: The centroids, see detect()
+        """
+        height, width = labels.shape[:2]
+        left, top, right, bottom = cut_edges or (False, False, False, False)
+
+        found = self.segmenter.bounding_boxes(labels)
+        if not found:
+            return Detections(None, self.segmenter.colours)
+
+        timer = self.timer
+        if timer:
+            start = timer.now()
+
+        boxes = np.array([box for _, colour_boxes in found for box in colour_boxes], dtype=np.int32).reshape(-1, 4)
+        codes = np.repeat([self.colour_codes[color] for color, _ in found], [len(colour_boxes) for _, colour_boxes in found])
+        x, y, w, h = boxes.T
+
+
+        # skip centroids with an area below this value (might be a false positive)
+        keep = w*h >= self.MINUMUM_AREA_PX
+
+        # skip blobs that might carry on outside of labels
+        if left:
+            keep &= x != 0
+        if top:
+            keep &= y != 0
+        if right:
+            keep &= x+w != width
+        if bottom:
+            keep &= y+h != height
+
+        centroids = Detections.from_boxes(boxes[keep], codes[keep], self.segmenter.colours, offset)
+        if timer:
+            timer.lap('filter', start)
+        return centroids
+
     def detect(self, frame):
-        """_summary_
+        """Find the centroids of the coloured targets in a frame
 
         Args:
-            frame (cv2.frame): The CV2 frame to process 
-
-        Returns: A tuple where the first element is a list of centroids
-                    Each centroid is a dict => { 'x': int, 'y': int, 'w': int, 'h': int, A: float }
-                 The second tuple is a dict with addtional information
-                 'blurred' => the blurred cv2.frame
-                 'masked' => the array of masked colours
-                 'contours' => the contours from cv2.findContours
-            tuple: (list(centroids), additional)
+            frame (cv2.frame): The CV2 frame to process
+
+        Returns:
+            Detections: One row per centroid => { 'x': int, 'y': int, 'w': int, 'h': int, 'A': int, 'color': int }
+                        where x, y is the centre of the bounding box and color indexes self.segmenter.colours
         """
-        '''
-        Find centroids in a give CV2 frame
+        timer = self.timer
+        if timer:
+            start = stage = timer.now()
+
+        if self.downscale > 1:
+            centroids = self.detect_pyramid(frame)
+        else:
+            # blur to remove high frequency noise
+            blurred = cv2.GaussianBlur(frame,(3,3),0)
+            if timer:
+                stage = timer.lap('blur', stage)
+
+            # convert to hls to make it easier to mask colours
+            hls = cv2.cvtColor(blurred, cv2.COLOR_BGR2HLS)
+            if timer:
+                stage = timer.lap('hls', stage)
+
+            # label every colour at once and find all of their blobs
+            labels = self.segmenter.labels(hls)
+            if timer:
+                timer.lap('mask', stage)
+            centroids = self.find_centroids(labels)
+
+        if timer:
+            timer.lap('total', start)
+        return centroids
 
-        :param frame: The CV2 frame to process
-        '''
-        # blur to remove high frequency noise
-        blurred = cv2.GaussianBlur(frame,(3,3),0)
+    def detect_pyramid(self, frame):
+        """Find centroids coarse to fine: candidates on a downscaled frame, refined at full resolution
 
-        # convert to hls to make it easier to mask colours
-        hls = cv2.cvtColor(blurred, cv2.COLOR_BGR2HLS)
+        Only the regions around the candidates are blurred, converted and segmented at full resolution, so
+        the result is the same as detecting on the whole frame (apart from targets too thin to survive the
+        downscale) for a fraction of the cost.
 
-        centroids = []
-        for colour, color_range in self.colour_ranges.items():
-            _centroids = self.detect_color(blurred, hls, color_range, colour)
-            centroids.extend(_centroids)
+        Args:
+            frame (cv2.frame): The CV2 frame to process
 
-        # return the centroids along with other info that might be useful for debugging
-        return centroids
+        Returns:
+            Detections: The centroids, see detect()
+        """
+        timer = self.timer
+        if timer:
+            start = timer.now()
+
+        height, width = frame.shape[:2]
+        small_width, small_height = max(1, width // self.downscale), max(1, height // self.downscale)
+        scale_x, scale_y = width / small_width, height / small_height
+
+        # area averaging already smooths out the noise the full resolution blur is there for. Halving is a fast
+        # path for INTER_AREA, so halve as far as possible first (eg. 4K / 4 is 3 times faster as two halvings)
+        small = frame
+        while small.shape[1] // 2 >= small_width and small.shape[0] // 2 >= small_height:
+            small = cv2.resize(small, (small.shape[1] // 2, small.shape[0] // 2), interpolation=cv2.INTER_AREA)
+        if small.shape[:2] != (small_height, small_width):
+            small = cv2.resize(small, (small_width, small_height), interpolation=cv2.INTER_AREA)
+        labels = self.segmenter.labels(cv2.cvtColor(small, cv2.COLOR_BGR2HLS))
+        if timer:
+            start = timer.lap('downscale', start)
+
+        # candidates in full resolution coordinates, with a lower area threshold since edge pixels blend into the background
+        min_area = self.MINUMUM_AREA_PX / (2 * scale_x * scale_y)
+        margin_x = int(np.ceil(scale_x)) + self.PYRAMID_MARGIN_PX
+        margin_y = int(np.ceil(scale_y)) + self.PYRAMID_MARGIN_PX
+        candidates = []
+        for color, boxes in self.segmenter.bounding_boxes(labels):
+            for x, y, w, h in boxes:
+                if(w*h < min_area):
+                    continue
+                x0, y0 = int(x*scale_x), int(y*scale_y)
+                x1, y1 = int(np.ceil((x+w)*scale_x)), int(np.ceil((y+h)*scale_y))
+                candidates.append((x0-margin_x, y0-margin_y, x1+margin_x, y1+margin_y))
+        if timer:
+            timer.lap('candidates', start)
+
+        return self.detect_regions(frame, candidates)
+
+    def detect_regions(self, frame, regions: list):
+        """Find centroids inside regions of a frame at full resolution
+
+        Overlapping regions are merged first. Blobs cut off by a region's edges (other than the edges of the
+        frame) are skipped since they carry on outside of it.
+
+        Args:
+            frame (cv2.frame): The CV2 frame to process
+            regions (list): (x0, y0, x1, y1) pixel boxes to search
+
+        Returns:
+            Detections: The centroids, see detect()
+        """
+        height, width = frame.shape[:2]
+        regions = [(max(0, int(x0)), max(0, int(y0)), min(width, int(x1)), min(height, int(y1))) for x0, y0, x1, y1 in regions]
+        regions = [box for box in regions if box[0] < box[2] and box[1] < box[3]]
+
+        timer = self.timer
+        found = []
+        for x0, y0, x1, y1, _ in self.merge_boxes(regions):
+            if timer:
+                stage = timer.now()
+            # one extra pixel so the blur sees the same neighbours it would on the whole frame
+            px0, py0, px1, py1 = max(0, x0-1), max(0, y0-1), min(width, x1+1), min(height, y1+1)
+            blurred = cv2.GaussianBlur(frame[py0:py1, px0:px1], (3,3), 0)
+            if timer:
+                stage = timer.lap('region.blur', stage)
+            hls = cv2.cvtColor(blurred[y0-py0:y1-py0, x0-px0:x1-px0], cv2.COLOR_BGR2HLS)
+            if timer:
+                stage = timer.lap('region.hls', stage)
+            labels = self.segmenter.labels(hls)
+            if timer:
+                timer.lap('region.mask', stage)
+
+            # the regions don't overlap, so a blob is found in one region or is cut off by its edges
+            cut_edges = (x0 > 0, y0 > 0, x1 < width, y1 < height)
+            found.append(self.find_centroids(labels, offset=(x0, y0), cut_edges=cut_edges))
+
+        return Detections.concatenate(found, self.segmenter.colours)
 
     def pixels2camera(self, x: int, y: int, camera_origin):
         """Convert pixel coordinates to camera space
 
         Args:
-            x (int): pixel's x value
-            y (int): pixel's y value
+            x (int): pixel's x value (or an np.ndarray of them)
+            y (int): pixel's y value (or an np.ndarray of them)
             camera_origin (_type_): The camera rotation matrix
 
         Returns:
@@ -147,7 +395,7 @@ class TargetDetect:
         # we need to clamp -0.0 to +0.0 since atan2 treats the two differently
         x = TargetDetect.clampZero((x-camera_origin[0])/(self.FOCAL_LENGTH_MM))
         y = TargetDetect.clampZero((y-camera_origin[1])/(self.FOCAL_LENGTH_MM))
-        z = 1
+        z = np.ones_like(x) if np.ndim(x) else 1
         return (x, y, z)
     
     # TODO: create a dataclass to hold (x,y,img_width,img_height) and (vec_alt, vec_lat, vec_lon, vec_hdg, vec_pitch, vec_roll)
@@ -160,7 +408,7 @@ class TargetDetect:
             y (int): The y pixel coordinate
             img_width (int): The width of the image (pixels)
             img_height (int): The height of the image (pixels)
-            vec_alt (float): The vehicle's altitude (degrees)
+            vec_alt (float): The vehicle's altitude (metres)
             vec_lat (float): The vehicle's latitude (decimal degrees)
             vec_lon (float): The vehicle's longitude (decimal degrees)
             vec_hdg (float): The vehicle's heading (degrees)
@@ -170,37 +418,92 @@ class TargetDetect:
         Returns:
             dict: the estimated lat and lon of the target (keys: lat, lon)
         """
-        # camera origin is the centre of the image
-        camera_origin = (int(img_width/2), int(img_height/2))
+        coords = self.pixels2coords_batch([x], [y], img_width, img_height, vec_alt, vec_lat, vec_lon, vec_hdg, vec_pitch, vec_roll)
 
-        # calculate transform from drone to world using yaw, pitch, roll
-        # TODO: incorporate pitch and roll
-        drone_to_world = R.from_euler('xyz', [vec_hdg, vec_pitch, vec_roll], degrees=True)
+        # TODO: save to file
+
+        return { 'lat': float(coords['lat'][0]), 'lon': float(coords['lon'][0]) }
+
+    def pixels2coords_batch(self, x, y, img_width: int, img_height: int, vec_alt, vec_lat, vec_lon, vec_hdg, vec_pitch, vec_roll, enu: bool = False) -> dict:
+        """Convert arrays of pixel coordinates to GPS coordinates
+
+        The vehicle arguments are either one pose shared by every pixel (eg. all of the targets in a frame) or arrays
+        with a pose per pixel (eg. a whole flight's detections). All of the pixels are rotated to the world frame
+        with one matrix multiply.
+
+        Args:
+            x (np.ndarray): The x pixel coordinates
+            y (np.ndarray): The y pixel coordinates
+            img_width (int): The width of the image (pixels)
+            img_height (int): The height of the image (pixels)
+            vec_alt, vec_lat, vec_lon, vec_hdg, vec_pitch, vec_roll: See pixels2coords(), floats or arrays the same length as x
+            enu (bool, optional): Shift the vehicle position in a local tangent plane instead of along the WGS84 geodesic.
+                                  Vectorized, and within a centimetre of the geodesic for targets up to 300 m away
+                                  (Defaults to False)
 
-        # point in camera reference frame
-        point_camera = self.pixels2camera(x, y, camera_origin)
+        Returns:
+            dict: arrays of the estimated 'lat' and 'lon' of each target, along with the 'azimuth' and 'elevation' (degrees)
+                  and horizontal 'distance' (metres) from the vehicle, and whether the pixel's ray meets the ground ('valid',
+                  the lat, lon and distance of the others are NaN)
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        y = np.asarray(y, dtype=np.float64).ravel()
+
+        # point in camera reference frame, looked up in the camera's ray table
+        point_camera = self.camera.pixels2rays(x, y, img_width, img_height)
 
-        # point in drone reference frame
-        point_drone = self.camera_to_drone.apply(point_camera)
-        point_drone = [TargetDetect.clamp_zero(x) for x in point_drone]
-        
         # point in world (inertial) reference frame
-        point_world = drone_to_world.apply(point_drone)
-        point_world = [TargetDetect.clamp_zero(x) for x in point_world]
+        attitude = np.broadcast_arrays(np.asarray(vec_hdg, dtype=np.float64), np.asarray(vec_pitch, dtype=np.float64), np.asarray(vec_roll, dtype=np.float64))
+        if attitude[0].ndim == 0:
+            point_world = point_camera @ self.camera2world_matrix(float(vec_hdg), float(vec_pitch), float(vec_roll)).T
+        else:
+            camera_to_world = self.euler2matrix(*[a.ravel() for a in attitude]) @ self.CAMERA_TO_DRONE
+            point_world = np.einsum('nij,nj->ni', camera_to_world, point_camera)
+        # we need to clamp -0.0 to +0.0 since atan2 treats the two differently
+        point_world[np.abs(point_world) < 0.001] = 0
 
         # calculate angles using trig
-        azimuth = atan2(point_world[1], point_world[0])
-        elevation = atan2(-point_world[2], sqrt(point_world[0]**2 + point_world[1]**2))
-
-        # calculate distance to target with more trif
-        distance = vec_alt/cos(elevation)
+        azimuth = np.arctan2(point_world[:, 1], point_world[:, 0])
+        horizontal = np.hypot(point_world[:, 0], point_world[:, 1])
+        elevation = np.arctan2(-point_world[:, 2], horizontal)
+
+        # the ray meets the ground alt*tan(off-nadir angle) away, straight down is no offset at all and rays
+        # at or above the horizon never meet it
+        down = point_world[:, 2]
+        valid = down > 0
+        vec_alt = np.broadcast_to(np.asarray(vec_alt, dtype=np.float64), azimuth.shape)
+        distance = np.full(azimuth.shape, np.nan)
+        distance[valid] = vec_alt[valid] * horizontal[valid] / down[valid]
 
         # shift the vehicle lat, lon by the distance in the direction of azimuth
-        geod = Geodesic.WSG84
-        shift = geod.Direct(vec_lat, vec_lon, degrees(azimuth), distance)
+        vec_lat, vec_lon = np.broadcast_arrays(np.asarray(vec_lat, dtype=np.float64), np.asarray(vec_lon, dtype=np.float64), azimuth)[:2]
+        lat = np.full(azimuth.shape, np.nan)
+        lon = np.full(azimuth.shape, np.nan)
+        if enu:
+            lat[valid], lon[valid] = self.enu_shift(vec_lat[valid], vec_lon[valid], distance[valid]*np.cos(azimuth[valid]), distance[valid]*np.sin(azimuth[valid]))
+        else:
+            geod = Geodesic.WGS84
+            for i in np.flatnonzero(valid).tolist():
+                shift = geod.Direct(float(vec_lat[i]), float(vec_lon[i]), float(np.degrees(azimuth[i])), float(distance[i]), Geodesic.LATITUDE | Geodesic.LONGITUDE)
+                lat[i], lon[i] = shift['lat2'], shift['lon2']
+
+        return { 'lat': lat, 'lon': lon, 'azimuth': np.degrees(azimuth), 'elevation': np.degrees(elevation), 'distance': distance, 'valid': valid }
 
-        # TODO: save to file
+    @staticmethod
+    def enu_shift(lat, lon, north, east):
+        """Shift positions by a distance north and east in the local tangent plane
 
-        return { 'lat': shift['lat2'], 'lon': shift['lon2'] }
+        Uses the WGS84 radii of curvature at each starting latitude. The error grows with the square of the
+        distance: about 1 mm at 100 m and 8 mm at 300 m from the vehicle.
 
-            
\ No newline at end of file
+        Args:
+            lat (np.ndarray): Starting latitudes (decimal degrees)
+            lon (np.ndarray): Starting longitudes (decimal degrees)
+            north (np.ndarray): Distances north (metres)
+            east (np.ndarray): Distances east (metres)
+
+        Returns:
+            tuple: (lat, lon) arrays of the shifted positions (decimal degrees)
+        """
+        meridian, normal = radii_of_curvature(lat)
+        return lat + np.degrees(north / meridian), lon + np.degrees(east / (normal * np.cos(np.radians(lat))))
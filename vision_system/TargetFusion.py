@@ -0,0 +1,213 @@
+import math
+
+import numpy as np
+
+from Geodesy import radii_of_curvature
+
+class TargetCluster:
+    """The fused location of one target from all of the estimates merged into it
+
+    The position is tracked in metres north and east of TargetFusion's origin, with a running weighted
+    mean and covariance (West's incremental algorithm), so adding an estimate doesn't revisit the old ones.
+    """
+
+    id: int = 0
+    colour: str = None
+    count: int = 0
+    weight: float = 0.0
+    # (north, east) metres from the fusion's origin
+    mean: np.ndarray = None
+    # weighted sum of squared deviations, the covariance is scatter / weight
+    scatter: np.ndarray = None
+    lat: float = None
+    lon: float = None
+
+    def __init__(self, id: int, north: float, east: float, weight: float, colour: str = None):
+        self.id = id
+        self.colour = colour
+        self.count = 1
+        self.weight = weight
+        self.mean = np.array([north, east], dtype=np.float64)
+        self.scatter = np.zeros((2, 2), dtype=np.float64)
+
+    def add(self, north: float, east: float, weight: float):
+        self.count += 1
+        self.weight += weight
+        delta_n, delta_e = north - self.mean[0], east - self.mean[1]
+        self.mean[0] += weight / self.weight * delta_n
+        self.mean[1] += weight / self.weight * delta_e
+        after_n, after_e = north - self.mean[0], east - self.mean[1]
+        self.scatter[0, 0] += weight * delta_n * after_n
+        self.scatter[0, 1] += weight * delta_n * after_e
+        self.scatter[1, 0] += weight * delta_e * after_n
+        self.scatter[1, 1] += weight * delta_e * after_e
+
+    def merge(self, other):
+        """Absorb another cluster's estimates (the pairwise update of Chan et al. for the mean and scatter)"""
+        weight = self.weight + other.weight
+        delta = other.mean - self.mean
+        self.scatter += other.scatter + np.outer(delta, delta) * self.weight * other.weight / weight
+        self.mean += delta * other.weight / weight
+        self.weight = weight
+        self.count += other.count
+
+    @property
+    def covariance(self):
+        """The weighted covariance of the estimates (north, east in m^2)"""
+        return self.scatter / self.weight
+
+    @property
+    def sigma(self):
+        """The standard deviation of the estimates along their worst axis (metres)"""
+        return float(np.sqrt(max(np.linalg.eigvalsh(self.covariance)[-1], 0)))
+
+    def to_dict(self):
+        return { 'id': self.id, 'lat': self.lat, 'lon': self.lon, 'colour': self.colour, 'count': self.count,
+                 'weight': self.weight, 'sigma': self.sigma }
+
+class TargetFusion:
+    """Merges target location estimates into clusters, one per real target
+
+    Estimates are converted to metres on a local tangent plane around the first one and clusters are
+    indexed in a grid of radius sized cells, so an estimate only has to be compared with the clusters in
+    the 3x3 cells around it. Adding an estimate is O(1) expected time however many have been added.
+
+    An estimate joins the nearest cluster of the same colour whose mean is within radius metres, otherwise
+    it starts a new cluster. When that moves the cluster's mean within radius of another cluster of the same
+    colour (eg. one target first seen as two from noisy estimates), the two are merged into the older one.
+    """
+
+    clusters: list = []
+    grid: dict = {}
+
+    def __init__(self, radius: float = 2.0):
+        """
+        Args:
+            radius (float, optional): The furthest an estimate can be from a cluster's mean to be merged into it (metres, Defaults to 2.0)
+        """
+        self.radius = radius
+        self.clusters = []
+        # (row, column) => clusters whose mean is in that cell
+        self.grid = {}
+        self.origin = None
+        self.next_id = 1
+
+    def to_local(self, lat: float, lon: float):
+        """Get the metres north and east of the origin (set by the first estimate)
+
+        Returns:
+            tuple: (north, east) in metres
+        """
+        if self.origin is None:
+            meridian, normal = radii_of_curvature(lat)
+            self.origin = (lat, lon, math.radians(1) * float(meridian), math.radians(1) * float(normal) * math.cos(math.radians(lat)))
+
+        lat0, lon0, metres_per_lat, metres_per_lon = self.origin
+        return (lat - lat0) * metres_per_lat, (lon - lon0) * metres_per_lon
+
+    def to_global(self, north: float, east: float):
+        lat0, lon0, metres_per_lat, metres_per_lon = self.origin
+        return lat0 + float(north) / metres_per_lat, lon0 + float(east) / metres_per_lon
+
+    def cell(self, north: float, east: float):
+        return (math.floor(north / self.radius), math.floor(east / self.radius))
+
+    def add(self, lat: float, lon: float, weight: float = 1.0, colour: str = None):
+        """Merge a location estimate into the clusters
+
+        Args:
+            lat (float): Latitude of the estimate (degrees)
+            lon (float): Longitude of the estimate (degrees)
+            weight (float, optional): How much to trust the estimate, eg. 1/distance^2 (Defaults to 1.0)
+            colour (str, optional): The target's colour, only estimates of the same colour are merged (Defaults to None)
+
+        Returns:
+            tuple: (the cluster it was merged into, True if it's a new cluster)
+        """
+        north, east = self.to_local(lat, lon)
+
+        best = self.nearest(north, east, colour)
+        if best is None:
+            best = TargetCluster(self.next_id, north, east, weight, colour)
+            best.lat, best.lon = lat, lon
+            self.next_id += 1
+            self.clusters.append(best)
+            self.place(best)
+            return best, True
+
+        self.unplace(best)
+        best.add(north, east, weight)
+
+        # the mean moved, it may now be close enough to another cluster to be the same target
+        while True:
+            other = self.nearest(*best.mean, colour)
+            if other is None:
+                break
+            self.unplace(other)
+            keep, gone = (best, other) if best.id < other.id else (other, best)
+            keep.merge(gone)
+            self.clusters.remove(gone)
+            best = keep
+
+        best.lat, best.lon = self.to_global(*best.mean)
+        self.place(best)
+        return best, False
+
+    def nearest(self, north: float, east: float, colour: str):
+        # the nearest cluster in the grid of the colour within radius, None if there isn't one
+        row, column = self.cell(north, east)
+        best = None
+        best_distance = self.radius**2
+        for r in (row - 1, row, row + 1):
+            for c in (column - 1, column, column + 1):
+                for cluster in self.grid.get((r, c), ()):
+                    if cluster.colour != colour:
+                        continue
+                    distance = (cluster.mean[0] - north)**2 + (cluster.mean[1] - east)**2
+                    if distance <= best_distance:
+                        best, best_distance = cluster, distance
+        return best
+
+    def place(self, cluster: TargetCluster):
+        self.grid.setdefault(self.cell(*cluster.mean), []).append(cluster)
+
+    def unplace(self, cluster: TargetCluster):
+        key = self.cell(*cluster.mean)
+        self.grid[key].remove(cluster)
+        if not self.grid[key]:
+            del self.grid[key]
+
+    def add_batch(self, lat, lon, weights=None, colours=None):
+        """Merge many estimates, eg. the results of TargetDetect.pixels2coords_batch()
+
+        Args:
+            lat (np.ndarray): Latitudes (degrees)
+            lon (np.ndarray): Longitudes (degrees)
+            weights (np.ndarray, optional): See add() (Defaults to 1.0 for all)
+            colours (list, optional): See add() (Defaults to None for all)
+
+        Returns:
+            list: (cluster, new) for each estimate, see add()
+        """
+        lat = np.asarray(lat, dtype=np.float64).ravel().tolist()
+        lon = np.asarray(lon, dtype=np.float64).ravel().tolist()
+        weights = [1.0] * len(lat) if weights is None else np.broadcast_to(weights, len(lat)).tolist()
+        colours = [None] * len(lat) if colours is None else list(colours)
+        return [self.add(*estimate) for estimate in zip(lat, lon, weights, colours)]
+
+    def ranked(self, min_count: int = 1):
+        """Get the clusters, most supported first
+
+        Clusters are ranked by their total weight. Ties keep the order the clusters were found in, so the
+        order only changes when the evidence does.
+
+        Args:
+            min_count (int, optional): Leave out clusters with fewer estimates, eg. one off false detections (Defaults to 1)
+
+        Returns:
+            list: The TargetClusters
+        """
+        return sorted((cluster for cluster in self.clusters if cluster.count >= min_count), key=lambda cluster: (-cluster.weight, cluster.id))
+
+    def __len__(self):
+        return len(self.clusters)
@@ -0,0 +1,207 @@
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from TargetDetect import TargetDetect
+from Detections import Detections, DETECTION_DTYPE
+
+# the detection of each confirmed track, with its ID, velocity (pixels/frame) and number of detections
+TRACK_DTYPE = np.dtype(DETECTION_DTYPE.descr + [('id', np.int32), ('vx', np.float32), ('vy', np.float32), ('hits', np.int32)])
+
+class Track:
+    """One tracked target with a constant velocity Kalman filter over its pixel position
+
+    The state is [x, y, vx, vy] in pixels and pixels per frame.
+    """
+
+    # state transition for one frame
+    F = np.array([[1, 0, 1, 0],
+                  [0, 1, 0, 1],
+                  [0, 0, 1, 0],
+                  [0, 0, 0, 1]], dtype=np.float64)
+    # only the position is measured
+    H = np.array([[1, 0, 0, 0],
+                  [0, 1, 0, 0]], dtype=np.float64)
+
+    id: int = 0
+    state: np.ndarray = None
+    covariance: np.ndarray = None
+    # the latest detection (a DETECTION_DTYPE record)
+    centroid: np.void = None
+    hits: int = 0
+    misses: int = 0
+    age: int = 0
+
+    def __init__(self, id: int, centroid: np.void, process_noise: float, measurement_noise: float):
+        """
+        Args:
+            id (int): The track ID
+            centroid (np.void): The detection that starts the track, a row of TargetDetect.detect()
+            process_noise (float): Standard deviation of the unmodelled acceleration (pixels/frame^2)
+            measurement_noise (float): Standard deviation of the detected position (pixels)
+        """
+        self.id = id
+        self.state = np.array([centroid['x'], centroid['y'], 0, 0], dtype=np.float64)
+        # the velocity is unknown until the second detection
+        self.covariance = np.diag([measurement_noise**2, measurement_noise**2, 100.0, 100.0])
+        self.centroid = centroid
+        self.hits = 1
+        self.misses = 0
+        self.age = 1
+
+        # discrete white noise acceleration model
+        G = np.array([[0.5, 0], [0, 0.5], [1, 0], [0, 1]])
+        self.Q = G @ G.T * process_noise**2
+        self.R = np.eye(2) * measurement_noise**2
+
+    @property
+    def position(self):
+        return self.state[0], self.state[1]
+
+    @property
+    def uncertainty(self):
+        """The standard deviation of the predicted position (pixels)"""
+        return float(np.sqrt(max(self.covariance[0, 0], self.covariance[1, 1])))
+
+    def predict(self):
+        self.state = self.F @ self.state
+        self.covariance = self.F @ self.covariance @ self.F.T + self.Q
+        self.age += 1
+
+    def update(self, centroid: np.void):
+        residual = np.array([centroid['x'], centroid['y']]) - self.H @ self.state
+        S = self.H @ self.covariance @ self.H.T + self.R
+        K = self.covariance @ self.H.T @ np.linalg.inv(S)
+        self.state = self.state + K @ residual
+        self.covariance = (np.eye(4) - K @ self.H) @ self.covariance
+        self.centroid = centroid
+        self.hits += 1
+        self.misses = 0
+
+class TargetTracker:
+    """Tracks targets across frames so full frame detection only runs every few frames
+
+    Each target gets a Track whose position is predicted every frame. On most frames only a search window
+    around each predicted position is processed (TargetDetect.detect_regions()), so the cost scales with the
+    number and size of the targets instead of the frame area. The whole frame is searched every full_every
+    frames to pick up new targets, and on the frame after any track is missed.
+    """
+
+    # extra pixels around a target's size to search for it, on top of its position uncertainty
+    SEARCH_MARGIN_PX = 16
+    # standard deviations of position uncertainty to add to the search window and the matching gate
+    SEARCH_SIGMAS = 3
+
+    tracks: list = []
+    frame_count: int = 0
+
+    def __init__(self, detect: TargetDetect, full_every: int = 10, max_misses: int = 5, min_hits: int = 3, process_noise: float = 2.0, measurement_noise: float = 2.0):
+        """
+        Args:
+            detect (TargetDetect): The detector to use
+            full_every (int, optional): Search the whole frame every this many frames (Defaults to 10)
+            max_misses (int, optional): Drop a track after this many frames in a row without a detection (Defaults to 5)
+            min_hits (int, optional): Only report tracks that have been detected this many times (Defaults to 3)
+            process_noise (float, optional): See Track (Defaults to 2.0)
+            measurement_noise (float, optional): See Track (Defaults to 2.0)
+        """
+        self.detect = detect
+        self.full_every = max(1, full_every)
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.process_noise = process_noise
+        self.measurement_noise = measurement_noise
+
+        self.tracks = []
+        self.next_id = 1
+        self.frame_count = 0
+        self.lost = False
+
+        # how many frames the whole frame was searched (for checking the savings)
+        self.full_detections = 0
+
+    def search_window(self, track: Track):
+        x, y = track.position
+        margin = self.SEARCH_MARGIN_PX + self.SEARCH_SIGMAS * track.uncertainty
+        half_w = track.centroid['w'] / 2 + margin
+        half_h = track.centroid['h'] / 2 + margin
+        return (int(x - half_w), int(y - half_h), int(np.ceil(x + half_w)), int(np.ceil(y + half_h)))
+
+    def match(self, detections: Detections):
+        """Assign detections to tracks, minimising the total distance to the predicted positions
+
+        A detection can only match a track of the same colour within its gate (half the target's size plus
+        the position uncertainty).
+
+        Returns:
+            tuple: (list of (track, detection index) pairs, mask of the unmatched detections)
+        """
+        unmatched = np.ones(len(detections), dtype=bool)
+        if not self.tracks or not len(detections):
+            return [], unmatched
+
+        positions = np.array([track.position for track in self.tracks])
+        points = np.stack([detections['x'], detections['y']], axis=-1).astype(np.float64)
+        cost = np.linalg.norm(positions[:, None, :] - points[None, :, :], axis=2)
+
+        gates = np.array([max(t.centroid['w'], t.centroid['h']) / 2 + self.SEARCH_SIGMAS * t.uncertainty for t in self.tracks])
+        colours = np.array([t.centroid['color'] for t in self.tracks])
+        invalid = (cost > gates[:, None]) | (colours[:, None] != detections['color'][None, :])
+
+        # large enough that an invalid pairing is never better than leaving both unmatched
+        cost[invalid] = 1e9
+        rows, cols = linear_sum_assignment(cost)
+
+        pairs = [(self.tracks[r], c) for r, c in zip(rows, cols) if not invalid[r, c]]
+        unmatched[[c for _, c in pairs]] = False
+        return pairs, unmatched
+
+    def update(self, frame):
+        """Detect and track the targets in the next frame
+
+        Args:
+            frame (cv2.frame): The CV2 frame to process
+
+        Returns:
+            Detections: The detection of each confirmed track seen in this frame (TRACK_DTYPE rows, see TargetDetect.detect()
+                        for the others), with its 'id', 'vx' and 'vy' (pixels/frame) and 'hits' (frames it has been detected in)
+        """
+        for track in self.tracks:
+            track.predict()
+
+        full = not self.tracks or self.lost or self.frame_count % self.full_every == 0
+        if full:
+            detections = self.detect.detect(frame)
+            self.full_detections += 1
+        else:
+            detections = self.detect.detect_regions(frame, [self.search_window(track) for track in self.tracks])
+        self.frame_count += 1
+
+        pairs, unmatched = self.match(detections)
+        for track, index in pairs:
+            track.update(detections[index].copy())
+
+        matched = set(id(track) for track, _ in pairs)
+        self.lost = False
+        for track in self.tracks:
+            if id(track) not in matched:
+                track.misses += 1
+                self.lost = True
+
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        for centroid in detections.array[unmatched]:
+            self.tracks.append(Track(self.next_id, centroid.copy(), self.process_noise, self.measurement_noise))
+            self.next_id += 1
+
+        confirmed = [track for track in self.tracks if track.misses == 0 and track.hits >= self.min_hits]
+        targets = np.empty(len(confirmed), dtype=TRACK_DTYPE)
+        if confirmed:
+            centroids = np.array([track.centroid for track in confirmed], dtype=DETECTION_DTYPE)
+            for name in DETECTION_DTYPE.names:
+                targets[name] = centroids[name]
+            targets['id'] = [track.id for track in confirmed]
+            targets['vx'] = [track.state[2] for track in confirmed]
+            targets['vy'] = [track.state[3] for track in confirmed]
+            targets['hits'] = [track.hits for track in confirmed]
+
+        return Detections(targets, detections.colours)
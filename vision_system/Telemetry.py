@@ -1,16 +1,20 @@
+import time
 from datetime import datetime
 from threading import Thread
 
 from pymavlink import mavutil
 
+from TelemetryHistory import TelemetryHistory
+
 class Telemetry:
     conn: str = None
     dev = None
     thread: Thread = None
     telemetry: dict = {}
     debug_print: bool = False
+    history: TelemetryHistory = None
 
-    def __init__(self, conn: str, msg_types, timeout: int = 5, conn_print: bool = True, debug_print: bool = False):
+    def __init__(self, conn: str, msg_types, timeout: int = 5, conn_print: bool = True, debug_print: bool = False, history: int = 0):
         if(conn_print):
             print(f"Connecting to {conn}")
         self.debug_print = debug_print
@@ -27,6 +31,9 @@ class Telemetry:
         # message for each message type that was requested
         self.telemetry = { msg_type.upper(): None for msg_type in msg_types }
 
+        # keep the last history messages of each type to interpolate them to when a frame was captured
+        self.history = TelemetryHistory(msg_types, history) if history > 0 else None
+
         self.thread = Thread(target=self.handle_messges)
         self.thread.daemon = True; # makes sure it cleans up on ctrl+c
         self.thread.start()
@@ -46,6 +53,8 @@ class Telemetry:
 
             # save the message 
             self.telemetry[msg_type] = msg
+            if self.history is not None:
+                self.history.add(msg, time.time())
 
     def get_msg(self, msg_type):
         if msg_type not in self.telemetry:
@@ -54,4 +63,17 @@ class Telemetry:
         
     
     def get_msgs(self):
-        return self.telemetry
\ No newline at end of file
+        return self.telemetry
+
+    def get_msgs_at(self, t: float):
+        """Get the messages interpolated to a time, eg. when a frame was captured
+
+        Args:
+            t (float): The time (time.time())
+
+        Returns:
+            dict: message type => message, the latest messages (see get_msgs()) without a history
+        """
+        if self.history is None:
+            return self.get_msgs()
+        return self.history.get_msgs_at(t)
\ No newline at end of file
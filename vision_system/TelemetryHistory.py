@@ -0,0 +1,245 @@
+import math
+from threading import Lock
+from types import SimpleNamespace
+
+import numpy as np
+
+class MessageRing:
+    """The last size messages of one type as NumPy arrays, in time order
+
+    Every sample is written twice, at i and i+size, so the newest size samples are always the contiguous slice
+    [start, start+size) and can be binary searched without copying or unwrapping the ring.
+    """
+
+    size: int = 0
+    fields: list = []
+    count: int = 0
+    start: int = 0
+
+    def __init__(self, fields: list, size: int):
+        """
+        Args:
+            fields (list): The numeric fields of the message to keep
+            size (int): The number of messages to keep
+        """
+        self.fields = list(fields)
+        self.size = size
+        self.boot_ms = np.zeros(2 * size, dtype=np.float64)
+        self.values = np.zeros((2 * size, len(self.fields)), dtype=np.float64)
+        self.count = 0
+        self.start = 0
+
+    def add(self, boot_ms: float, values: list):
+        if self.count < self.size:
+            i = self.count
+            self.count += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % self.size
+        self.boot_ms[i] = self.boot_ms[i + self.size] = boot_ms
+        self.values[i] = self.values[i + self.size] = values
+
+    def window(self):
+        """Get the samples, oldest first
+
+        Returns:
+            tuple: (boot_ms, values) views of the arrays
+        """
+        end = self.start + self.count
+        return self.boot_ms[self.start:end], self.values[self.start:end]
+
+    def clear(self):
+        self.count = 0
+        self.start = 0
+
+class TelemetryHistory:
+    """Time indexed history of telemetry messages, interpolated to any time
+
+    Each message type keeps a fixed size ring of its numeric fields keyed by time_boot_ms. A lookup is a
+    binary search (O(log n)) and an interpolation between the two messages either side of the time: positions
+    are interpolated linearly, headings the short way around, and the ATTITUDE angles with a quaternion slerp.
+
+    Times are given in the flight controller's time_boot_ms, or as local time.time() (eg. when a frame was
+    captured), which is converted using the smallest offset seen between when a message was received and its
+    time_boot_ms, ie. the message that got here the fastest.
+
+    The receiver thread can add() while other threads look up, a lock is held for the few array accesses of each.
+    """
+
+    # heading fields that wrap around (in the message's units per turn)
+    WRAPPED = {
+        ('GLOBAL_POSITION_INT', 'hdg'): 36000,
+        ('VFR_HUD', 'heading'): 360,
+    }
+    # the fields of a message type that are Euler angles (radians) to slerp
+    ATTITUDE_FIELDS = ('roll', 'pitch', 'yaw')
+
+    rings: dict = {}
+
+    def __init__(self, msg_types, size: int = 512):
+        """
+        Args:
+            msg_types (list): The message types to keep
+            size (int, optional): The number of messages of each type to keep (Defaults to 512, about 10s at 50Hz)
+        """
+        self.size = size
+        self.msg_types = set(msg_type.upper() for msg_type in msg_types)
+        self.rings = {}
+        self.lock = Lock()
+        # time.time() - time_boot_ms/1000 of the fastest message
+        self.offset = None
+        self.last_boot_ms = None
+
+    def add(self, msg, received: float):
+        """Add a message
+
+        Args:
+            msg (MAVLink_message): The message (ignored without a time_boot_ms or if its type isn't kept)
+            received (float): When it was received (time.time())
+        """
+        msg_type = msg.get_type().upper()
+        boot_ms = getattr(msg, 'time_boot_ms', None)
+        if msg_type not in self.msg_types or boot_ms is None:
+            return
+
+        with self.lock:
+            ring = self.rings.get(msg_type)
+            if ring is None:
+                fields = [name for name in msg.get_fieldnames() if name != 'time_boot_ms' and isinstance(getattr(msg, name), (int, float))]
+                ring = self.rings[msg_type] = MessageRing(fields, self.size)
+
+            if self.last_boot_ms is not None and boot_ms < self.last_boot_ms - 1000:
+                # the flight controller rebooted, the old messages are on a different clock
+                for r in self.rings.values():
+                    r.clear()
+                self.offset = None
+                self.last_boot_ms = boot_ms
+
+            boot_times, _ = ring.window()
+            if ring.count and boot_ms < boot_times[-1]:
+                # out of order, keep the ring sorted
+                return
+
+            ring.add(boot_ms, [getattr(msg, name) for name in ring.fields])
+            self.last_boot_ms = boot_ms if self.last_boot_ms is None else max(self.last_boot_ms, boot_ms)
+            offset = received - boot_ms / 1E3
+            if self.offset is None or offset < self.offset:
+                self.offset = offset
+
+    def to_boot_ms(self, t: float):
+        """Convert a time.time() to the flight controller's time_boot_ms (None before any messages)"""
+        with self.lock:
+            return None if self.offset is None else (t - self.offset) * 1E3
+
+    def at(self, msg_type: str, t: float):
+        """Get a message interpolated to a local time
+
+        Args:
+            msg_type (str): The message type
+            t (float): The time (time.time())
+
+        Returns:
+            SimpleNamespace: The message's fields (and time_boot_ms), None if there are no messages of the type
+        """
+        boot_ms = self.to_boot_ms(t)
+        return None if boot_ms is None else self.at_boot_ms(msg_type, boot_ms)
+
+    def at_boot_ms(self, msg_type: str, boot_ms: float):
+        """Get a message interpolated to a time_boot_ms
+
+        Times before the first or after the last message get that message.
+
+        Args:
+            msg_type (str): The message type
+            boot_ms (float): The time (ms since the flight controller booted)
+
+        Returns:
+            SimpleNamespace: The message's fields (and time_boot_ms), None if there are no messages of the type
+        """
+        msg_type = msg_type.upper()
+        with self.lock:
+            ring = self.rings.get(msg_type)
+            if ring is None or ring.count == 0:
+                return None
+            boot_times, values = ring.window()
+            i = int(np.searchsorted(boot_times, boot_ms))
+            if i == 0 or i == ring.count:
+                i = min(i, ring.count - 1)
+                return self.message(ring.fields, boot_times[i], values[i].tolist())
+            t0, t1 = boot_times[i-1], boot_times[i]
+            before, after = values[i-1].copy(), values[i].copy()
+
+        fraction = (boot_ms - t0) / (t1 - t0) if t1 > t0 else 0.0
+        result = before + (after - before) * fraction
+
+        for i, name in enumerate(ring.fields):
+            turn = self.WRAPPED.get((msg_type, name))
+            if turn is not None:
+                delta = (after[i] - before[i] + turn / 2) % turn - turn / 2
+                result[i] = (before[i] + delta * fraction) % turn
+
+        if all(name in ring.fields for name in self.ATTITUDE_FIELDS):
+            index = [ring.fields.index(name) for name in self.ATTITUDE_FIELDS]
+            angles = self.slerp_euler(before[index], after[index], fraction)
+            result[index] = angles
+
+        return self.message(ring.fields, boot_ms, result.tolist())
+
+    def get_msgs_at(self, t: float):
+        """Get every message type interpolated to a local time, see at()
+
+        Returns:
+            dict: message type => message (or None)
+        """
+        return { msg_type: self.at(msg_type, t) for msg_type in self.msg_types }
+
+    @staticmethod
+    def message(fields, boot_ms, values):
+        msg = SimpleNamespace(**dict(zip(fields, values)))
+        msg.time_boot_ms = boot_ms
+        return msg
+
+    @staticmethod
+    def euler2quaternion(roll: float, pitch: float, yaw: float):
+        # aerospace (yaw, pitch, roll) order, as MAVLink ATTITUDE
+        cr, sr = math.cos(roll / 2), math.sin(roll / 2)
+        cp, sp = math.cos(pitch / 2), math.sin(pitch / 2)
+        cy, sy = math.cos(yaw / 2), math.sin(yaw / 2)
+        return np.array([cr*cp*cy + sr*sp*sy,
+                         sr*cp*cy - cr*sp*sy,
+                         cr*sp*cy + sr*cp*sy,
+                         cr*cp*sy - sr*sp*cy])
+
+    @staticmethod
+    def quaternion2euler(q):
+        w, x, y, z = q
+        roll = math.atan2(2 * (w*x + y*z), 1 - 2 * (x*x + y*y))
+        pitch = math.asin(max(-1.0, min(1.0, 2 * (w*y - z*x))))
+        yaw = math.atan2(2 * (w*z + x*y), 1 - 2 * (y*y + z*z))
+        return np.array([roll, pitch, yaw])
+
+    @classmethod
+    def slerp_euler(cls, before, after, fraction: float):
+        """Interpolate between two attitudes along the shortest rotation
+
+        Args:
+            before (np.ndarray): (roll, pitch, yaw) radians
+            after (np.ndarray): (roll, pitch, yaw) radians
+            fraction (float): 0 for before, 1 for after
+
+        Returns:
+            np.ndarray: The interpolated (roll, pitch, yaw) radians
+        """
+        q0 = cls.euler2quaternion(*before)
+        q1 = cls.euler2quaternion(*after)
+        dot = float(np.dot(q0, q1))
+        if dot < 0:
+            q1, dot = -q1, -dot
+
+        if dot > 0.9995:
+            # too close to divide by sin(angle), linear is as good
+            q = q0 + (q1 - q0) * fraction
+        else:
+            angle = math.acos(dot)
+            q = (math.sin((1 - fraction) * angle) * q0 + math.sin(fraction * angle) * q1) / math.sin(angle)
+        return cls.quaternion2euler(q / np.linalg.norm(q))
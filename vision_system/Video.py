@@ -1,9 +1,33 @@
-import queue
+import os
+import time
+from collections import deque
 from threading import Thread, Condition
 
 import cv2
+import numpy as np
+
+from FFmpegCapture import FFmpegCapture
 
 class Video:
+    """Reads frames from a video stream
+
+    With a buffer_size, frames are read by a background thread into a ring of preallocated frames, so a slow
+    consumer never makes frames pile up in the stream's buffer. When the ring is full the oldest frame is
+    dropped, and get_latest() skips straight to the newest frame, so processing always runs on the freshest
+    frame with bounded latency. A frame returned by get_frame()/get_latest() stays valid (and is not
+    overwritten) until the next call.
+
+    A video file isn't live, so nothing is gained by dropping its frames: the capture thread waits for a free
+    buffer instead and get_latest() returns the next frame, so every frame is still processed in order.
+
+    Without a buffer_size, get_frame() reads the next frame from the stream when it's called.
+
+    The stream is read with OpenCV, or with the ffmpeg backend (see FFmpegCapture) which reads frames straight
+    into the preallocated buffers and lets the decoder's threads and buffering be set.
+    """
+
+    BACKENDS = ['opencv', 'ffmpeg']
+
     conn: str = None
     thread = None
     cap = None
@@ -14,34 +38,247 @@ class Video:
     cv = Condition()
     new_frame_available = False
 
-    def __init__(self, conn: str, debug_print: bool = False, save_file: str = None):
+    # the ring buffer (threaded capture only)
+    buffers: list = []
+    # indexes into buffers of the frames waiting to be consumed, oldest first, and when they were captured
+    # (time.perf_counter() for the latency and time.time() for frame_time)
+    ready: deque = None
+    # the buffer the consumer has (from the last get_frame()/get_latest())
+    held: int = None
+    running: bool = False
+    ended: bool = False
+    # a stream rather than a video file, frames are only dropped from live streams
+    live: bool = True
+
+    # counters
+    captured: int = 0
+    consumed: int = 0
+    dropped: int = 0
+    latency: float = 0.0
+    # when the last frame returned was captured (time.time())
+    frame_time: float = None
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+
+    def __init__(self, conn: str, debug_print: bool = False, save_file: str = None, buffer_size: int = 0,
+                 backend: str = 'opencv', ffmpeg_options: dict = None):
+        """
+        Args:
+            conn (str): The stream URL or video file
+            debug_print (bool, optional): Print connection messages (Defaults to False)
+            buffer_size (int, optional): Capture frames in a background thread into a ring of this many frames, at
+                                         least 3 (one being written, one held by the consumer and one waiting)
+                                         (Defaults to 0, read frames when they're asked for)
+            backend (str, optional): opencv or ffmpeg (Defaults to opencv)
+            ffmpeg_options (dict, optional): Arguments for FFmpegCapture, eg. { 'threads': 2, 'low_latency': True }, the
+                                             pix_fmt can only be bgr24 (Defaults to None)
+        """
+        if backend not in self.BACKENDS:
+            raise Exception(f"Unknown video backend {backend} (expected {', '.join(self.BACKENDS)})")
         self.conn = conn
         self.debug_print = debug_print
+        self.live = not os.path.isfile(conn)
 
         if debug_print:
             print(f"Connecting to {self.conn}")
-        self.cap = cv2.VideoCapture(self.conn)
+        if backend == 'ffmpeg':
+            # the frames (and the ring buffers) are BGR, the same as OpenCV's
+            pix_fmt = (ffmpeg_options or {}).get('pix_fmt', 'bgr24')
+            if pix_fmt != 'bgr24':
+                raise Exception(f"Video reads BGR frames, the ffmpeg backend's pix_fmt has to be bgr24 (not {pix_fmt})")
+            self.cap = FFmpegCapture(self.conn, **(ffmpeg_options or {}))
+        else:
+            self.cap = cv2.VideoCapture(self.conn)
         if (self.cap.isOpened() == False):
             raise Exception(f"Could not connect to stream {self.conn}")
-        
+
         self.width = int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH))
         self.height = int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
 
         if debug_print:
             print(f"Connected to {self.conn} (Frame size: {self.width}x{self.height})")
 
+        self.cv = Condition()
+        self.new_frame_available = False
+        self.ready = deque()
+        self.held = None
+        self.running = False
+        self.ended = False
+        self.captured = 0
+        self.consumed = 0
+        self.dropped = 0
+        self.latency = 0.0
+        self.frame_time = None
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.buffers = []
+        if buffer_size:
+            self.buffers = [np.empty((self.height, self.width, 3), dtype=np.uint8) for _ in range(max(3, buffer_size))]
+            self.running = True
+            self.thread = Thread(target=self.capture)
+            self.thread.daemon = True # makes sure it cleans up on ctrl+c
+            self.thread.start()
+
     def get_resolution(self):
         return (self.width, self.height)
-    
+
     def get_centre_point(self):
         width, height = self.get_resolution()
         return (int(width/2), int(height/2))
-    
+
     def cleanup(self):
+        if self.thread is not None:
+            with self.cv:
+                self.running = False
+                self.cv.notify_all()
+            self.thread.join()
         self.cap.release()
 
-    def get_frame(self):
-        ret, frame = self.cap.read()
-        if(not ret):
-            return None
-        return frame
\ No newline at end of file
+    def capture(self):
+        """Read frames into the ring buffer until the stream ends or cleanup() is called (the capture thread)"""
+        writing = None
+        while True:
+            with self.cv:
+                if not self.running:
+                    break
+                # a buffer that isn't waiting or held by the consumer, or the oldest waiting frame if there isn't one
+                # (a file waits for the consumer instead)
+                free = self.free_buffers()
+                while not free and not self.live and self.running:
+                    self.cv.wait()
+                    free = self.free_buffers()
+                if not self.running:
+                    break
+                if free:
+                    writing = free[0]
+                else:
+                    writing, _, _ = self.ready.popleft()
+                    self.dropped += 1
+
+            ret, frame = self.cap.read(self.buffers[writing])
+            captured = time.perf_counter()
+            captured_time = time.time()
+
+            with self.cv:
+                if not ret:
+                    break
+                if frame is not self.buffers[writing]:
+                    # the stream changed size, make this the buffer from now on
+                    self.buffers[writing] = frame
+                self.ready.append((writing, captured, captured_time))
+                self.captured += 1
+                self.new_frame_available = True
+                self.cv.notify_all()
+
+        with self.cv:
+            self.ended = True
+            self.cv.notify_all()
+
+    def free_buffers(self):
+        busy = set(index for index, _, _ in self.ready)
+        busy.add(self.held)
+        return [index for index in range(len(self.buffers)) if index not in busy]
+
+    def take(self, latest: bool, timeout: float):
+        # wait for a frame from the capture thread, then hand its buffer to the consumer
+        with self.cv:
+            if not self.cv.wait_for(lambda: self.ready or self.ended or not self.running, timeout):
+                return None
+            if not self.ready:
+                return None
+
+            if latest and self.live:
+                while len(self.ready) > 1:
+                    self.ready.popleft()
+                    self.dropped += 1
+            index, captured, self.frame_time = self.ready.popleft()
+            self.new_frame_available = bool(self.ready)
+            self.held = index
+            # the capture thread may be waiting for the buffer that was held
+            self.cv.notify_all()
+
+            self.latency = time.perf_counter() - captured
+            self.total_latency += self.latency
+            self.max_latency = max(self.max_latency, self.latency)
+            self.consumed += 1
+            return self.buffers[index]
+
+    def get_frame(self, timeout: float = None):
+        """Get the next frame
+
+        Args:
+            timeout (float, optional): Seconds to wait for a frame in threaded capture (Defaults to None, forever)
+
+        Returns:
+            np.ndarray: The BGR frame, None at the end of the stream (or after the timeout)
+        """
+        if self.thread is None:
+            ret, frame = self.cap.read()
+            if(not ret):
+                return None
+            self.frame_time = time.time()
+            self.captured += 1
+            self.consumed += 1
+            return frame
+        return self.take(False, timeout)
+
+    def get_latest(self, timeout: float = None):
+        """Get the newest frame, dropping any older frames that haven't been consumed (the next frame of a file)
+
+        Args:
+            timeout (float, optional): See get_frame()
+
+        Returns:
+            np.ndarray: The BGR frame, None at the end of the stream (or after the timeout)
+        """
+        if self.thread is None:
+            return self.get_frame()
+        return self.take(True, timeout)
+
+    def read_into(self, buffer: np.ndarray):
+        """Read the next frame into a buffer, eg. a slot of a Pipeline's FramePool (without a buffer_size only)
+
+        Args:
+            buffer (np.ndarray): A (height, width, 3) uint8 array
+
+        Returns:
+            bool: False at the end of the stream
+        """
+        ret, frame = self.cap.read(buffer)
+        if ret and frame is not buffer:
+            buffer[...] = frame
+        self.frame_time = time.time()
+        if ret:
+            self.captured += 1
+            self.consumed += 1
+        return ret
+
+    def skip(self):
+        """Read the next frame without decoding it into a buffer (without a buffer_size only)
+
+        Returns:
+            bool: False at the end of the stream
+        """
+        if not self.cap.grab():
+            return False
+        self.captured += 1
+        self.dropped += 1
+        return True
+
+    def get_stats(self):
+        """Get the capture counters
+
+        Returns:
+            dict: { 'captured', 'consumed', 'dropped' (frames), 'latency_ms' (capture to consume of the last frame),
+                    'mean_latency_ms', 'max_latency_ms' }
+        """
+        with self.cv:
+            return {
+                'captured': self.captured,
+                'consumed': self.consumed,
+                'dropped': self.dropped,
+                'latency_ms': self.latency * 1E3,
+                'mean_latency_ms': self.total_latency / self.consumed * 1E3 if self.consumed else 0.0,
+                'max_latency_ms': self.max_latency * 1E3,
+            }
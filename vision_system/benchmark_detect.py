@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import argparse
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from TargetDetect import TargetDetect
+from TargetTracker import TargetTracker
+
+# python3 benchmark_detect.py -r vga,1080p,4k --modes full,pyramid,track -o detect_benchmark.json --compare detect_main.json
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# benchmark_report.py is shared with telemetry_processor/benchmark.py
+sys.path.append(os.path.join(SCRIPT_DIR, '..'))
+import benchmark_report
+
+DEFAULT_IMAGE = os.path.join(SCRIPT_DIR, '..', 'data', 'DJI_0154.jpg')
+RESOLUTIONS = {
+    'vga': (640, 480),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+    '12mp': (4000, 3000),
+}
+MODES = ['full', 'pyramid', 'track', 'reference']
+
+def parse_resolution(text):
+    text = text.strip().lower()
+    if text in RESOLUTIONS:
+        return text, RESOLUTIONS[text]
+    width, height = text.split('x')
+    return text, (int(width), int(height))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark target detection on a real still and synthetic frames")
+    parser.add_argument('-i', '--image', type=str, default=DEFAULT_IMAGE, help="A real frame to benchmark (skipped if it doesn't exist)")
+    parser.add_argument('-r', '--resolutions', type=str, default='vga,1080p,4k,12mp', help=f"Comma separated synthetic frame sizes ({', '.join(RESOLUTIONS)} or WxH)")
+    parser.add_argument('-m', '--modes', type=str, default='full,pyramid,track', help=f"Comma separated detector modes ({', '.join(MODES)})")
+    parser.add_argument('-t', '--targets', type=int, default=8, help="Coloured targets in each synthetic frame")
+    parser.add_argument('--clutter', type=int, default=40, help="Distractors in each synthetic frame (coloured specks under the minimum area and patches of colours that aren't targets)")
+    parser.add_argument('-n', '--frames', type=int, default=50, help="Frames to time for each resolution and mode")
+    parser.add_argument('-d', '--downscale', type=int, default=4, help="Downscale factor of the pyramid mode")
+    parser.add_argument('--track-every', type=int, default=10, help="Full frame search interval of the track mode")
+    parser.add_argument('--seed', type=int, default=0, help="Random seed of the synthetic frames")
+    parser.add_argument('-o', '--output', type=str, default='detect_benchmark.json', help="The JSON file to write the results to")
+    parser.add_argument('-c', '--compare', type=str, help="A previous results JSON file to compare against")
+    parser.add_argument('--threshold', type=float, default=0.1, help="Flag a regression when the median latency is this fraction slower than in --compare")
+
+    args = parser.parse_args()
+    args.image = os.path.expanduser(args.image)
+    try:
+        args.resolutions = [parse_resolution(x) for x in args.resolutions.split(',') if x.strip()]
+    except ValueError:
+        parser.error(f"resolutions must be {', '.join(RESOLUTIONS)} or WxH")
+    args.modes = [x.strip() for x in args.modes.split(',') if x.strip()]
+    for mode in args.modes:
+        if mode not in MODES:
+            parser.error(f"unknown mode '{mode}'")
+
+    return args
+
+class SyntheticScene:
+    """Generates frames of moving coloured targets over a noisy background
+
+    The background is low saturation noise (so it doesn't match any colour), generated once per scene.
+    Targets are filled circles at the centre hue of each colour TargetDetect can see, moving a few pixels a
+    frame so the tracker has something to follow. Clutter is specks of target colours too small to pass the
+    area threshold and saturated patches of hues between the colour ranges.
+    """
+
+    def __init__(self, width: int, height: int, targets: int, clutter: int, colour_ranges: dict, seed: int = 0):
+        """
+        Args:
+            width (int): The frame width (pixels)
+            height (int): The frame height (pixels)
+            targets (int): The number of targets
+            clutter (int): The number of distractors
+            colour_ranges (dict): TargetDetect.colour_ranges, to pick the hues from
+            seed (int, optional): Random seed (Defaults to 0)
+        """
+        self.width = width
+        self.height = height
+        rng = np.random.default_rng(seed)
+
+        # OpenCV's 8 bit hue is 0-179, ranges above that can't match
+        self.hues = [(lower[0] + upper[0]) // 2 for ranges in colour_ranges.values() for lower, upper in ranges[:1] if lower[0] < 180]
+        # distractor hues are kept a few hues from the ranges, or the blur smears their edges into a target colour
+        inside = np.zeros(180, dtype=bool)
+        for ranges in colour_ranges.values():
+            for lower, upper in ranges:
+                inside[max(0, min(lower[0] - 4, 180)):min(upper[0] + 5, 180)] = True
+        other_hues = np.flatnonzero(~inside)
+
+        # a small background scaled up, noise at full resolution is slow to generate at 12MP and looks the same
+        small = np.empty((max(1, height // 4), max(1, width // 4), 3), dtype=np.uint8)
+        small[..., 0] = rng.integers(0, 180, small.shape[:2])
+        small[..., 1] = rng.integers(30, 200, small.shape[:2])
+        small[..., 2] = rng.integers(0, 60, small.shape[:2])
+        hls = cv2.resize(cv2.GaussianBlur(small, (0, 0), 1), (width, height), interpolation=cv2.INTER_LINEAR)
+
+        size = min(width, height)
+        # blobs under TargetDetect.MINUMUM_AREA_PX
+        speck = max(1, int(np.sqrt(TargetDetect.MINUMUM_AREA_PX) / 4))
+        for _ in range(clutter):
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            if len(other_hues) and rng.random() < 0.5:
+                r = int(rng.integers(max(2, size // 60), max(3, size // 20)))
+                cv2.circle(hls, (x, y), r, (int(rng.choice(other_hues)), 128, 200), -1)
+            elif self.hues:
+                cv2.circle(hls, (x, y), speck, (int(rng.choice(self.hues)), 128, 200), -1)
+        self.background = cv2.cvtColor(hls, cv2.COLOR_HLS2BGR)
+
+        self.targets = []
+        for _ in range(targets if self.hues else 0):
+            r = int(rng.integers(max(12, size // 40), max(13, size // 15)))
+            position = np.array([rng.integers(r, max(r + 1, width - r)), rng.integers(r, max(r + 1, height - r))], dtype=np.float64)
+            velocity = rng.uniform(-3, 3, 2)
+            hue = int(rng.choice(self.hues))
+            self.targets.append([position, velocity, r, cv2.cvtColor(np.uint8([[[hue, 128, 200]]]), cv2.COLOR_HLS2BGR)[0, 0].tolist()])
+
+    def frame(self, number: int):
+        """Get a frame of the scene
+
+        Args:
+            number (int): The frame number
+
+        Returns:
+            np.ndarray: The BGR frame
+        """
+        frame = self.background.copy()
+        for position, velocity, r, colour in self.targets:
+            x, y = position + velocity * number
+            # bounce off the edges
+            x = abs((x - r) % (2 * max(1, self.width - 2*r)) - max(1, self.width - 2*r)) + r
+            y = abs((y - r) % (2 * max(1, self.height - 2*r)) - max(1, self.height - 2*r)) + r
+            cv2.circle(frame, (int(x), int(y)), r, colour, -1)
+        return frame
+
+def make_detector(mode: str, args):
+    """Create the detect function of a mode
+
+    Returns:
+        function: frame => number of targets found
+    """
+    if mode == 'full':
+        detect = TargetDetect()
+        return lambda frame: len(detect.detect(frame))
+    if mode == 'pyramid':
+        detect = TargetDetect(args.downscale)
+        return lambda frame: len(detect.detect(frame))
+    if mode == 'track':
+        tracker = TargetTracker(TargetDetect(), full_every=args.track_every)
+        return lambda frame: len(tracker.update(frame))
+
+    # the mask per colour path the lookup tables replaced, on the same blurred frame as detect()
+    detect = TargetDetect()
+    def reference(frame):
+        blurred = cv2.GaussianBlur(frame, (3,3), 0)
+        hls = cv2.cvtColor(blurred, cv2.COLOR_BGR2HLS)
+        return sum(len(detect.detect_color(blurred, hls, ranges, color)) for color, ranges in detect.colour_ranges.items())
+    return reference
+
+def run(mode: str, frames, count: int, args):
+    """Time a detector mode
+
+    Args:
+        mode (str): One of MODES
+        frames (function): frame number => frame, generated outside the timed part
+        count (int): The number of frames to time
+        args: The command line arguments
+
+    Returns:
+        dict: The latency distribution, frames/s, the allocations per frame and the mean targets found
+    """
+    detect = make_detector(mode, args)
+
+    # warm up the lookup tables, caches and the tracker's tracks
+    for number in range(3):
+        detect(frames(number))
+
+    latencies = []
+    found = 0
+    for number in range(3, 3 + count):
+        frame = frames(number)
+        start = time.perf_counter()
+        found += detect(frame)
+        latencies.append(time.perf_counter() - start)
+
+    # tracemalloc slows down Python code, so allocations are measured on a separate few frames. NumPy (and so
+    # OpenCV's output arrays) report their buffers to it: peak is the most memory allocated at once during a
+    # frame, retained is the number of blocks still allocated after it (eg. caches, tracks)
+    peaks = []
+    retained = []
+    tracemalloc.start()
+    for number in range(3 + count, 3 + count + min(count, 5)):
+        frame = frames(number)
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        detect(frame)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        retained.append(sum(stat.count_diff for stat in tracemalloc.take_snapshot().compare_to(snapshot, 'filename') if stat.count_diff > 0))
+    tracemalloc.stop()
+
+    ms = np.array(latencies) * 1E3
+    return {
+        'frames': count,
+        'fps': count / sum(latencies),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+        'peak_alloc_mb': max(peaks) / (1 << 20),
+        'retained_blocks': int(np.median(retained)),
+        'targets_per_frame': found / count,
+    }
+
+def compare(results, previous_file, threshold):
+    """Print the change from a previous run and flag regressions
+
+    Returns:
+        list: The results whose median latency is more than threshold slower
+    """
+    before = benchmark_report.load_previous(previous_file, lambda x: (x['source'], x['mode']))
+    regressions = []
+    for result in results:
+        old = before.get((result['source'], result['mode']))
+        if old is None or result.get('error') is not None:
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1 if old['p50_ms'] else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(result)
+            flag = '  REGRESSION'
+        if result['targets_per_frame'] != old['targets_per_frame']:
+            flag += f"  targets {old['targets_per_frame']:.2f} -> {result['targets_per_frame']:.2f}"
+        print(f"  {result['source']:<10} {result['mode']:<9} p50 {old['p50_ms']:8.2f}ms -> {result['p50_ms']:8.2f}ms ({change:+.0%}){flag}")
+
+    return regressions
+
+def main():
+    args = parse_args()
+
+    sources = []
+    if os.path.isfile(args.image):
+        image = cv2.imread(args.image)
+        if image is None:
+            print(f"Warning: Could not read image, skipping it: {args.image}")
+        else:
+            sources.append(('real', image.shape[1], image.shape[0], lambda number: image))
+    else:
+        print(f"Warning: Image file not found, skipping it: {args.image}")
+
+    colour_ranges = TargetDetect().colour_ranges
+    for name, (width, height) in args.resolutions:
+        scene = SyntheticScene(width, height, args.targets, args.clutter, colour_ranges, args.seed)
+        sources.append((name, width, height, scene.frame))
+
+    results = []
+    for source, width, height, frames in sources:
+        for mode in args.modes:
+            result = { 'source': source, 'width': width, 'height': height, 'mode': mode }
+            try:
+                result.update(run(mode, frames, args.frames, args))
+            except Exception as exc:
+                result['error'] = str(exc)
+                print(f"  {source:<10} {mode:<9} failed: {exc}")
+                results.append(result)
+                continue
+            results.append(result)
+            print(f"  {source:<10} {mode:<9} {result['fps']:7.1f} frames/s  p50 {result['p50_ms']:7.2f}ms  p95 {result['p95_ms']:7.2f}ms  "
+                  f"p99 {result['p99_ms']:7.2f}ms  peak alloc {result['peak_alloc_mb']:6.1f} MB  {result['targets_per_frame']:.1f} targets")
+
+    report = benchmark_report.environment()
+    report.update({
+        'opencv': cv2.__version__,
+        'cv2_threads': cv2.getNumThreads(),
+        'targets': args.targets,
+        'clutter': args.clutter,
+        'seed': args.seed,
+        'results': results,
+    })
+    benchmark_report.write_report(report, args.output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) over {args.threshold:.0%}")
+            exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+import os
+import csv
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+import numpy as np
+
+from TargetDetect import TargetDetect
+from Detections import Detections
+
+# python3 offline_detect.py ../recorder/flights/20231106_161938_123/output.avi -j 8 -d 4
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Detect targets in every frame of a recorded video using all of the CPU cores")
+    parser.add_argument('VIDEO', type=str, help="The recorded video (eg. output.avi from record_telem.py)")
+    parser.add_argument('-o', '--output', type=str, help="The file to write the detections to, .csv or .npy (Defaults to detections.csv next to the video)")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help="The number of worker processes")
+    parser.add_argument('--chunk', type=int, default=0, help="Frames per work item (Defaults to splitting the video into 4 items per worker)")
+    parser.add_argument('-d', '--downscale', type=int, default=1, help="Find targets on a frame downscaled by this factor and refine them at full resolution (see TargetDetect)")
+    parser.add_argument('--start', type=int, default=0, help="The first frame to process")
+    parser.add_argument('--end', type=int, help="Stop before this frame (Defaults to the end of the video)")
+
+    args = parser.parse_args()
+    args.VIDEO = os.path.expanduser(args.VIDEO)
+    if args.output is None:
+        args.output = os.path.join(os.path.dirname(args.VIDEO), 'detections.csv')
+
+    return args
+
+# each worker process keeps one detector so the colour lookup tables are only built once
+detect = None
+
+def init_worker(downscale: int):
+    global detect
+    # the frames are already split between the processes
+    cv2.setNumThreads(1)
+    detect = TargetDetect(downscale)
+
+def detect_frames(video: str, start: int, end: int):
+    """Detect targets in a range of frames of a video
+
+    Args:
+        video (str): The video file
+        start (int): The first frame
+        end (int): Stop before this frame, or None to read to the end of the video
+
+    Returns:
+        tuple: (start, the number of frames read, the detections as a DETECTION_DTYPE array)
+    """
+    cap = cv2.VideoCapture(video)
+    if start > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+
+    found = []
+    frame_number = start
+    while end is None or frame_number < end:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        found.append(detect.detect(frame).with_frame(frame_number))
+        frame_number += 1
+    cap.release()
+
+    return start, frame_number - start, Detections.concatenate(found, detect.segmenter.colours).array
+
+class DetectionWriter:
+    """Writes detections to a .csv or .npy file in frame order, as the chunks of frames finish out of order"""
+
+    def __init__(self, file: str, colours):
+        self.file = file
+        self.colours = tuple(colours)
+        # finished chunks waiting for the ones before them
+        self.pending = {}
+        self.next_chunk = 0
+        self.parts = []
+        self.count = 0
+
+        self.csv = None
+        if not file.endswith('.npy'):
+            self.csv_file = open(file, 'w', newline='')
+            self.csv = csv.writer(self.csv_file)
+            self.csv.writerow(['frame', 'x', 'y', 'w', 'h', 'A', 'color'])
+
+    def add(self, chunk: int, array: np.ndarray):
+        """Add the detections of a chunk, writing it and any chunks after it once the chunks before it are written
+
+        Args:
+            chunk (int): The chunk's position in the video (0 for the first chunk)
+            array (np.ndarray): The chunk's detections
+        """
+        self.pending[chunk] = array
+        while self.next_chunk in self.pending:
+            self.write(self.pending.pop(self.next_chunk))
+            self.next_chunk += 1
+
+    def write(self, array: np.ndarray):
+        self.count += len(array)
+        if self.csv is None:
+            self.parts.append(array)
+            return
+        names = Detections(array, self.colours).colour_names()
+        self.csv.writerows(zip(array['frame'].tolist(), array['x'].tolist(), array['y'].tolist(), array['w'].tolist(),
+                               array['h'].tolist(), array['A'].tolist(), names))
+
+    def close(self):
+        if self.csv is None:
+            np.save(self.file, Detections.concatenate([Detections(part, self.colours) for part in self.parts], self.colours).array)
+        else:
+            self.csv_file.close()
+
+def main():
+    args = parse_args()
+
+    if not os.path.isfile(args.VIDEO):
+        print(f"Error: Video file is not a file: {args.VIDEO}")
+        exit()
+
+    cap = cv2.VideoCapture(args.VIDEO)
+    if not cap.isOpened():
+        print(f"Error: Could not open video: {args.VIDEO}")
+        exit()
+    # the frame count is from the container's header, the last chunk reads on to the real end of the video
+    total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+
+    end = args.end if args.end is not None else total
+    frames = max(0, end - args.start)
+    jobs = max(1, args.jobs)
+    chunk = args.chunk if args.chunk > 0 else max(1, -(-frames // (jobs * 4)))
+
+    ranges = [(start, min(start + chunk, end)) for start in range(args.start, end, chunk)]
+    if args.end is None:
+        if ranges:
+            ranges[-1] = (ranges[-1][0], None)
+        else:
+            ranges = [(args.start, None)]
+
+    print(f"Detecting targets in {frames} frames of {args.VIDEO} ({len(ranges)} chunks, {jobs} workers)")
+
+    writer = DetectionWriter(args.output, TargetDetect().segmenter.colours)
+
+    read = 0
+    start_time = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(args.downscale,)) as executor:
+        futures = { executor.submit(detect_frames, args.VIDEO, start, stop): chunk for chunk, (start, stop) in enumerate(ranges) }
+        for i, future in enumerate(as_completed(futures), 1):
+            _, count, array = future.result()
+            writer.add(futures[future], array)
+            read += count
+            elapsed = time.perf_counter() - start_time
+            print(f"[{i}/{len(ranges)}] {read} frames, {read / elapsed:.1f} frames/s")
+    writer.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"Found {writer.count} targets in {read} frames in {elapsed:.2f}s ({read / elapsed if elapsed else 0:.1f} frames/s)")
+    print(f"Wrote {args.output}")
+
+if __name__ == "__main__":
+    main()
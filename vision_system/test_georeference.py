@@ -0,0 +1,70 @@
+import math
+
+import numpy as np
+
+from TargetDetect import TargetDetect
+
+WIDTH, HEIGHT = 1920, 1080
+ALT, LAT, LON = 15.6, 42.9792118, -81.1439136
+
+def test_nadir_pixel_is_below_the_vehicle():
+    detect = TargetDetect()
+    for enu in (False, True):
+        coords = detect.pixels2coords_batch([WIDTH / 2], [HEIGHT / 2], WIDTH, HEIGHT, ALT, LAT, LON, 0, 0, 0, enu=enu)
+        assert coords['valid'][0]
+        assert coords['distance'][0] == 0
+        assert math.isclose(coords['lat'][0], LAT, abs_tol=1E-9)
+        assert math.isclose(coords['lon'][0], LON, abs_tol=1E-9)
+
+def test_off_nadir_pixels_are_alt_tan_angle_away():
+    detect = TargetDetect()
+    x = np.array([WIDTH / 2 + 1, WIDTH / 2 + 10, WIDTH / 2, 0])
+    y = np.array([HEIGHT / 2, HEIGHT / 2, 0, 0])
+    coords = detect.pixels2coords_batch(x, y, WIDTH, HEIGHT, ALT, LAT, LON, 0, 0, 0)
+
+    rays = detect.camera.pixels2rays(x, y, WIDTH, HEIGHT)
+    tan_angle = np.hypot(rays[:, 0], rays[:, 1]) / rays[:, 2]
+    assert coords['valid'].all()
+    np.testing.assert_allclose(coords['distance'], ALT * tan_angle)
+    # one pixel off centre is a fraction of a metre away, not hundreds
+    assert coords['distance'][0] < 1
+
+    # the local tangent plane agrees with the geodesic this close to the vehicle
+    enu = detect.pixels2coords_batch(x, y, WIDTH, HEIGHT, ALT, LAT, LON, 0, 0, 0, enu=True)
+    np.testing.assert_allclose(enu['lat'], coords['lat'], atol=1E-7)
+    np.testing.assert_allclose(enu['lon'], coords['lon'], atol=1E-7)
+
+def test_rays_above_the_horizon_are_invalid():
+    detect = TargetDetect()
+    # pitched up 90 degrees, the centre pixel looks straight ahead and the top row above the horizon
+    coords = detect.pixels2coords_batch([WIDTH / 2, WIDTH / 2], [HEIGHT / 2, 0], WIDTH, HEIGHT, ALT, LAT, LON, 0, 90, 0)
+    assert not coords['valid'].any()
+    assert np.isnan(coords['lat']).all() and np.isnan(coords['lon']).all() and np.isnan(coords['distance']).all()
+
+def test_nadir_pixel_stays_below_the_vehicle_at_any_heading():
+    detect = TargetDetect()
+    hdg = np.array([0, 10, 45, 90, 135, 180, 270, 359])
+    for coords in (detect.pixels2coords_batch([WIDTH / 2] * len(hdg), [HEIGHT / 2] * len(hdg), WIDTH, HEIGHT, ALT, LAT, LON, hdg, 0, 0),
+                   *[detect.pixels2coords_batch([WIDTH / 2], [HEIGHT / 2], WIDTH, HEIGHT, ALT, LAT, LON, h, 0, 0) for h in hdg]):
+        assert coords['valid'].all()
+        np.testing.assert_allclose(coords['distance'], 0)
+        np.testing.assert_allclose(coords['lat'], LAT, atol=1E-9)
+        np.testing.assert_allclose(coords['lon'], LON, atol=1E-9)
+
+def test_forward_pixel_points_along_the_heading():
+    detect = TargetDetect()
+    # the top of the frame is towards the nose
+    for hdg, lat_sign, lon_sign in ((0, 1, 0), (90, 0, 1), (180, -1, 0), (270, 0, -1)):
+        coords = detect.pixels2coords_batch([WIDTH / 2], [0], WIDTH, HEIGHT, ALT, LAT, LON, hdg, 0, 0)
+        assert coords['valid'][0]
+        assert math.isclose(coords['azimuth'][0] % 360, hdg, abs_tol=1E-6)
+        assert np.sign(round(coords['lat'][0] - LAT, 6)) == lat_sign
+        assert np.sign(round(coords['lon'][0] - LON, 6)) == lon_sign
+
+    # per pixel attitudes agree with the cached single attitude
+    hdg = np.array([0, 30, 90, 200])
+    batch = detect.pixels2coords_batch(np.full(4, WIDTH / 4), np.zeros(4), WIDTH, HEIGHT, ALT, LAT, LON, hdg, 5, -3)
+    for i, h in enumerate(hdg):
+        single = detect.pixels2coords_batch([WIDTH / 4], [0], WIDTH, HEIGHT, ALT, LAT, LON, h, 5, -3)
+        np.testing.assert_allclose(batch['azimuth'][i], single['azimuth'][0])
+        np.testing.assert_allclose(batch['lat'][i], single['lat'][0])
@@ -0,0 +1,31 @@
+from types import SimpleNamespace
+
+from TelemetryHistory import TelemetryHistory
+
+def message(boot_ms: int, lat: int):
+    msg = SimpleNamespace(time_boot_ms=boot_ms, lat=lat)
+    msg.get_type = lambda: 'GLOBAL_POSITION_INT'
+    msg.get_fieldnames = lambda: ['time_boot_ms', 'lat']
+    return msg
+
+def test_interpolates_between_messages():
+    history = TelemetryHistory(['GLOBAL_POSITION_INT'])
+    for boot_ms in range(0, 10000, 1000):
+        history.add(message(boot_ms, boot_ms), 100 + boot_ms / 1E3)
+    assert history.at_boot_ms('GLOBAL_POSITION_INT', 4500).lat == 4500
+    assert history.at('GLOBAL_POSITION_INT', 104.25).lat == 4250
+
+def test_interpolates_after_a_reboot():
+    history = TelemetryHistory(['GLOBAL_POSITION_INT'])
+    for boot_ms in range(0, 60000, 1000):
+        history.add(message(boot_ms, 0), 100 + boot_ms / 1E3)
+
+    # the flight controller rebooted, its clock starts again from 0
+    for boot_ms in range(0, 10000, 1000):
+        history.add(message(boot_ms, boot_ms), 200 + boot_ms / 1E3)
+
+    boot_times, _ = history.rings['GLOBAL_POSITION_INT'].window()
+    assert len(boot_times) == 10
+    assert history.at_boot_ms('GLOBAL_POSITION_INT', 4500).lat == 4500
+    # and local times map onto the new clock
+    assert history.at('GLOBAL_POSITION_INT', 204.25).lat == 4250
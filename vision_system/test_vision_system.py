@@ -0,0 +1,68 @@
+import os
+import json
+import math
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+
+from TargetDetect import TargetDetect
+from DetectionPublisher import DetectionPublisher
+from vision_system import georeference
+
+WIDTH, HEIGHT = 1280, 720
+
+def frame_with_targets():
+    frame = np.full((HEIGHT, WIDTH, 3), 90, dtype=np.uint8)
+    # targets around the frame, including the corners furthest off nadir
+    for (x, y), colour in (((40, 40), (0, 0, 255)), ((600, 330), (0, 255, 255)), ((1180, 620), (0, 0, 255)), ((1180, 40), (0, 0, 255))):
+        cv2.rectangle(frame, (x, y), (x + 60, y + 60), colour, -1)
+    return frame
+
+def test_heading_changes_dont_invalidate_targets():
+    detect = TargetDetect()
+    centroids = detect.detect(frame_with_targets())
+    assert len(centroids) == 4
+
+    # hdg is 65535 (unknown) on GLOBAL_POSITION_INT, the heading comes from ATTITUDE
+    pos = SimpleNamespace(relative_alt=30000, lat=429792118, lon=-811439136, hdg=65535)
+    level = None
+    for yaw in range(-180, 180, 15):
+        att = SimpleNamespace(yaw=math.radians(yaw), pitch=0.0, roll=0.0)
+        coords = georeference(detect, centroids, pos, att, WIDTH, HEIGHT)
+        assert coords['valid'].all()
+        assert not np.isnan(coords['lat']).any() and not np.isnan(coords['lon']).any()
+        if level is None:
+            level = coords
+        # turning only moves the targets around the vehicle
+        np.testing.assert_allclose(coords['distance'], level['distance'])
+        turned = coords['azimuth'] - level['azimuth'] - (yaw + 180)
+        np.testing.assert_allclose((turned + 180) % 360 - 180, 0, atol=1E-6)
+
+def test_published_targets_say_why_they_have_no_location():
+    detect = TargetDetect()
+    centroids = detect.detect(frame_with_targets())
+    pos = SimpleNamespace(relative_alt=30000, lat=429792118, lon=-811439136, hdg=65535)
+    json_publisher = DetectionPublisher(os.devnull, 'json')
+    binary_publisher = DetectionPublisher(os.devnull, 'binary')
+
+    # level at 90 degrees, banked 90 degrees so the camera looks at the horizon, and no telemetry
+    for att, status in ((SimpleNamespace(yaw=math.pi / 2, pitch=0.0, roll=0.0), 'valid'),
+                        (SimpleNamespace(yaw=math.pi / 2, pitch=0.0, roll=math.pi / 2), None),
+                        (None, 'no_telemetry')):
+        coords = georeference(detect, centroids, pos, att, WIDTH, HEIGHT)
+        record = json.loads(json_publisher.encode(1, 0.0, centroids, coords))
+        _, targets = DetectionPublisher.decode(binary_publisher.encode(1, 0.0, centroids, coords))
+        names = [DetectionPublisher.GEO_STATUS[geo] for geo in targets['geo']]
+        assert [target['geo'] for target in record['targets']] == names
+
+        if status is None:
+            # the pixels towards the left wing look above the horizon
+            assert set(names) == { 'valid', 'above_horizon' }
+        else:
+            assert set(names) == { status }
+        for target, row in zip(record['targets'], targets):
+            assert (target['lat'] is not None) == (target['geo'] == 'valid') == (not np.isnan(row['lat']))
+
+    json_publisher.close()
+    binary_publisher.close()
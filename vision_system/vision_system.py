@@ -1,23 +1,52 @@
 #!/usr/bin/python3
 
-import queue
+import time
 import argparse
 
 import cv2
 import numpy as np
-from scipy.spatial.transform import Rotation as R
-from geographiclib.geodesic import Geodesic
 
 from Telemetry import Telemetry
 from Video import Video
 from TargetDetect import TargetDetect
+from TargetTracker import TargetTracker
+from CameraModel import CameraModel
+from StageTimer import StageTimer
+from Detections import Detections
+from Pipeline import Pipeline, FramePool
+from DetectionPublisher import DetectionPublisher
+
+GLOBAL_POSITION_INT = 'GLOBAL_POSITION_INT'
+ATTITUDE = 'ATTITUDE'
+WINDOW_NAME = 'Tracking'
+
+# frames in the pipeline's shared memory, enough for every stage and the queues between them to be full
+PIPELINE_FRAMES = 12
+PIPELINE_QUEUE_SIZE = 2
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Analyze PADA video and telemetry to attempt lamding at markers")
     parser.add_argument('MAV', type=str, help="The connection URL to connect to for mavlink messages (eg. udpin:127.0.0.1:5001)")
     parser.add_argument('STREAM', type=str, help="The connection URL to use for the RTMP stream (eg. rtmp://localhost:1935/live/test)")
+    parser.add_argument('-n', '--track', type=int, default=0, help="Track targets and only search the whole frame every this many frames (eg. 10, Defaults to 0 which searches every frame without tracking)")
+    parser.add_argument('-c', '--camera', type=str, help="Camera calibration JSON file with the intrinsics and distortion (see CameraModel.load())")
+    parser.add_argument('-d', '--downscale', type=int, default=1, help="Find targets on a frame downscaled by this factor and refine them at full resolution (eg. 4)")
+    parser.add_argument('-b', '--buffer', type=int, default=3, help="Capture frames in a background thread into a ring of this many frames and always process the newest one (Defaults to 3, 0 processes every frame in order; a video file is always processed in order)")
+    parser.add_argument('--backend', type=str, default='opencv', choices=Video.BACKENDS, help="Read the stream with OpenCV or an ffmpeg subprocess (needs ffmpeg on the PATH) which reads frames straight into preallocated buffers")
+    parser.add_argument('--decoder-threads', type=int, default=0, help="With --backend ffmpeg, the number of decoder threads (Defaults to 0, ffmpeg chooses)")
+    parser.add_argument('--low-latency', action='store_true', help="With --backend ffmpeg, decode frames as soon as they arrive without buffering or probing the stream (for live streams)")
+    parser.add_argument('--history', type=int, default=512, help="Keep this many of each telemetry message to interpolate the telemetry to when each frame was captured (Defaults to 512, 0 uses the latest messages)")
+    parser.add_argument('--video-latency', type=float, default=0, help="Seconds between a frame being taken and it being received, subtracted from its capture time to match it with the telemetry")
+    parser.add_argument('--pipeline', action='store_true', help="Capture, detect, georeference and show frames in parallel stages (detection in its own process) instead of one after another")
+    parser.add_argument('--headless', action='store_true', help="Don't draw or show the frames (except for --preview), eg. on the onboard computer")
+    parser.add_argument('--publish', type=str, help="Publish each frame's targets and their coordinates to udp://host:port or a file (- for stdout)")
+    parser.add_argument('--format', type=str, default='json', choices=DetectionPublisher.FORMATS, help="The format to publish in, one line of JSON per frame or packed binary records (see DetectionPublisher)")
+    parser.add_argument('--preview', type=float, default=0, help="With --headless, show a frame this many times a second (eg. 2, Defaults to 0 which shows none)")
+    parser.add_argument('-p', '--profile', type=float, default=0, help="Time each stage of detection and print the p50/p95/p99 times every this many seconds (eg. 10, Defaults to 0 which doesn't time anything)")
 
     args = parser.parse_args()
+    if args.headless and not args.publish and args.preview <= 0:
+        parser.error("--headless needs --publish or --preview, otherwise the targets go nowhere")
 
     return args
 
@@ -26,61 +55,236 @@ def placeBoundingBox(frame, x, y, w, h, colour=(255,255,255), thickness=4):
         end   = ( int(x+w/2), int(y+h/2) )
         cv2.rectangle(frame, start, end, colour, thickness)
 
-def main():
+def create_detector(downscale: int, camera: CameraModel, track: int, profile: float):
+    """Create the detector from the command line arguments
 
-    args = parse_args()
-    GLOBAL_POSITION_INT = 'GLOBAL_POSITION_INT'
-    ATTITUDE = 'ATTITUDE'
+    Returns:
+        tuple: (TargetDetect, TargetTracker or None, StageTimer or None)
+    """
+    timer = StageTimer(profile) if profile > 0 else None
+    detect = TargetDetect(downscale, camera, timer)
+    tracker = TargetTracker(detect, full_every=track) if track > 0 else None
+    return detect, tracker, timer
+
+def find_targets(detect: TargetDetect, tracker: TargetTracker, timer: StageTimer, frame):
+    if timer:
+        start = timer.now()
+    centroids = tracker.update(frame) if tracker else detect.detect(frame)
+    if timer:
+        # includes the tracking, on tracked frames only the search windows go through detect()
+        timer.lap('frame', start)
+        timer.tick()
+    return centroids
+
+def detect_worker(downscale: int, camera: CameraModel, track: int, profile: float):
+    # creates the work function of the pipeline's detect process
+    detect, tracker, timer = create_detector(downscale, camera, track, profile)
+    return lambda frame: { 'detections': find_targets(detect, tracker, timer, frame).array }
+
+def georeference(detect: TargetDetect, centroids: Detections, pos, att, width: int, height: int):
+    """Get the coordinates of the targets from the telemetry
+
+    The heading, pitch and roll all come from ATTITUDE, interpolated together to the frame's capture time
+    (GLOBAL_POSITION_INT's hdg is 65535 when it's unknown).
+
+    Returns:
+        dict: See TargetDetect.pixels2coords_batch(), None without targets or telemetry
+    """
+    if not len(centroids) or pos is None or att is None:
+        return None
+    return detect.pixels2coords_batch(centroids['x'], centroids['y'], width, height, pos.relative_alt/1E3, pos.lat/1E7, pos.lon/1E7,
+                                      np.degrees(att.yaw), np.degrees(att.pitch), np.degrees(att.roll))
+
+def draw(frame, centroids: Detections, coords: dict, pos):
+    for i, (c, colour) in enumerate(zip(centroids, centroids.colour_names())):
+        start = ( int(c['x']-c['w']/2), int(c['y']-c['h']/2) )
+        end   = ( int(c['x']+c['w']/2), int(c['y']+c['h']/2) )
+        label = f"{colour} #{c['id']}" if 'id' in c.dtype.names else colour
+        if coords is not None and coords['valid'][i]:
+            label += f" {coords['lat'][i]:.6f},{coords['lon'][i]:.6f}"
+        cv2.rectangle(frame, start, end, (36,255,12), 4)
+        cv2.putText(frame, label, start, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
+
+    if pos:
+        # TODO: wrap this up in a function in the Video class
+        cv2.putText(frame, f"{pos.time_boot_ms}", (50, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
+        cv2.putText(frame, f"Lat  : {pos.lat/1E7}", (50, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
+        cv2.putText(frame, f"Lon  : {pos.lon/1E7}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
+        cv2.putText(frame, f"Hdg  : {pos.hdg}", (50, 120), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
 
-    WINDOW_NAME = 'Tracking'
-    att = None
-    messages = [GLOBAL_POSITION_INT, ATTITUDE]
+def show(frame):
+    """Show a frame in the window
 
+    Returns:
+        bool: False once the window is closed (q, esc or the close button)
+    """
+    cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
+    cv2.imshow(WINDOW_NAME, frame)
+
+    key = cv2.waitKey(1)
+    return not (key == ord('q') or key == 27 or cv2.getWindowProperty(WINDOW_NAME, cv2.WND_PROP_VISIBLE) < 1)
+
+def create_output(args, publisher: DetectionPublisher):
+    """Create the function that publishes and shows each frame's results
+
+    Returns:
+        function: (frame, number, time, centroids, coords, pos) => False once the window is closed
+    """
+    preview_interval = 1 / args.preview if args.preview > 0 else None
+    last_preview = [0.0]
+
+    def output(frame, number: int, t: float, centroids: Detections, coords: dict, pos):
+        if publisher is not None:
+            publisher.publish(number, t, centroids, coords)
+
+        if args.headless:
+            # drawing and showing every frame would cost as much as detecting on a small frame
+            now = time.perf_counter()
+            if preview_interval is None or now - last_preview[0] < preview_interval:
+                return True
+            last_preview[0] = now
+
+        draw(frame, centroids, coords, pos)
+        return show(frame)
+
+    return output
+
+def run(args, tlm: Telemetry, video: Video, camera: CameraModel, output):
+    """Capture, detect, georeference and output one frame at a time"""
+    detect, tracker, timer = create_detector(args.downscale, camera, args.track, args.profile)
+    width, height = video.get_resolution()
+
+    number = 0
     try:
-        tlm = Telemetry(args.MAV, messages, conn_print=True, debug_print=True)
-        video = Video(args.STREAM, debug_print=True)
-        detect = TargetDetect()
+        while True:
+            frame = video.get_latest()
+
+            if(frame is None):
+                print("Video stream complete")
+                break
+            number += 1
+            t = video.frame_time - args.video_latency
+
+            centroids = find_targets(detect, tracker, timer, frame)
+
+            # the telemetry when the frame was taken, after detection so there's more likely to be a message after it
+            msgs = tlm.get_msgs_at(t)
+            pos = msgs[GLOBAL_POSITION_INT]
+            att = msgs[ATTITUDE]
+            coords = georeference(detect, centroids, pos, att, width, height)
+            if not output(frame, number, t, centroids, coords, pos):
+                break
+    except KeyboardInterrupt:
+        pass
+
+    if timer:
+        print(timer.format_summary())
+
+    stats = video.get_stats()
+    if stats['consumed']:
+        print(f"Processed {stats['consumed']} of {stats['captured']} frames ({stats['dropped']} dropped), "
+              f"capture to processing latency {stats['mean_latency_ms']:.1f}ms mean, {stats['max_latency_ms']:.1f}ms max")
+
+def run_pipeline(args, tlm: Telemetry, video: Video, camera: CameraModel, output):
+    """Capture, detect, georeference and output frames in a Pipeline, each stage working on a different frame
+
+    Capture and georeferencing are threads, detection is a process (the tracker and the detector's
+    filtering hold the GIL) and the frames are output by the main thread (cv2.imshow() has to be).
+    """
+    width, height = video.get_resolution()
+    # only used to georeference, the detect process has its own
+    detect = TargetDetect(camera=camera)
+    pool = FramePool((height, width, 3), PIPELINE_FRAMES)
+    pipeline = Pipeline(PIPELINE_QUEUE_SIZE)
+    counts = { 'frames': 0, 'dropped': 0 }
+
+    def capture():
+        while pipeline.stages[0].running:
+            # a live stream has to be read as fast as it comes, so frames are dropped when the pipeline is full
+            # (a video file, or --buffer 0, waits instead)
+            drop = args.buffer and video.live
+            slot = pool.acquire(block=False) if drop else pool.acquire(timeout=0.1)
+            if slot is None and not drop:
+                continue
+            if slot is None:
+                if not video.skip():
+                    return None
+                counts['dropped'] += 1
+                continue
+
+            if not video.read_into(pool.frames[slot]):
+                pool.release(slot)
+                return None
+            counts['frames'] += 1
+            return { 'slot': slot, 'number': counts['frames'], 'time': video.frame_time - args.video_latency }
+        return None
+
+    def locate(item):
+        item['centroids'] = Detections(item.pop('detections'), detect.segmenter.colours)
+        msgs = tlm.get_msgs_at(item['time'])
+        item['pos'], item['att'] = msgs[GLOBAL_POSITION_INT], msgs[ATTITUDE]
+        item['coords'] = georeference(detect, item['centroids'], item['pos'], item['att'], width, height)
+        return item
+
+    def render(item):
+        return output(pool.frames[item['slot']], item['number'], item['time'], item['centroids'], item['coords'], item['pos'])
+
+    pipeline.source('capture', capture)
+    pipeline.process('detect', detect_worker, (args.downscale, camera, args.track, args.profile), pool)
+    pipeline.thread('georeference', locate)
+    pipeline.start()
+
+    showing = True
+    results = pipeline.results()
+    try:
+        for item in results:
+            # after the window is closed, the frames still in the pipeline are only released
+            if showing and not render(item):
+                showing = False
+                pipeline.stop()
+            pool.release(item['slot'])
+    except KeyboardInterrupt:
+        showing = False
+        pipeline.stop()
+        for item in results:
+            pool.release(item['slot'])
+    if showing:
+        print("Video stream complete")
+    pipeline.join()
+
+    print(f"Processed {counts['frames']} frames ({counts['dropped']} dropped), stage utilization:")
+    print(pipeline.format_stats())
+    pool.close()
+
+def main():
+    args = parse_args()
+
+    try:
+        tlm = Telemetry(args.MAV, [GLOBAL_POSITION_INT, ATTITUDE], conn_print=True, debug_print=True, history=args.history)
+        # detection needs bgr24, the ffmpeg backend's default pixel format
+        ffmpeg_options = { 'threads': args.decoder_threads, 'low_latency': args.low_latency }
+        # the pipeline reads frames straight into its own buffers
+        video = Video(args.STREAM, debug_print=True, buffer_size=0 if args.pipeline else args.buffer,
+                      backend=args.backend, ffmpeg_options=ffmpeg_options)
+        camera = CameraModel.load(args.camera) if args.camera else None
+        publisher = DetectionPublisher(args.publish, args.format) if args.publish else None
     except Exception as err:
         print(err)
         exit(0)
 
-    # width and height of image stream
-    res = video.get_resolution()
-
-    while True:
-        msgs = tlm.get_msgs()
-        pos = msgs[GLOBAL_POSITION_INT]
-        att = msgs[ATTITUDE]
-
-        frame = video.get_frame()
-
-        if(frame is None):
-            print("Video stream complete")
-            break
-
-        centroids = detect.detect(frame)
-        for c in centroids:
-            start = ( int(c['x']-c['w']/2), int(c['y']-c['h']/2) )
-            end   = ( int(c['x']+c['w']/2), int(c['y']+c['h']/2) )
-            cv2.rectangle(frame, start, end, (36,255,12), 4)
-            cv2.putText(frame, c["color"], start, cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
-            
-        if pos and att:    
-            # TODO: wrap this up in a function in the Video class
-            cv2.putText(frame, f"{pos.time_boot_ms}", (50, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
-            cv2.putText(frame, f"Lat  : {pos.lat/1E7}", (50, 60), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
-            cv2.putText(frame, f"Lon  : {pos.lon/1E7}", (50, 90), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA) 
-            cv2.putText(frame, f"Hdg  : {pos.hdg}", (50, 120), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2, cv2.LINE_AA)
-
-        cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
-        cv2.imshow(WINDOW_NAME, frame)
-
-        key = cv2.waitKey(1)
-        if key == ord('q') or key == 27 or cv2.getWindowProperty(WINDOW_NAME, cv2.WND_PROP_VISIBLE) < 1: # q, esc, or window closed
-            break
+    output = create_output(args, publisher)
+    if args.pipeline:
+        run_pipeline(args, tlm, video, camera, output)
+    else:
+        run(args, tlm, video, camera, output)
+
+    if publisher is not None:
+        print(f"Published {publisher.count} frames to {args.publish}")
+        publisher.close()
 
     print('Closing video')
+    video.cleanup()
     cv2.destroyAllWindows()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()